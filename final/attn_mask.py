@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
 
+import numpy as np
+
 
 class AttnMask(ABC):
 
@@ -13,3 +15,41 @@ class AttnMask(ABC):
 	@abstractmethod
 	def get_cols(self):
 		pass
+
+	@abstractmethod
+	def generate_adj_matrix(self, edges, num_nodes):
+		pass
+
+	def build_attention_matrix(self, num_code_tokens, attn_idxs, num_targets, attn_col_offset):
+		attention_matrix = np.full((num_code_tokens, num_targets), -1e9, dtype=np.float32)
+
+		if len(attn_idxs) == 0:
+			return attention_matrix
+
+		lengths = [len(code_token_idxs) for code_token_idxs in attn_idxs]
+		rows = np.concatenate(attn_idxs).astype(np.int64)
+		cols = np.repeat(np.arange(len(attn_idxs)), lengths) + attn_col_offset # adjust for padding
+		attention_matrix[rows, cols] = 0
+
+		return attention_matrix
+
+	def build_sparse_attention_masks(self, ast_leaf_code_token_idxs, dfg_node_code_token_idxs, dfg_edges,
+									 num_code_tokens, num_ast_leaves, num_dfg_nodes):
+		"""
+		Scatters the attention masks that are stored as index lists into dense matrices.
+		"""
+		return {
+			'attn_dfg_edges': self.generate_adj_matrix(dfg_edges, num_dfg_nodes),
+			'attn_code_ast': self.build_attention_matrix(
+				num_code_tokens=num_code_tokens,
+				attn_idxs=ast_leaf_code_token_idxs,
+				num_targets=num_ast_leaves,
+				attn_col_offset=1  # adjust for padding of AST leaves
+			),
+			'attn_code_dfg': self.build_attention_matrix(
+				num_code_tokens=num_code_tokens,
+				attn_idxs=dfg_node_code_token_idxs,
+				num_targets=num_dfg_nodes,
+				attn_col_offset=1  # adjust for padding of DFG nodes
+			),
+		}
@@ -0,0 +1,221 @@
+import time
+import threading
+from queue import Queue, Full
+
+from ragged_batch import RaggedBatch
+
+import numpy as np
+import torch
+
+END_OF_DATA = object()
+
+
+def get_samples(samples):
+	# collate_fn of the DataLoader of a BatchPrefetcher, which collates the samples itself
+	return samples
+
+
+def map_batch(batch, fn):
+	# applies 'fn' to every tensor of 'batch'
+	if torch.is_tensor(batch):
+		return fn(batch)
+	if isinstance(batch, RaggedBatch):
+		return batch.map_tensors(fn)
+	if isinstance(batch, dict):
+		return {key: map_batch(value, fn) for key, value in batch.items()}
+	if isinstance(batch, (list, tuple)):
+		return type(batch)(map_batch(value, fn) for value in batch)
+
+	return batch
+
+
+class BufferSlot:
+	"""
+	Reusable buffers for the tensors of one batch. The i-th tensor of a batch is a view of the i-th buffer,
+	which is reallocated only if the tensor is larger than any tensor it held before.
+	"""
+
+	def __init__(self, pin_memory):
+		self.pin_memory = pin_memory
+		self.buffers = []
+		self.num_allocs = 0
+		self.num_reuses = 0
+		self.num_used = 0
+		self.in_use = False
+
+	def full(self, size, fill_value, dtype):
+		tensor = self.empty(size, dtype)
+		tensor.fill_(fill_value)
+
+		return tensor
+
+	def empty(self, size, dtype):
+		num_bytes = int(np.prod(size, dtype=np.int64)) * torch.empty(0, dtype=dtype).element_size()
+		if self.num_used < len(self.buffers) and self.buffers[self.num_used].size(0) >= num_bytes:
+			self.num_reuses += 1
+		else:
+			buffer = torch.empty(num_bytes, dtype=torch.uint8, pin_memory=self.pin_memory)
+			if self.num_used < len(self.buffers):
+				self.buffers[self.num_used] = buffer
+			else:
+				self.buffers.append(buffer)
+			self.num_allocs += 1
+		self.num_used += 1
+
+		return self.buffers[self.num_used - 1][:num_bytes].view(dtype).view(size)
+
+	def copy(self, tensor):
+		if any(tensor.untyped_storage().data_ptr() == buffer.data_ptr() for buffer in self.buffers[:self.num_used]):
+			return tensor  # written by collate_fn
+
+		return self.empty(tensor.shape, tensor.dtype).copy_(tensor)
+
+
+class BatchPrefetcher:
+	"""
+	Wraps a DataLoader and prepares the next 'num_prefetch_batches' batches on a background thread.
+	With 'collate_fn', e.g. StructureAwareDataset.collate, the DataLoader yields the samples of each batch,
+	which are collated directly into a pool of reusable buffers, otherwise the collated batches are copied into them.
+	With a GPU, the buffers are pinned and the batches are copied to the device on a separate stream, overlapping with compute.
+	Without a GPU, the batches are handed out in the buffers, which are reused once the next batch is requested.
+	"""
+
+	def __init__(self, loader, collate_fn=None, num_prefetch_batches=2, device=None):
+		self.loader = loader
+		self.collate_fn = collate_fn
+		self.num_prefetch_batches = num_prefetch_batches
+		self.device = device
+		self.pool = []
+		self.pool_lock = threading.Lock()
+		self.num_batches = 0
+		self.sum_queue_depth = 0
+		self.stall_time = 0.0
+
+	def __getattr__(self, name):
+		# e.g. the dataset and the sampler of the DataLoader
+		if name == 'loader':
+			raise AttributeError(name)
+		return getattr(self.loader, name)
+
+	def __len__(self):
+		return len(self.loader)
+
+	def replace_loader(self, loader):
+		# a prefetcher with the same settings around 'loader', e.g. the DataLoader with the sampler of the strategy
+		return BatchPrefetcher(loader, collate_fn=self.collate_fn, num_prefetch_batches=self.num_prefetch_batches, device=self.device)
+
+	def get_metrics(self):
+		"""
+		Returns the mean number of prepared batches when a batch is requested, the total and mean time spent waiting for batches
+		and the fraction of buffer requests that reused a buffer.
+		"""
+		num_allocs = sum(slot.num_allocs for slot in self.pool)
+		num_reuses = sum(slot.num_reuses for slot in self.pool)
+
+		return {
+			'queue_depth': self.sum_queue_depth / self.num_batches if self.num_batches > 0 else 0.0,
+			'stall_time': self.stall_time,
+			'stall_time_per_batch': self.stall_time / self.num_batches if self.num_batches > 0 else 0.0,
+			'buffer_reuse_rate': num_reuses / (num_allocs + num_reuses) if num_allocs + num_reuses > 0 else 0.0,
+		}
+
+	def acquire_slot(self, pin_memory):
+		with self.pool_lock:
+			slot = next((slot for slot in self.pool if not slot.in_use), None)
+			if slot is None:
+				slot = BufferSlot(pin_memory)
+				self.pool.append(slot)
+			slot.in_use = True
+			slot.num_used = 0
+
+		return slot
+
+	def release_slot(self, slot):
+		with self.pool_lock:
+			slot.in_use = False
+
+	def prepare(self, samples, slot, stream):
+		if self.collate_fn is not None:
+			batch = self.collate_fn(samples, full=slot.full)
+		else:
+			batch = samples
+		batch = map_batch(batch, slot.copy)
+
+		if stream is None:
+			return batch
+
+		with torch.cuda.stream(stream):
+			batch = map_batch(batch, lambda tensor: tensor.to(self.device, non_blocking=True))
+		stream.synchronize()  # the buffers can be reused once the copies are done
+		self.release_slot(slot)
+
+		return batch
+
+	def prefetch(self, queue, stop):
+		stream = None
+		if self.device is not None:
+			torch.cuda.set_device(self.device)
+			stream = torch.cuda.Stream(self.device)
+
+		try:
+			for samples in self.loader:
+				slot = self.acquire_slot(pin_memory=stream is not None)
+				batch = self.prepare(samples, slot, stream)
+				if not put(queue, (batch, None if stream is not None else slot), stop):
+					self.release_slot(slot)
+					return
+			put(queue, END_OF_DATA, stop)
+		except Exception as e:
+			put(queue, e, stop)
+
+	def __iter__(self):
+		if self.device is None and torch.cuda.is_available():
+			self.device = torch.device('cuda', torch.cuda.current_device())
+
+		queue = Queue(maxsize=self.num_prefetch_batches)
+		stop = threading.Event()
+		thread = threading.Thread(target=self.prefetch, args=(queue, stop), daemon=True)
+		thread.start()
+		slot = None
+		try:
+			while True:
+				if slot is not None:
+					self.release_slot(slot)  # the previous batch is no longer used
+					slot = None
+				self.sum_queue_depth += queue.qsize()
+				start = time.perf_counter()
+				item = queue.get()
+				self.stall_time += time.perf_counter() - start
+				if item is END_OF_DATA:
+					return
+				if isinstance(item, Exception):
+					raise item
+
+				batch, slot = item
+				self.num_batches += 1
+				if self.device is not None:
+					# the batch was allocated on the stream of the background thread
+					map_batch(batch, lambda tensor: tensor.record_stream(torch.cuda.current_stream()))
+				yield batch
+		finally:
+			stop.set()
+			thread.join()
+			# batches that were prepared but not requested
+			while not queue.empty():
+				item = queue.get()
+				if isinstance(item, tuple) and item[1] is not None:
+					self.release_slot(item[1])
+			if slot is not None:
+				self.release_slot(slot)
+
+
+def put(queue, item, stop):
+	# returns False if the consumer stopped before the item could be put
+	while not stop.is_set():
+		try:
+			queue.put(item, timeout=0.1)
+			return True
+		except Full:
+			pass
+
+	return False
@@ -1,18 +1,28 @@
 import os
+import json
+import hashlib
 import pickle
+import multiprocessing
 import re
+import time
 import tokenize
-import ast
 from io import StringIO
+from concurrent.futures import ProcessPoolExecutor
 from types import SimpleNamespace
 
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from tqdm import tqdm
 from transformers import AutoTokenizer
 import pandas as pd
 
 from attn_mask import AttnMask
 from code_completion_attn_mask import CodeCompletionAttnMask
+from pipeline_profiler import PipelineProfiler
+from deduplication import Deduplicator
+from length_budget import LengthBudget, merge_stats
 
 tqdm.pandas()
 from datasets import load_dataset
@@ -20,16 +30,67 @@ from datasets import load_dataset
 START_TOK_ID_DFG = 0
 PAD_TOK_ID_DFG = 2
 
+DEFAULT_TOKENIZER = 'bigcode/starcoder2-3b'
+MANIFEST_FILENAME = 'manifest.json'
+PROFILE_REPORT_FILENAME = 'profile.json'
+
+# part of the sample keys, must be increased whenever a change of the pipeline changes its output
+PIPELINE_VERSION = 4
+
+MAX_NUM_AST_LEAVES_LL_SIMS = 512
+MAX_REL_POS = 127
+
+# Version 1: nested lists str()-serialized by fastparquet, version 2: typed nested Arrow list columns compressed with zstd,
+# version 3: token ids, AST path lengths and the DFG node mask as integer list columns instead of comma-separated strings,
+# version 4: without the masks that only depend on the sequence lengths, i.e. attn_code_tokens, attn_ast_leaves,
+# attn_text_tokens, attn_code_text, attn_ast_text and attn_dfg_text (see LENGTH_DERIVED_COLS),
+# version 5: ll_sims as a nested float64 list column instead of a string with ';'-separated rows of ','-separated values
+SHARD_FORMAT_VERSION = 5
+SHARD_FORMAT_VERSION_KEY = 'shard_format_version'
+LL_SIMS_REDUCED_FLAG = 'll_sims_reduced'
+# stored up to format version 3, built from the sequence lengths at collate time since version 4
+LENGTH_DERIVED_COLS = ['attn_code_tokens', 'attn_ast_leaves', 'attn_text_tokens', 'attn_code_text', 'attn_ast_text', 'attn_dfg_text']
+MATRIX_TYPE = pa.list_(pa.list_(pa.float32()))  # type of all 'attn_' columns
+# float64 keeps the similarities exact, the rows are the upper triangles once they are reduced, see reduce_ll_sims
+LL_SIMS_TYPE = pa.list_(pa.list_(pa.float64()))
+# matrices per chunk of a nested list column, i.e. at most 100 * 512 * 512 values, far below the 32-bit list offsets
+MATRICES_PER_CHUNK = 100
+SHARD_COL_TYPES = {
+	'll_sims': LL_SIMS_TYPE,
+	'code_tokens': pa.list_(pa.int32()),
+	'text_tokens': pa.list_(pa.int32()),
+	'lr_paths_len': pa.list_(pa.int32()),
+	'dfg_node_mask': pa.list_(pa.int8()),
+	'dfg_edges': pa.list_(pa.struct([('to_node', pa.int64()), ('from_nodes', pa.list_(pa.int64()))])),
+}
+
+DOCSTRING_QUOTES = '"""'
+CRLF_BLANK_LINES = re.compile(r"\r\n\s*\r\n")
+
+# (data_handler, data, num_rows_per_file) inherited by forked workers of store_preprocessed_data
+_worker_state = None
+
 
 class DataHandler:
 
 	def __init__(self, save_dir, dataset='code_search_net', lang='python',
-				 tokenizer=AutoTokenizer.from_pretrained('bigcode/starcoder2-3b'), attn_mask_builder: AttnMask=CodeCompletionAttnMask()):
+				 tokenizer=None, attn_mask_builder: AttnMask=CodeCompletionAttnMask(),
+				 tokenizer_cache_dir=os.path.join(os.path.expanduser('~'), '.cache', 'structure_aware', 'tokenizers'),
+				 sort_shards_by_length=False, profiler: PipelineProfiler=None, deduplicator: Deduplicator=None,
+				 length_budget: LengthBudget=None):
 		self.save_dir = save_dir
 		self.dataset = dataset
 		self.lang = lang
-		self.tokenizer = tokenizer
+		# loaded on demand, so that the module can be imported offline
+		self.tokenizer = AutoTokenizer.from_pretrained(DEFAULT_TOKENIZER) if tokenizer is None else tokenizer
 		self.attn_mask_builder = attn_mask_builder
+		self.tokenizer_cache_dir = tokenizer_cache_dir
+		self.tokenizer_artifacts = None
+		self.sort_shards_by_length = sort_shards_by_length
+		# a disabled profiler only costs a few function calls per stage
+		self.profiler = PipelineProfiler(enabled=False) if profiler is None else profiler
+		self.deduplicator = deduplicator
+		self.length_budget = length_budget
 
 	def read_dataset(self, split, max_samples=None):
 		np.random.seed(10)
@@ -43,12 +104,41 @@ class DataHandler:
 		pbar = tqdm(indices)
 		pbar.set_description('Reading split=' + split)
 
-		for i in pbar:
-			sample = dataset[split][i]
-			rows.append([sample['func_documentation_string'], sample['func_code_string']])
+		with self.profiler.stage('read_dataset', len(indices)):
+			for i in pbar:
+				sample = dataset[split][i]
+				rows.append([sample['func_documentation_string'], sample['func_code_string']])
 
 		return pd.DataFrame(rows, columns=['text', 'code'])
 
+	def iter_dataset(self, split, max_samples=None, batch_size=1000):
+		"""
+		Streaming counterpart of read_dataset that yields the split in DataFrames of at most 'batch_size' rows.
+		Sampling is done on the fly via selection sampling, so no index list is materialized.
+		"""
+		rng = np.random.default_rng(10)
+		dataset = load_dataset(self.dataset, self.lang, split=split).select_columns(['func_documentation_string', 'func_code_string'])
+
+		num_remaining = len(dataset)
+		num_to_select = num_remaining if max_samples is None else min(max_samples, num_remaining)
+		pbar = tqdm(dataset.iter(batch_size=batch_size), total=(num_remaining + batch_size - 1) // batch_size)
+		pbar.set_description('Streaming split=' + split)
+
+		for batch in pbar:
+			rows = []
+			draws = rng.random(len(batch['func_code_string']))
+			for draw, text, code in zip(draws, batch['func_documentation_string'], batch['func_code_string']):
+				# each subset of size max_samples is equally likely
+				if draw * num_remaining < num_to_select:
+					rows.append([text, code])
+					num_to_select -= 1
+				num_remaining -= 1
+
+			if rows:
+				yield pd.DataFrame(rows, columns=['text', 'code'])
+			if num_to_select == 0:
+				break
+
 	def get_tokenizer_chars(self):
 		tokenizer_chars = []
 
@@ -61,27 +151,67 @@ class DataHandler:
 
 		return tokenizer_chars
 
+	def get_tokenizer_key(self):
+		name = getattr(self.tokenizer, 'name_or_path', type(self.tokenizer).__name__)
+		revision = getattr(self.tokenizer, 'init_kwargs', {}).get('_commit_hash') or 'main'
+
+		return re.sub(r'[^A-Za-z0-9_.-]', '_', name + '@' + str(revision) + '@' + str(self.tokenizer.vocab_size))
+
+	def get_tokenizer_cache_path(self):
+		return os.path.join(self.tokenizer_cache_dir, self.get_tokenizer_key() + '.pkl')
+
+	def get_tokenizer_artifacts(self):
+		"""
+		Returns the artifacts derived from the tokenizer that preprocessing needs.
+		They are cached on disk keyed by tokenizer name and revision, as deriving them decodes the whole vocabulary.
+		"""
+		if self.tokenizer_artifacts is not None:
+			return self.tokenizer_artifacts
+
+		cache_path = self.get_tokenizer_cache_path()
+		if os.path.exists(cache_path):
+			with open(cache_path, 'rb') as f:
+				self.tokenizer_artifacts = pickle.load(f)
+			return self.tokenizer_artifacts
+
+		tokenizer_chars = self.get_tokenizer_chars()
+		self.tokenizer_artifacts = {
+			'tokenizer_chars': frozenset(tokenizer_chars),
+			# matches every character that is not in the vocabulary of the tokenizer
+			'char_filter_pattern': '[^' + ''.join(re.escape(c) for c in sorted(set(tokenizer_chars))) + ']',
+			'bos_token_id': self.tokenizer.bos_token_id,
+			'eos_token_id': self.tokenizer.eos_token_id,
+			'vocab_size': self.tokenizer.vocab_size,
+		}
+
+		os.makedirs(self.tokenizer_cache_dir, exist_ok=True)
+		tmp_path = cache_path + '.' + str(os.getpid()) + '.tmp'
+		with open(tmp_path, 'wb') as f:
+			pickle.dump(self.tokenizer_artifacts, f)
+		os.replace(tmp_path, cache_path)  # atomic, so that concurrent runs never read a partial file
+
+		return self.tokenizer_artifacts
+
+	def get_char_filter(self):
+		return re.compile(self.get_tokenizer_artifacts()['char_filter_pattern'])
+
 	def remove_comments_and_docstrings(self, source):
 		"""
 		Returns 'source' minus comments and docstrings.
+		Runs in linear time: tokens are written to a StrippedCodeWriter, which drops blank rows and cuts out docstrings
+		in the same pass.
 		"""
 		io_obj = StringIO(source)
-		out = ""
+		out = StrippedCodeWriter()
 		prev_toktype = tokenize.INDENT
 		last_lineno = -1
 		last_col = 0
 
-		for tok in tokenize.generate_tokens(io_obj.readline):
-			token_type = tok[0]
-			token_string = tok[1]
-			start_line, start_col = tok[2]
-			end_line, end_col = tok[3]
-			line_text = tok[4]
-
+		for token_type, token_string, (start_line, start_col), (end_line, end_col), _ in tokenize.generate_tokens(io_obj.readline):
 			if start_line > last_lineno:
 				last_col = 0 # start at beginning of new line
 			if start_col > last_col:
-				out += (" " * (start_col - last_col)) # add space between tokens
+				out.write(" " * (start_col - last_col)) # add space between tokens
 
 			# Remove comments:
 			if token_type == tokenize.COMMENT:
@@ -92,61 +222,76 @@ class DataHandler:
 					# This is likely a docstring; double-check we're not inside an operator:
 					if prev_toktype != tokenize.NEWLINE:
 						if start_col > 0:
-							out += token_string
+							out.write(token_string)
 			else:
-				out += token_string
+				out.write(token_string)
 
 			prev_toktype = token_type
 			last_col = end_col
 			last_lineno = end_line
 
-		temp = []
-		for row in out.split('\n'):
-			if row.strip() != "":
-				temp.append(row)
-		code = '\n'.join(temp)
-
-		pos = 0
-		docstring_quotes = '"""'
-		while pos < len(code):
-			try:
-				start = code[pos:].index(docstring_quotes) + pos
-				end = code[start + len(docstring_quotes):].index(docstring_quotes) + start + len(docstring_quotes)
-				code = code[:start] + code[end + len(docstring_quotes):]
-				pos = start
-			except:
-				break
-
-		return re.sub(r"\r\n\s*\r\n", '\n', code)
+		return CRLF_BLANK_LINES.sub('\n', out.getvalue())
 
 	def preprocess(self, data):
 		failed_count = 0
+		num_rows = len(data)
 		rows = []
-		tokenizer_chars = self.get_tokenizer_chars()
+		char_filter = self.get_char_filter()
 		pbar = tqdm(data.itertuples())
+		profile = self.profiler.enabled
+		filter_seconds = 0.0
+		remove_seconds = 0.0
 
 		for row in pbar:
+			start = time.perf_counter() if profile else 0
 			code = row.code.strip().replace('▁', '_').replace('\r\n', '\n')  # step 1
-			code = ''.join(filter(lambda c: c in tokenizer_chars, code))  # step 2
+			code = char_filter.sub('', code)  # step 2
+			if profile:
+				filter_seconds += time.perf_counter() - start
+				start = time.perf_counter()
 			try:
 				code = self.remove_comments_and_docstrings(code)  # step 3
-			except:
+			except (tokenize.TokenError, SyntaxError):
 				failed_count += 1
 				pbar.set_description('failed_count=' + str(failed_count))
 				continue
+			finally:
+				if profile: remove_seconds += time.perf_counter() - start
 
 			rows.append([row.text.strip(), code])
 
 		data = pd.DataFrame(rows, columns=['text', 'code'])
+		self.profiler.add('preprocess.char_filter', filter_seconds, num_rows=num_rows)
+		self.profiler.add('preprocess.remove_comments_and_docstrings', remove_seconds, num_rows=num_rows)
 
 		return data
 
-	def convert_tokens_to_strings(self, data):
-		data = data.drop(columns=['ast_leaf_tokens', 'ast_leaf_ranges', 'code_tokens_ranges'])
-		for col in ['code_tokens', 'text_tokens']:
-			data[col] = data[col].progress_apply(lambda l: ','.join(list(map(str, l))))
+	def deduplicate(self, data, reset=False):
+		"""
+		Drops exact and near-duplicate functions of preprocessed data, ideally before the expensive structural featurization.
+		Duplicates are detected across all calls since the last one with reset=True, see Deduplicator.
+		Without a deduplicator, 'data' is returned as is.
+		"""
+		if self.deduplicator is None:
+			return data
+
+		if reset:
+			self.deduplicator.reset()
+		with self.profiler.stage('deduplicate', len(data)):
+			data = self.deduplicator.filter(data)
+		if reset:
+			tqdm.write(self.deduplicator.get_summary())
+
+		return data
 
-		return data.sample(frac=1).reset_index(drop=True)
+	def convert_tokens_to_arrays(self, data):
+		with self.profiler.stage('convert_tokens_to_arrays', len(data)):
+			data = data.drop(columns=['ast_leaf_tokens', 'ast_leaf_ranges', 'code_tokens_ranges'])
+			for col in ['code_tokens', 'text_tokens']:
+				offsets, values = flatten_lists(data[col])
+				data[col] = to_arrow_series(list_array(offsets, pa.array(values, type=pa.int32())), data.index)
+
+			return data.sample(frac=1).reset_index(drop=True)
 
 	def get_lr_path(self, leaf):
 		path = [leaf]
@@ -156,7 +301,8 @@ class DataHandler:
 		return path
 
 	def clean_data(self, data):
-		return data[data['dfg_edges'].apply(lambda row: row != [])].reset_index(drop=True)
+		with self.profiler.stage('clean_data', len(data)):
+			return data[data['dfg_edges'].apply(lambda row: row != [])].reset_index(drop=True)
 
 	def get_ll_sim(self, lr_path1, lr_path2):
 		node_types = [node.type for node in lr_path1 + lr_path2]
@@ -170,28 +316,58 @@ class DataHandler:
 
 		return common * common / (len(lr_path1) * len(lr_path2))
 
+	def compute_ll_sims(self, leaf_lr_paths, max_num_ast_leaves=MAX_NUM_AST_LEAVES_LL_SIMS):
+		"""
+		Vectorized get_ll_sim for all pairs of AST leaves incl. the rows and columns of <START_AST> and <END_AST>.
+		Root-to-leaf paths are encoded as integer arrays of node ids,
+		such that the number of common nodes (depth of the LCA) is computed for all pairs at once.
+		"""
+		num_ast_leaves = min(len(leaf_lr_paths) + 2, max_num_ast_leaves)
+		leaf_lr_paths = leaf_lr_paths[:num_ast_leaves - 1]  # first row is <START_AST>
+		num_leaves = len(leaf_lr_paths)
+
+		node_ids = {}
+		lr_paths_len = np.array([len(lr_path) for lr_path in leaf_lr_paths], dtype=np.int64)
+		max_depth = max(lr_paths_len, default=1)
+		# padding ids are unique per leaf, so that padded positions never match
+		root_leaf_paths = np.repeat(-1 - np.arange(num_leaves, dtype=np.int64)[:, None], max_depth, axis=1)
+		for i, lr_path in enumerate(leaf_lr_paths):
+			root_leaf_paths[i, :len(lr_path)] = [node_ids.setdefault(node, len(node_ids)) for node in reversed(lr_path)]
+
+		common = np.ones((num_leaves, num_leaves), dtype=np.int64)  # root is always common
+		is_common_prefix = np.ones((num_leaves, num_leaves), dtype=bool)
+		for depth in range(1, max_depth):
+			nodes = root_leaf_paths[:, depth]
+			is_common_prefix &= nodes[:, None] == nodes[None, :]
+			common += is_common_prefix
+
+		ll_sims = np.zeros((num_ast_leaves, num_ast_leaves))
+		ll_sims[1:num_leaves + 1, 1:num_leaves + 1] = common * common / np.outer(lr_paths_len, lr_paths_len)
+		np.fill_diagonal(ll_sims, 1)
+
+		return ll_sims
+
 	def add_ast_lr_paths_and_ll_sim(self, data):
 		ll_sims = []
 		lr_paths = []
 		all_node_types = set()
 
 		for i, row in tqdm(enumerate(data.itertuples())):
-			curr_lr_paths = [[SimpleNamespace(type='<START_AST>')]] + [self.get_lr_path(leaf) for leaf in row.ast_leaves] + [[SimpleNamespace(type='<END_AST>')]]
-			num_ast_leaves = min(len(curr_lr_paths), 512)
-			curr_ll_sims = np.ones((num_ast_leaves, num_ast_leaves))
-
-			for i in range(num_ast_leaves - 1):
-				for j in range(i + 1, num_ast_leaves):
-					curr_ll_sims[i, j] = curr_ll_sims[j, i] = self.get_ll_sim(curr_lr_paths[i], curr_lr_paths[j])
+			leaf_lr_paths = [self.get_lr_path(leaf) for leaf in row.ast_leaves]
+			if self.length_budget is not None:
+				leaf_lr_paths = [self.length_budget.truncate_lr_path(lr_path) for lr_path in leaf_lr_paths]
+			curr_lr_paths = [[SimpleNamespace(type='<START_AST>')]] + leaf_lr_paths + [[SimpleNamespace(type='<END_AST>')]]
+			curr_ll_sims = self.compute_ll_sims(curr_lr_paths[1:-1])
 
-			ll_sims.append(';'.join([','.join(list(map(str, row))) for row in curr_ll_sims]))
+			ll_sims.append(curr_ll_sims)
 			lr_paths.append([[node.type for node in path] for path in curr_lr_paths])
 			all_node_types.update(set(np.concatenate(lr_paths[-1])))
 
 		data.drop(columns=['ast_leaves'], inplace=True)
-		data['ll_sims'] = ll_sims
+		data['ll_sims'] = to_arrow_series(matrix_list_array(ll_sims), data.index)
 		data['lr_paths_types'] = lr_paths
-		data['lr_paths_len'] = data['lr_paths_types'].apply(lambda row: ",".join(str(len(sublist)) for sublist in row))
+		offsets, values = flatten_lists([[len(lr_path) for lr_path in row] for row in lr_paths])
+		data['lr_paths_len'] = to_arrow_series(list_array(offsets, pa.array(values, type=pa.int32())), data.index)
 
 		return all_node_types
 
@@ -199,140 +375,762 @@ class DataHandler:
 		""""
 		A DFG node/variable can correspond to multiple code tokens due to tokenization.
 		This function maps each DFG node/variable to the corresponding code tokens.
+		The edges and mappings of the whole chunk are flattened into CSR arrays (values and offsets),
+		such that the mapping is done by array operations and the results are Arrow list columns.
 		"""
-		dfg_node_code_token_idxs = []
-		dfg_edges = []
-
-		for row in tqdm(data.itertuples()):
-			if len(row.dfg_edges) > 0:
-				dfg_nodes = sorted(list(set(np.concatenate([[left] + right for left, right in row.dfg_edges]))))
-			else:
-				dfg_nodes = []
+		num_rows = len(data)
+		leaf_row_offsets, leaf_offsets, leaf_values = flatten_nested_lists(data['ast_leaf_code_token_idxs'])
+		edge_row_offsets, edge_to = flatten_lists([[left for left, _ in row] for row in data['dfg_edges']])
+		edge_from_offsets, edge_from = flatten_lists([right for row in data['dfg_edges'] for _, right in row])
+
+		# keys (row, AST leaf) of all edge endpoints, the unique keys of a row are its sorted DFG nodes
+		edge_row = np.repeat(np.arange(num_rows), np.diff(edge_row_offsets))
+		edge_from_row = np.repeat(edge_row, np.diff(edge_from_offsets))
+		num_keys_per_row = max(edge_to.max(initial=-1), edge_from.max(initial=-1)) + 1
+		to_keys = edge_row * num_keys_per_row + edge_to
+		from_keys = edge_from_row * num_keys_per_row + edge_from
+		dfg_node_keys = np.unique(np.concatenate([to_keys, from_keys]))
+		dfg_node_row = dfg_node_keys // num_keys_per_row
+		node_row_offsets = np.concatenate([[0], np.cumsum(np.bincount(dfg_node_row, minlength=num_rows))])
+
+		# index of a DFG node within its row
+		edge_to = np.searchsorted(dfg_node_keys, to_keys) - node_row_offsets[edge_row]
+		edge_from = np.searchsorted(dfg_node_keys, from_keys) - node_row_offsets[edge_from_row]
+
+		# DFG was built with the indices of AST leaves
+		# Thus, the index of a DFG node can be used to retrieve the corresponding AST leaf and its code tokens
+		dfg_node_leaf = leaf_row_offsets[dfg_node_row] + dfg_node_keys % num_keys_per_row
+		node_offsets, node_values = gather_ranges(leaf_values, leaf_offsets[dfg_node_leaf], leaf_offsets[dfg_node_leaf + 1])
+
+		dfg_edges = list_array(edge_row_offsets, pa.StructArray.from_arrays(
+			[pa.array(edge_to), list_array(edge_from_offsets, edge_from)], names=['to_node', 'from_nodes']))
+		data['dfg_edges'] = to_arrow_series(dfg_edges, data.index)
+		data['ast_leaf_code_token_idxs'] = to_arrow_series(
+			list_array(leaf_row_offsets, list_array(leaf_offsets, leaf_values)), data.index)
+		data['dfg_node_code_token_idxs'] = to_arrow_series(
+			list_array(node_row_offsets, list_array(node_offsets, node_values)), data.index)
+		dfg_node_mask = list_array(node_row_offsets, pa.array(np.ones(node_row_offsets[-1], dtype=np.int8)))
+		data['dfg_node_mask'] = to_arrow_series(wrap_list_array(dfg_node_mask, START_TOK_ID_DFG, PAD_TOK_ID_DFG), data.index)
+
+	def process_chunk(self, chunk_data, start):
+		"""
+		Computes all structural features of a chunk and stores it as shard 'from_<start>.parquet'.
+		Returns the partial metadata of the chunk that is needed to build the metadata of the whole split.
+		"""
+		num_rows = len(chunk_data)
+		if 'sample_key' not in chunk_data.columns:
+			with self.profiler.stage('compute_sample_keys', num_rows, start):
+				chunk_data['sample_key'] = self.compute_sample_keys(chunk_data)
+
+		length_budget_stats = None
+		if self.length_budget is not None:
+			with self.profiler.stage('apply_length_budget', num_rows, start):
+				chunk_data, length_budget_stats = self.length_budget.apply(chunk_data)
+			num_rows = len(chunk_data)
+			if num_rows == 0:
+				return self.store_shard_metadata(set(), 0, -1, start, length_budget_stats)
+
+		with self.profiler.stage('add_ast_lr_paths_and_ll_sim', num_rows, start):
+			chunk_node_types = self.add_ast_lr_paths_and_ll_sim(chunk_data)
+			chunk_max_ast_depth = max([len(lr_path) for row in chunk_data['lr_paths_types'] for lr_path in row])
+		with self.profiler.stage('map_dfg_node_code_token_idices', num_rows, start):
+			self.map_dfg_node_code_token_idices(chunk_data)
+		with self.profiler.stage('add_special_tokens', num_rows, start):
+			self.add_special_tokens(chunk_data)
+		with self.profiler.stage('compute_attention_masks', num_rows, start):
+			chunk_data = self.attn_mask_builder.compute_attention_masks(chunk_data)
+		with self.profiler.stage('compute_max_relative_distance', num_rows, start):
+			# relative distances are derived from the number of code/text tokens at training time
+			chunk_max_rel_pos = int(self.compute_max_relative_distance(list_lengths(chunk_data['code_tokens'])).max())
+
+		cols = (['sample_key', 'code_tokens', 'lr_paths_types', 'lr_paths_len', 'll_sims',
+				 'dfg_node_mask',]
+				+ self.attn_mask_builder.get_cols())
+		chunk_data = chunk_data[cols]
+
+		if self.sort_shards_by_length:
+			# homogeneous lengths within row groups
+			sample_lengths = self.compute_sample_lengths(chunk_data)
+			chunk_data = chunk_data.iloc[np.argsort(sample_lengths['total_len'], kind='stable')]
+
+		path = os.path.join(self.save_dir, 'from_' + str(start) + '.parquet')
+		with self.profiler.stage('write_shard', num_rows, start) as record:
+			self.write_shard(chunk_data, path)
+			if record is not None: record.bytes_written = os.path.getsize(path)
+
+		return self.store_shard_metadata(chunk_node_types, chunk_max_rel_pos, chunk_max_ast_depth, start, length_budget_stats)
+
+	def store_shard_metadata(self, node_types, max_rel_pos, max_ast_depth, start, length_budget_stats=None):
+		shard_metadata = {
+			'node_types': node_types,
+			'max_rel_pos': max_rel_pos,
+			'max_ast_depth': max_ast_depth,
+		}
+		if length_budget_stats is not None:
+			shard_metadata['length_budget_stats'] = length_budget_stats
+		with open(os.path.join(self.save_dir, 'meta_from_' + str(start) + '.pkl'), 'wb') as f:
+			pickle.dump(shard_metadata, f)
+
+		return shard_metadata
+
+	def get_shard_starts(self, num_rows, num_rows_per_file, num_hosts=1, host_id=0):
+		# deterministic round-robin assignment of chunks to hosts
+		return [start for i, start in enumerate(range(0, num_rows, num_rows_per_file)) if i % num_hosts == host_id]
+
+	def store_preprocessed_data(self, data, num_rows_per_file, num_workers=1, num_hosts=1, host_id=0):
+		"""
+		Stores the chunks of 'data' assigned to host 'host_id' as shards.
+		With num_workers > 1, the chunks are processed in a pool of forked worker processes.
+		Each shard is accompanied by its partial metadata that is merged by merge_shard_metadata.
+		With a deduplicator, duplicates within 'data' are dropped first. Deduplication is deterministic,
+		so all hosts agree on the chunks.
+		"""
+		data = self.deduplicate(data, reset=True)
+		# do memory intensive part in chunks
+		os.makedirs(self.save_dir, exist_ok=True)
+		# the chunks of all hosts, shards of earlier runs at other starts are not overwritten
+		self.remove_stale_shards(range(0, len(data), num_rows_per_file))
+		starts = self.get_shard_starts(len(data), num_rows_per_file, num_hosts=num_hosts, host_id=host_id)
+
+		if num_workers > 1:
+			global _worker_state
+			# AST leaves are not picklable, so forked workers access the data via inherited memory
+			_worker_state = (self, data, num_rows_per_file)
+			try:
+				with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+					all_shard_metadata = []
+					for shard_metadata, records in tqdm(executor.map(_process_chunk_in_worker, starts), total=len(starts)):
+						all_shard_metadata.append(shard_metadata)
+						self.profiler.extend(records)
+			finally:
+				_worker_state = None
+		else:
+			all_shard_metadata = []
+			for start in starts:
+				chunk_data = data.iloc[start:start + num_rows_per_file].copy()  # copy so that edits are not on data
+				all_shard_metadata.append(self.process_chunk(chunk_data, start))
 
-			dfg_node_to_idx = {k: i for i, k in enumerate(dfg_nodes)}
-			# DFG was built with the indices of AST leaves
-			# Thus, the index of a DFG node can be used to retrieve the corresponding AST leaf and its code tokens
-			dfg_node_code_token_idxs.append([row.ast_leaf_code_token_idxs[i] for i in dfg_nodes])
-			dfg_edges.append([(dfg_node_to_idx[left], [dfg_node_to_idx[r] for r in right]) for left, right in row.dfg_edges])
+		all_node_types, global_max_rel_pos, _ = self.merge_metadata(all_shard_metadata)
 
-		data['dfg_edges'] = dfg_edges
-		data['dfg_node_code_token_idxs'] = dfg_node_code_token_idxs
-		data['dfg_node_mask'] = [str(START_TOK_ID_DFG) + ","
-								 + ",".join(["1" for _ in sublist])
-								 + "," + str(PAD_TOK_ID_DFG) for sublist in dfg_node_code_token_idxs]
+		return all_node_types, global_max_rel_pos
 
-	def store_preprocessed_data(self, data, num_rows_per_file):
-		# do memory intensive part in chunks
+	def rechunk(self, batches, num_rows):
+		# regroups a stream of DataFrames into DataFrames of exactly 'num_rows' rows (except for the last one)
+		buffer = []
+		num_buffered = 0
+		for batch in batches:
+			buffer.append(batch)
+			num_buffered += len(batch)
+			while num_buffered >= num_rows:
+				data = pd.concat(buffer, ignore_index=True)
+				yield data.iloc[:num_rows].reset_index(drop=True)
+				buffer = [data.iloc[num_rows:]]
+				num_buffered -= num_rows
+
+		if num_buffered > 0:
+			yield pd.concat(buffer, ignore_index=True)
+
+	def store_preprocessed_batches(self, batches, num_rows_per_file):
+		"""
+		Streaming counterpart of store_preprocessed_data.
+		At most one chunk of 'num_rows_per_file' rows and one incoming batch are held in memory at a time.
+		"""
 		os.makedirs(self.save_dir, exist_ok=True)
+		all_shard_metadata = []
+		start = 0
+		for chunk_data in self.rechunk(batches, num_rows_per_file):
+			chunk_data.index = pd.RangeIndex(start, start + len(chunk_data))  # same row index as in store_preprocessed_data
+			all_shard_metadata.append(self.process_chunk(chunk_data, start))
+			start += len(chunk_data)
+		self.remove_stale_shards(range(0, start, num_rows_per_file))
+
+		all_node_types, global_max_rel_pos, _ = self.merge_metadata(all_shard_metadata)
+
+		return all_node_types, global_max_rel_pos
+
+	def stream_preprocessed_data(self, split, featurize_fn, num_rows_per_file, max_samples=None, batch_size=1000):
+		"""
+		Bounded-memory pipeline from reading the split to writing its shards.
+		'featurize_fn' maps a preprocessed batch to a batch with the columns code_tokens, text_tokens, ast_leaves,
+		ast_leaf_tokens, ast_leaf_ranges, ast_leaf_code_token_idxs, code_tokens_ranges and dfg_edges.
+		Rows are shuffled within batches only. With a deduplicator, duplicates within the split are dropped right after preprocessing.
+		"""
+		if self.deduplicator is not None:
+			self.deduplicator.reset()
+		batches = self.iter_dataset(split, max_samples=max_samples, batch_size=batch_size)
+		batches = (self.deduplicate(self.preprocess(batch)) for batch in batches)
+		batches = (featurize_fn(batch) for batch in batches if len(batch) > 0)
+		batches = (self.convert_tokens_to_arrays(self.clean_data(batch)) for batch in batches)
+
+		result = self.store_preprocessed_batches(batches, num_rows_per_file)
+		if self.deduplicator is not None:
+			tqdm.write(self.deduplicator.get_summary())
+
+		return result
+
+	def merge_metadata(self, all_shard_metadata):
 		all_node_types = set()
 		global_max_rel_pos = 0
+		global_max_ast_depth = -1
+		for shard_metadata in all_shard_metadata:
+			all_node_types.update(shard_metadata['node_types'])
+			global_max_rel_pos = max(global_max_rel_pos, shard_metadata['max_rel_pos'])
+			global_max_ast_depth = max(global_max_ast_depth, shard_metadata['max_ast_depth'])
+
+		return all_node_types, global_max_rel_pos, global_max_ast_depth
+
+	def remove_stale_shards(self, starts):
+		# removes the shards in save_dir and their metadata left by earlier runs, whose start is not in 'starts'
+		starts = set(starts)
+		for filename in os.listdir(self.save_dir):
+			if filename.startswith('meta_from_') and filename.endswith('.pkl'):
+				start = int(filename[len('meta_from_'):-len('.pkl')])
+			elif filename.startswith('from_') and filename.endswith('.parquet'):
+				start = get_shard_start(filename)
+			else:
+				continue
+			if start not in starts:
+				try:
+					os.remove(os.path.join(self.save_dir, filename))
+				except FileNotFoundError:
+					pass  # removed by another host
+
+	def load_all_shard_metadata(self):
+		# partial metadata of the shards in save_dir, metadata without a shard is ignored
+		all_shard_metadata = []
+		for path in self.iter_shard_paths(self.save_dir):
+			with open(os.path.join(self.save_dir, 'meta_from_' + str(get_shard_start(path)) + '.pkl'), 'rb') as f:
+				all_shard_metadata.append(pickle.load(f))
+
+		return all_shard_metadata
+
+	def get_length_budget_stats(self):
+		"""
+		Returns the number of samples whose code tokens, AST leaves, DFG nodes, LR paths or total length were over budget,
+		and the number of dropped samples, merged over all shards in save_dir, see LengthBudget.
+		"""
+		return merge_stats([shard_metadata.get('length_budget_stats', {}) for shard_metadata in self.load_all_shard_metadata()])
 
-		for start in range(0, len(data), num_rows_per_file):
-			chunk_data = data.iloc[start:start + num_rows_per_file].copy()  # copy so that edits are not on data
-			chunk_node_types = self.add_ast_lr_paths_and_ll_sim(chunk_data)
-			all_node_types.update(chunk_node_types)
-			self.map_dfg_node_code_token_idices(chunk_data)
-			self.add_special_tokens(chunk_data)
-			chunk_data = self.attn_mask_builder.compute_attention_masks(chunk_data)
-			chunk_data['code_tokens_rel_pos_ids'] = chunk_data['code_tokens_pos_ids'].apply(self.compute_relative_distances)
-			chunk_data['text_tokens_rel_pos_ids'] = chunk_data['text_tokens_pos_ids'].apply(self.compute_relative_distances)
-			chunk_max_rel_pos = max([row[0][-1] for row in chunk_data['code_tokens_rel_pos_ids']])
-			global_max_rel_pos = max(global_max_rel_pos, chunk_max_rel_pos)
+	def merge_shard_metadata(self):
+		"""
+		Reduce step: merges the partial metadata of all shards in save_dir, e.g. written by several hosts.
+		"""
+		return self.merge_metadata(self.load_all_shard_metadata())
+
+	def store_metadata(self, num_ast_node_types, max_ast_depth, max_code_token_rel_pos, metadata_dir=None):
+		# metadata is shared by all splits of a task, i.e. it is stored in the parent directory of the split
+		metadata_dir = os.path.dirname(os.path.normpath(self.save_dir)) if metadata_dir is None else metadata_dir
+		metadata = {
+			'num_ast_node_types': int(num_ast_node_types),
+			'max_ast_depth': int(max_ast_depth),
+			'max_code_token_rel_pos': int(max_code_token_rel_pos),
+		}
+		with open(os.path.join(metadata_dir, 'metadata.json'), 'w') as f:
+			json.dump(metadata, f)
+
+		return metadata
+
+	def compute_sample_lengths(self, chunk_data):
+		"""
+		Returns the structural lengths of each sample of a chunk with its stored columns.
+		'total_len' is the length of the structure-aware sequence, i.e. AST leaves + DFG nodes + code (+ text) tokens.
+		"""
+		num_ast_leaves = list_lengths(chunk_data['lr_paths_len'])
+		lr_paths_len = pc.list_flatten(pa.array(chunk_data['lr_paths_len'])).to_numpy()
+		sample_lengths = {
+			'num_code_tokens': list_lengths(chunk_data['code_tokens']),
+			'num_ast_leaves': num_ast_leaves,
+			'num_dfg_nodes': list_lengths(chunk_data['dfg_node_mask']),
+			# every sample has the paths of <START_AST> and <END_AST>
+			'max_lr_path_len': np.maximum.reduceat(lr_paths_len, np.cumsum(num_ast_leaves) - num_ast_leaves).astype(np.int64),
+		}
+		sample_lengths['total_len'] = sample_lengths['num_code_tokens'] + sample_lengths['num_ast_leaves'] + sample_lengths['num_dfg_nodes']
+		if 'text_tokens' in chunk_data.columns:
+			sample_lengths['total_len'] += list_lengths(chunk_data['text_tokens'])
+
+		return sample_lengths
+
+	def write_manifest(self, metadata):
+		"""
+		Writes manifest.json of the split in save_dir: the shards in reading order with their row counts and checksums,
+		the structural lengths of every sample and the metadata of the task (see store_metadata).
+		Samplers and planners can work from the manifest without reading the shards.
+		"""
+		shards = []
+		for path in self.iter_shard_paths(self.save_dir):
+			checksum = get_file_checksum(path)
+
+			cols = ['code_tokens', 'lr_paths_len', 'dfg_node_mask'] + (['text_tokens'] if 'text_tokens' in pq.read_schema(path).names else [])
+			sample_lengths = self.compute_sample_lengths(pq.read_table(path, columns=cols).to_pandas(types_mapper=pd.ArrowDtype))
+			shards.append({
+				'filename': os.path.basename(path),
+				'num_rows': len(sample_lengths['total_len']),
+				'sha256': checksum,
+				**{key: value.tolist() for key, value in sample_lengths.items()},
+			})
+
+		manifest = {
+			'shard_format_version': SHARD_FORMAT_VERSION,
+			'metadata': metadata,
+			'num_rows': sum(shard['num_rows'] for shard in shards),
+			'shards': shards,
+		}
+		with open(os.path.join(self.save_dir, MANIFEST_FILENAME), 'w') as f:
+			json.dump(manifest, f)
+
+		return manifest
+
+	def write_profile_report(self, path=None):
+		"""
+		Writes the JSON report of all stages profiled so far, by default as profile.json next to the shards.
+		"""
+		if not self.profiler.enabled:
+			return None
 
-			cols = (['code_tokens', 'code_tokens_rel_pos_ids', 'lr_paths_types', 'lr_paths_len', 'll_sims',
-					 'dfg_node_mask',]
-					+ self.attn_mask_builder.get_cols())
-			chunk_data = chunk_data[cols]
+		return self.profiler.write_report(os.path.join(self.save_dir, PROFILE_REPORT_FILENAME) if path is None else path)
 
-			for col in ['code_tokens_rel_pos_ids', 'lr_paths_types'] + self.attn_mask_builder.get_cols():
-				chunk_data[col] = chunk_data[col].apply(str)
+	def load_manifest(self, data_dir):
+		path = os.path.join(data_dir, MANIFEST_FILENAME)
+		if not os.path.exists(path):
+			return None
 
-			chunk_data.to_parquet(os.path.join(self.save_dir, 'from_' + str(start) + '.parquet'), engine='fastparquet', row_group_offsets=100)
+		with open(path, 'r') as f:
+			return json.load(f)
 
-		return all_node_types, global_max_rel_pos
+	def write_shard(self, chunk_data, path, shard_flags=None):
+		"""
+		Writes a shard of the current format version with nested lists as typed Arrow list columns.
+		'shard_flags' are stored as key-value metadata next to the format version, see get_shard_flags.
+		"""
+		columns = {}
+		for col in chunk_data.columns:
+			if isinstance(chunk_data[col].dtype, pd.ArrowDtype):
+				columns[col] = pa.array(chunk_data[col]).cast(SHARD_COL_TYPES.get(col, chunk_data[col].dtype.pyarrow_dtype))
+				continue
+
+			values = chunk_data[col].tolist()
+			if col == 'dfg_edges':
+				# edges read back from a shard are already structs
+				values = [[edge if isinstance(edge, dict) else {'to_node': edge[0], 'from_nodes': edge[1]} for edge in row] for row in values]
+			columns[col] = pa.array(values, type=SHARD_COL_TYPES.get(col, MATRIX_TYPE if col.startswith('attn_') else None))
+
+		table = pa.table(columns).replace_schema_metadata({**(shard_flags or {}), SHARD_FORMAT_VERSION_KEY: str(SHARD_FORMAT_VERSION)})
+		pq.write_table(table, path, compression='zstd', row_group_size=100)
 
-	def parse_list_of_lists(self, s, type_=int):
-		list_of_lists = s[1:-2].split('], ')
-		if type_ == str:
-			list_of_lists = [[t[1:-1].replace('\\n', '\n').replace('\\\\', '\\') for t in x[1:].split(', ')] for x in list_of_lists]
-		elif type_ == int:
-			list_of_lists = [[int(t) for t in x[1:].split(', ')] for x in list_of_lists]
+		# checksums and lengths of the manifest are outdated as soon as a shard changes
+		manifest_path = os.path.join(os.path.dirname(path), MANIFEST_FILENAME)
+		if os.path.exists(manifest_path):
+			os.remove(manifest_path)
+
+		return table
+
+	def read_shard(self, path):
+		table = pq.read_table(path, use_threads=True)
+
+		return table, get_shard_format_version(table)
+
+	def iter_shard_paths(self, data_dir, use_manifest=False):
+		# ordered by start row or, with use_manifest=True, in the order of the manifest if there is one
+		manifest = self.load_manifest(data_dir) if use_manifest else None
+		if manifest is not None:
+			filenames = [shard['filename'] for shard in manifest['shards']]
 		else:
-			raise Exception('Unknown value for type_')
-		return list_of_lists
+			filenames = sorted([filename for filename in os.listdir(data_dir) if filename.startswith('from_')], key=get_shard_start)
+
+		for filename in filenames:
+			yield os.path.join(data_dir, filename)
 
-	def convert_node_types_to_indices(self, all_node_types):
-		all_node_types = sorted(list(all_node_types))
+	def convert_node_types_to_indices(self, all_node_types, sort=True):
+		"""
+		Replaces the node types in 'lr_paths_types' of all shards that were not converted yet by their indices.
+		With sort=False, the order of 'all_node_types' is kept, such that indices of already converted shards stay valid.
+		"""
+		all_node_types = sorted(list(all_node_types)) if sort else list(all_node_types)
 		node_type_to_idx = {t: i for i, t in enumerate(all_node_types)}
 		with open(os.path.join(self.save_dir, 'all_node_types.pkl'), 'wb') as f:
 			pickle.dump(all_node_types, f)
 
 		global_max_ast_depth = -1
-		for filename in tqdm(os.listdir(self.save_dir)):
-			if filename.startswith('from_'):
-				chunk_data = pd.read_parquet(os.path.join(self.save_dir, filename), engine='fastparquet')
-				chunk_data['lr_paths_types'] = chunk_data['lr_paths_types'].apply(lambda lr_path_types: str([[node_type_to_idx[node_type] for node_type in lr_path]
-																											 for lr_path in self.parse_list_of_lists(lr_path_types, type_=str)]))
-				chunk_data.to_parquet(os.path.join(self.save_dir, filename), engine='fastparquet', row_group_offsets=100)
-
-				local_max_ast_depth = chunk_data['lr_paths_types'].apply(lambda x: ast.literal_eval(x)).apply(lambda row: max([len(sublist) for sublist in row])).max()
-				if local_max_ast_depth > global_max_ast_depth: global_max_ast_depth = local_max_ast_depth
+		for path in tqdm(list(self.iter_shard_paths(self.save_dir))):
+			table = self.read_shard(path)[0]
+			lr_paths_types = table['lr_paths_types'].combine_chunks()
+			local_max_ast_depth = pc.max(pc.list_value_length(lr_paths_types.flatten())).as_py()
+			if local_max_ast_depth > global_max_ast_depth: global_max_ast_depth = local_max_ast_depth
+
+			if not pa.types.is_string(lr_paths_types.type.value_type.value_type):
+				continue  # already converted
+
+			with self.profiler.stage('convert_node_types_to_indices', table.num_rows, get_shard_start(path)) as record:
+				chunk_data = table.to_pandas()
+				chunk_data['lr_paths_types'] = chunk_data['lr_paths_types'].apply(lambda lr_path_types: [[node_type_to_idx[node_type] for node_type in lr_path]
+																											 for lr_path in lr_path_types])
+				self.write_shard(chunk_data, path, shard_flags=get_shard_flags(table))
+				if record is not None: record.bytes_written = os.path.getsize(path)
 
 		return global_max_ast_depth
 
 	def upper_triangle(self, ll_sims):
-		rows = ll_sims.split(';')[:-1]
-		ll_sims = ''
-		for i, row in enumerate(rows):
-			ll_sims += ','.join(row.split(',')[i + 1:]) + ';'
-		return ll_sims[:-1]
+		"""
+		Keeps the upper triangles without diagonals of the ll_sims matrices of a list<list<float64>> array,
+		i.e. rows 0, ..., n - 2 of a matrix of n rows without their first i + 1 values. The kept values are gathered
+		from the flat values of the array at once.
+		"""
+		row_offsets = ll_sims.offsets.to_numpy()
+		value_offsets = ll_sims.values.offsets.to_numpy()
+		sizes = np.diff(row_offsets)
+		idxs = [value_offsets[row_offset] + get_upper_triangle_idxs(size) for row_offset, size in zip(row_offsets[:-1], sizes)]
+		row_lens = [np.arange(size - 1, 0, -1) for size in sizes]
+		values = ll_sims.values.values.to_numpy()[np.concatenate([np.zeros(0, dtype=np.int64)] + idxs)]
+
+		return list_array(np.concatenate([[0], np.cumsum(np.maximum(sizes - 1, 0))]),
+						  list_array(np.concatenate([[0], np.cumsum(np.concatenate([np.zeros(0, dtype=np.int64)] + row_lens))]),
+									 pa.array(values, type=pa.float64())))
 
 	def reduce_ll_sims(self):
 		# Reduce memory taken by ll_sims column by storing only upper triangles w/o diagonals
-		pbar = tqdm(os.listdir(self.save_dir))
-		for filename in pbar:
-			pbar.set_description(filename)
-			if filename.startswith('from_'):
-				chunk_data = pd.read_parquet(os.path.join(self.save_dir, filename), engine='fastparquet')
-				chunk_data['ll_sims'] = chunk_data['ll_sims'].apply(self.upper_triangle)
-				chunk_data.to_parquet(os.path.join(self.save_dir, filename), engine='fastparquet', row_group_offsets=100)
+		pbar = tqdm(list(self.iter_shard_paths(self.save_dir)))
+		for path in pbar:
+			pbar.set_description(os.path.basename(path))
+			table = self.read_shard(path)[0]
+			shard_flags = get_shard_flags(table)
+			if shard_flags.get(LL_SIMS_REDUCED_FLAG) == '1':
+				continue
+
+			with self.profiler.stage('reduce_ll_sims', table.num_rows, get_shard_start(path)) as record:
+				chunk_data = table.drop_columns(['ll_sims']).to_pandas()
+				ll_sims = pa.chunked_array([self.upper_triangle(chunk) for chunk in table['ll_sims'].chunks], type=LL_SIMS_TYPE)
+				chunk_data.insert(table.column_names.index('ll_sims'), 'll_sims', to_arrow_series(ll_sims, chunk_data.index))
+				self.write_shard(chunk_data, path, shard_flags={**shard_flags, LL_SIMS_REDUCED_FLAG: '1'})
+				if record is not None: record.bytes_written = os.path.getsize(path)
+
+	def compute_sample_keys(self, data):
+		"""
+		Keys each sample by a hash of its cleaned code and text, the tokenizer, the attention mask builder, the pipeline version
+		and the length budget.
+		"""
+		prefix = '\0'.join([self.get_tokenizer_key(), type(self.attn_mask_builder).__name__, str(PIPELINE_VERSION)]
+							+ ([self.length_budget.get_key()] if self.length_budget is not None else []))
+
+		return pd.Series([hashlib.sha256('\0'.join([prefix, text, code]).encode('utf-8')).hexdigest()
+						  for text, code in zip(data['text'], data['code'])], index=data.index, dtype=object)
+
+	def get_stored_sample_keys(self):
+		# returns the sample keys of all shards in save_dir and the start of the next shard to append
+		sample_keys = set()
+		next_start = 0
+		for path in self.iter_shard_paths(self.save_dir):
+			if 'sample_key' not in pq.read_schema(path).names:
+				raise Exception('Shard ' + path + ' has no sample keys, incremental preprocessing requires a full rebuild')
+
+			shard_sample_keys = pq.read_table(path, columns=['sample_key'])['sample_key'].to_pylist()
+			sample_keys.update(shard_sample_keys)
+			start = get_shard_start(path)
+			next_start = max(next_start, start + len(shard_sample_keys))
+
+		return sample_keys, next_start
+
+	def remove_stale_samples(self, sample_keys):
+		# removes all samples from the shards whose key is not in 'sample_keys'
+		for path in list(self.iter_shard_paths(self.save_dir)):
+			table = self.read_shard(path)[0]
+			is_current = pc.is_in(table['sample_key'], value_set=pa.array(list(sample_keys), type=pa.string()))
+			if pc.all(is_current).as_py():
+				continue
+
+			self.write_shard(table.filter(is_current).to_pandas(), path, shard_flags=get_shard_flags(table))
+
+	def load_node_types(self):
+		path = os.path.join(self.save_dir, 'all_node_types.pkl')
+		if not os.path.exists(path):
+			return []
+
+		with open(path, 'rb') as f:
+			return pickle.load(f)
+
+	def store_incremental_data(self, data, num_rows_per_file, drop_stale=False):
+		"""
+		Featurizes only the samples of 'data' whose key is not in the shards of save_dir yet and appends them as new shards.
+		Node types of existing shards keep their indices, new node types are appended.
+		With drop_stale=True, stored samples whose key is not in 'data' anymore are removed.
+		With a deduplicator, duplicates within 'data' are dropped first, i.e. they count as not in 'data'.
+		Returns all node types, the global max relative position and the global max AST depth.
+		"""
+		os.makedirs(self.save_dir, exist_ok=True)
+		for path in self.iter_shard_paths(self.save_dir):
+			if get_shard_format_version(pq.read_schema(path)) != SHARD_FORMAT_VERSION:
+				raise Exception('Shard ' + path + ' has an outdated format version, incremental preprocessing requires a full rebuild')
+
+		data = self.deduplicate(data, reset=True).copy()
+		data['sample_key'] = self.compute_sample_keys(data)
+
+		if drop_stale:
+			self.remove_stale_samples(set(data['sample_key']))
+		stored_sample_keys, next_start = self.get_stored_sample_keys()
+		data = data[~data['sample_key'].isin(stored_sample_keys)].drop_duplicates('sample_key')
+
+		for start in range(0, len(data), num_rows_per_file):
+			chunk_data = data.iloc[start:start + num_rows_per_file].copy()  # copy so that edits are not on data
+			self.process_chunk(chunk_data, next_start + start)
+
+		all_node_types = self.load_node_types()
+		node_types, global_max_rel_pos, global_max_ast_depth = self.merge_shard_metadata()
+		all_node_types = all_node_types + sorted(set(node_types) - set(all_node_types))
+		self.convert_node_types_to_indices(all_node_types, sort=False)
+		self.reduce_ll_sims()
+
+		return all_node_types, global_max_rel_pos, global_max_ast_depth
 
 	def get_concat_stored_data(self, split='train'):
+		"""
+		Reads all shards of a split. The format version of the shards is stored in data.attrs['shard_format_version'].
+		For shards of version 2, nested list columns are decoded into NumPy arrays (2D for matrices),
+		for legacy shards of version 1, they remain str()-serialized.
+		"""
 		data = []
-		data_dir = os.path.join(self.save_dir, split)
-		for filename in tqdm(os.listdir(data_dir)):
-			if filename.startswith('from_'):
-				chunk_data = pd.read_parquet(os.path.join(data_dir, filename), engine='fastparquet')
+		shard_format_versions = set()
+		for path in tqdm(list(self.iter_shard_paths(os.path.join(self.save_dir, split), use_manifest=True))):
+			with self.profiler.stage('read_shard', chunk_start=get_shard_start(path)) as record:
+				table, shard_format_version = self.read_shard(path)
+				if record is not None: record.num_rows = table.num_rows
+				shard_format_versions.add(shard_format_version)
+				if shard_format_version == 1:
+					data.append(table.to_pandas())
+					continue
+
+				matrix_cols = [field.name for field in table.schema if field.type == MATRIX_TYPE]
+				chunk_data = table.drop_columns(matrix_cols).to_pandas()
+				for col in matrix_cols:
+					chunk_data[col] = pd.Series(decode_matrix_column(table[col]), index=chunk_data.index, dtype=object)
+				chunk_data['dfg_edges'] = chunk_data['dfg_edges'].apply(lambda row: [(edge['to_node'], edge['from_nodes']) for edge in row])
 				data.append(chunk_data)
 
-		return pd.concat(data)
+		if len(shard_format_versions) > 1:
+			raise Exception('Shards of split=' + split + ' have mixed format versions ' + str(sorted(shard_format_versions)))
 
-	def compute_relative_distances(self, pos_ids_str, max_distance=127):
-		pos_ids = list(map(int, pos_ids_str.split(',')))
-		distances = []
-		for i in range(len(pos_ids)):
-			row = []
-			for j in range(len(pos_ids)):
-				# account for padding distance id of 0 that is added when padded in collating a batch
-				# thus, 0 should not be assigned as a relative distance
-				raw_distance = abs(pos_ids[i] - pos_ids[j]) + 1
-				distance = min(raw_distance, max_distance)
-				row.append(distance)
+		data = pd.concat(data)
+		data.attrs['shard_format_version'] = shard_format_versions.pop()
 
-			distances.append(row)
+		return data
 
-		return distances
+	def compute_max_relative_distance(self, num_tokens, max_distance=MAX_REL_POS):
+		# distance between the first and the last token, see get_rel_pos_ids in structure_aware_self_attention
+		return np.minimum(num_tokens, max_distance)
 
 	def add_special_tokens(self, data):
-		data['code_tokens'] = data['code_tokens'].apply(lambda x: str(self.tokenizer.bos_token_id) + ',' + x + ',' + str(self.tokenizer.eos_token_id))
-		data['code_tokens_pos_ids'] = data['code_tokens'].apply(lambda x: ','.join(map(str, range(len(x.split(','))))))
-
-		data['text_tokens'] = data['text_tokens'].apply(lambda x: str(self.tokenizer.bos_token_id) + ',' + x + ',' + str(self.tokenizer.eos_token_id))
-		data['text_tokens_pos_ids'] = data['text_tokens'].apply(lambda x: ','.join(map(str, range(len(x.split(','))))))
+		for col in ['code_tokens', 'text_tokens']:
+			data[col] = to_arrow_series(wrap_list_array(pa.array(data[col]), self.tokenizer.bos_token_id, self.tokenizer.eos_token_id), data.index)
 
 		# account for BOS token
-		data['ast_leaf_code_token_idxs'] = data['ast_leaf_code_token_idxs'].apply(lambda x: [[x + 1 for x in sublist] for sublist in x])
-		data['dfg_node_code_token_idxs'] = data['dfg_node_code_token_idxs'].apply(lambda x: [[x + 1 for x in sublist] for sublist in x])
+		data['ast_leaf_code_token_idxs'] = to_arrow_series(shift_list_array(pa.array(data['ast_leaf_code_token_idxs']), 1), data.index)
+		data['dfg_node_code_token_idxs'] = to_arrow_series(shift_list_array(pa.array(data['dfg_node_code_token_idxs']), 1), data.index)
 
 		# account for padding of BOS and EOS tokens for DFG sequence
-		data['dfg_edges'] = data['dfg_edges'].apply(lambda row: [(x + 1, [y + 1 for y in ys]) for x, ys in row])
+		data['dfg_edges'] = to_arrow_series(shift_list_array(pa.array(data['dfg_edges']), 1), data.index)
+
+
+class StrippedCodeWriter:
+	"""
+	Output of DataHandler.remove_comments_and_docstrings, written piece by piece while tokenizing.
+	Blank rows are dropped and all text between pairs of docstring quotes is cut out as the rows are completed.
+	A docstring that is still open at the end is kept.
+	"""
+
+	def __init__(self):
+		self.out = []
+		self.row = []
+		self.has_rows = False
+		self.docstring = None  # pieces since the opening quotes of an open docstring
+
+	def write(self, text):
+		if '\n' not in text:
+			self.row.append(text)
+			return
+
+		rows = text.split('\n')
+		for row in rows[:-1]:
+			self.row.append(row)
+			self.end_row()
+		self.row.append(rows[-1])
+
+	def end_row(self):
+		row = ''.join(self.row)
+		self.row = []
+		if row.strip() == "":
+			return
+
+		self.cut_docstrings('\n' + row if self.has_rows else row)
+		self.has_rows = True
+
+	def cut_docstrings(self, text):
+		# docstring quotes never span rows, as rows are separated by a newline
+		pos = 0
+		while True:
+			if self.docstring is None:
+				start = text.find(DOCSTRING_QUOTES, pos)
+				if start == -1:
+					self.out.append(text[pos:])
+					return
+				self.out.append(text[pos:start])
+				self.docstring = [DOCSTRING_QUOTES]
+				pos = start + len(DOCSTRING_QUOTES)
+			else:
+				end = text.find(DOCSTRING_QUOTES, pos)
+				if end == -1:
+					self.docstring.append(text[pos:])
+					return
+				self.docstring = None
+				pos = end + len(DOCSTRING_QUOTES)
+
+	def getvalue(self):
+		self.end_row()
+		if self.docstring is not None:
+			self.out.extend(self.docstring)
+			self.docstring = None
+
+		return ''.join(self.out)
+
+
+def _process_chunk_in_worker(start):
+	data_handler, data, num_rows_per_file = _worker_state
+	data_handler.profiler.pop_records()  # drops the records inherited from the parent process
+	chunk_data = data.iloc[start:start + num_rows_per_file].copy()  # copy so that edits are not on data
+	shard_metadata = data_handler.process_chunk(chunk_data, start)
+
+	# stage records of the worker are merged into the profiler of the parent process
+	return shard_metadata, data_handler.profiler.pop_records()
+
+
+def flatten_lists(rows):
+	# CSR representation (offsets, values) of a sequence of integer lists
+	lengths = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+	offsets = np.concatenate([[0], np.cumsum(lengths)])
+	values = np.fromiter((value for row in rows for value in row), dtype=np.int64, count=offsets[-1])
+
+	return offsets, values
+
+
+def flatten_nested_lists(rows):
+	# CSR representation (row offsets, offsets, values) of a sequence of lists of integer lists
+	row_offsets = np.concatenate([[0], np.cumsum(np.fromiter(map(len, rows), dtype=np.int64, count=len(rows)))])
+	offsets, values = flatten_lists([inner for row in rows for inner in row])
+
+	return row_offsets, offsets, values
+
+
+def gather_ranges(values, starts, ends):
+	# concatenates values[starts[i]:ends[i]] for all i, returns the offsets of the ranges in the result and the result
+	lengths = ends - starts
+	offsets = np.concatenate([[0], np.cumsum(lengths)])
+	idxs = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+
+	return offsets, values[idxs]
+
+
+def shift_list_array(array, shift):
+	# adds 'shift' to all integers of an arbitrarily nested list/struct array without leaving Arrow
+	if isinstance(array, pa.ChunkedArray):
+		array = array.combine_chunks()
+	if pa.types.is_list(array.type):
+		return list_array(array.offsets, shift_list_array(array.values, shift))
+	if pa.types.is_struct(array.type):
+		return pa.StructArray.from_arrays([shift_list_array(field, shift) for field in array.flatten()],
+										  names=[field.name for field in array.type])
+
+	return pc.add(array, shift)
+
+
+def wrap_list_array(array, first, last):
+	# prepends 'first' and appends 'last' to every list of a list array
+	if isinstance(array, pa.ChunkedArray):
+		array = array.combine_chunks()
+	offsets = array.offsets.to_numpy()
+	values = array.values.to_numpy()
+	wrapped_offsets = offsets - offsets[0] + 2 * np.arange(len(offsets))
+	wrapped_values = np.empty(wrapped_offsets[-1], dtype=values.dtype)
+	is_inner = np.ones(len(wrapped_values), dtype=bool)
+	is_inner[wrapped_offsets[:-1]] = False
+	is_inner[wrapped_offsets[1:] - 1] = False
+	wrapped_values[is_inner] = values[offsets[0]:offsets[-1]]
+	wrapped_values[wrapped_offsets[:-1]] = first
+	wrapped_values[wrapped_offsets[1:] - 1] = last
+
+	return list_array(wrapped_offsets, pa.array(wrapped_values, type=array.type.value_type))
+
+
+def matrix_list_array(matrices):
+	# list<list<float64>> array of 2D NumPy arrays with MATRICES_PER_CHUNK matrices per chunk
+	chunks = []
+	for start in range(0, len(matrices), MATRICES_PER_CHUNK):
+		chunk = matrices[start:start + MATRICES_PER_CHUNK]
+		num_rows = np.array([matrix.shape[0] for matrix in chunk], dtype=np.int64)
+		row_lens = np.concatenate([np.full(matrix.shape[0], matrix.shape[1], dtype=np.int64) for matrix in chunk])
+		values = np.concatenate([matrix.ravel() for matrix in chunk]).astype(np.float64)
+		chunks.append(list_array(np.concatenate([[0], np.cumsum(num_rows)]),
+								 list_array(np.concatenate([[0], np.cumsum(row_lens)]), pa.array(values, type=pa.float64()))))
+
+	return pa.chunked_array(chunks, type=LL_SIMS_TYPE)
+
+
+def get_upper_triangle_idxs(size):
+	# flat indices of the upper triangle without the diagonal of a matrix of size x size in row-major order
+	rows, cols = np.triu_indices(size, k=1)
+
+	return rows * size + cols
+
+
+def list_lengths(column):
+	# number of elements per row of a list column
+	return pc.list_value_length(pa.array(column)).to_numpy().astype(np.int64)
+
+
+def list_array(offsets, values):
+	return pa.ListArray.from_arrays(pa.array(offsets, type=pa.int32()), values)
+
+
+def to_arrow_series(array, index):
+	return pd.Series(pd.arrays.ArrowExtensionArray(array), index=index)
+
+
+def get_shard_format_version(table):
+	# 'table' can also be the schema of a shard
+	metadata = getattr(table, 'schema', table).metadata or {}
+
+	return int(metadata.get(SHARD_FORMAT_VERSION_KEY.encode(), b'1'))
+
+
+def get_file_checksum(path):
+	# SHA-256 of the file, read in blocks so that memory stays bounded
+	checksum = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			checksum.update(block)
+
+	return checksum.hexdigest()
+
+
+def get_shard_start(path):
+	return int(os.path.basename(path)[len('from_'):-len('.parquet')])
+
+
+def get_shard_flags(table):
+	metadata = table.schema.metadata or {}
+
+	return {key.decode(): value.decode() for key, value in metadata.items() if key.decode() != SHARD_FORMAT_VERSION_KEY}
+
+
+def decode_matrix_column(column):
+	"""
+	Decodes a list<list<float>> column into 2D NumPy arrays via the offsets of the Arrow list arrays, i.e. without copies.
+	"""
+	matrices = []
+	for chunk in column.chunks:
+		row_offsets = chunk.offsets.to_numpy()
+		inner_lists = chunk.values
+		value_offsets = inner_lists.offsets.to_numpy()
+		values = inner_lists.values.to_numpy(zero_copy_only=False)
+		for i in range(len(chunk)):
+			num_rows = row_offsets[i + 1] - row_offsets[i]
+			flat = values[value_offsets[row_offsets[i]]:value_offsets[row_offsets[i + 1]]]
+			matrices.append(flat.reshape(num_rows, -1) if num_rows > 0 else flat.reshape(0, 0))
+
+	return matrices
@@ -0,0 +1,171 @@
+import re
+import zlib
+import hashlib
+import sqlite3
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+CODE_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def normalize_code(code):
+	# whitespace-insensitive form of the code, comments and docstrings are already removed by preprocess
+	return ' '.join(code.split())
+
+
+def get_shingle_hashes(code, shingle_size):
+	tokens = CODE_TOKEN_PATTERN.findall(code)
+	shingles = [' '.join(tokens[i:i + shingle_size]) for i in range(max(len(tokens) - shingle_size + 1, 1))]
+
+	return np.array([zlib.crc32(shingle.encode('utf-8')) for shingle in shingles], dtype=np.uint64)
+
+
+def compute_minhash_signatures(codes, num_perm, shingle_size, seed):
+	"""
+	MinHash signatures of the token shingles of 'codes' with 'num_perm' universal hash functions (a * x + b) mod p.
+	"""
+	rng = np.random.default_rng(seed)
+	# a < 2^31 and x < 2^32, such that a * x + b does not overflow
+	a = rng.integers(1, 1 << 31, size=num_perm, dtype=np.uint64)
+	b = rng.integers(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+	signatures = np.empty((len(codes), num_perm), dtype=np.uint32)
+	for i, code in enumerate(codes):
+		shingle_hashes = get_shingle_hashes(code, shingle_size)
+		signatures[i] = (((a[:, None] * shingle_hashes[None, :] + b[:, None]) % MERSENNE_PRIME) & MAX_HASH).min(axis=1)
+
+	return signatures
+
+
+def get_lsh_bands(num_perm, threshold):
+	# number of bands b and rows per band r with b * r = num_perm, such that the LSH threshold (1/b)^(1/r) is closest to 'threshold'
+	candidates = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+
+	return min(candidates, key=lambda bands_rows: abs((1 / bands_rows[0]) ** (1 / bands_rows[1]) - threshold))
+
+
+class Deduplicator:
+	"""
+	Removes exact duplicates (same normalized code) and, with near_dup_threshold set, near duplicates,
+	i.e. functions whose estimated Jaccard similarity of token shingles to an already kept function is at least the threshold.
+	Near duplicates are found via MinHash and LSH. The first occurrence is kept.
+	The state is kept across calls of filter until reset, such that a dataset can be deduplicated batch by batch.
+	It lives in a private temporary SQLite database, which is spilled to disk beyond 'cache_size_kib': 16-byte digests
+	of the kept codes, one fixed-width 8-byte key per LSH band and kept row, and the signatures of the kept rows
+	to verify LSH candidates. Memory thus stays bounded however many rows are seen.
+	With num_workers > 1, signatures are computed in a pool of forked processes, which is started on first use and
+	kept across calls of filter and reset until close.
+	"""
+
+	def __init__(self, near_dup_threshold=None, num_perm=64, shingle_size=5, num_workers=1, seed=0, cache_size_kib=64 * 1024):
+		self.near_dup_threshold = near_dup_threshold
+		self.num_perm = num_perm
+		self.shingle_size = shingle_size
+		self.num_workers = num_workers
+		self.seed = seed
+		self.cache_size_kib = cache_size_kib
+
+		self.num_bands, self.rows_per_band = get_lsh_bands(num_perm, near_dup_threshold) if near_dup_threshold is not None else (0, 0)
+		# band keys are a polynomial hash of the band values, salted per band, such that equal values in different bands differ
+		rng = np.random.default_rng([seed, num_perm])
+		self.band_multipliers = rng.integers(1, 1 << 63, size=self.rows_per_band, dtype=np.uint64) | np.uint64(1)
+		self.band_salts = rng.integers(0, 1 << 63, size=self.num_bands, dtype=np.uint64)
+		self.db = None
+		self.executor = None
+		self.reset()
+
+	def reset(self):
+		# forgets all rows seen so far
+		if self.db is not None:
+			self.db.close()
+		# an empty filename is a private on-disk database that is deleted when it is closed
+		self.db = sqlite3.connect('')
+		self.db.execute('PRAGMA cache_size = -' + str(int(self.cache_size_kib)))
+		self.db.execute('CREATE TABLE code_hashes (code_hash BLOB PRIMARY KEY) WITHOUT ROWID')
+		self.db.execute('CREATE TABLE lsh_buckets (band_key INTEGER, row_id INTEGER, PRIMARY KEY (band_key, row_id)) WITHOUT ROWID')
+		self.db.execute('CREATE TABLE signatures (row_id INTEGER PRIMARY KEY, signature BLOB)')
+		self.num_signatures = 0
+		self.stats = {'num_rows': 0, 'num_exact_duplicates': 0, 'num_near_duplicates': 0}
+
+	def close(self):
+		if self.db is not None:
+			self.db.close()
+			self.db = None
+		if self.executor is not None:
+			self.executor.shutdown()
+			self.executor = None
+
+	def get_executor(self):
+		if self.executor is None:
+			self.executor = ProcessPoolExecutor(max_workers=self.num_workers, mp_context=multiprocessing.get_context('fork'))
+
+		return self.executor
+
+	def compute_signatures(self, codes):
+		if self.num_workers <= 1 or len(codes) < 2 * self.num_workers:
+			return compute_minhash_signatures(codes, self.num_perm, self.shingle_size, self.seed)
+
+		chunk_size = (len(codes) + self.num_workers - 1) // self.num_workers
+		chunks = [codes[i:i + chunk_size] for i in range(0, len(codes), chunk_size)]
+		signatures = list(self.get_executor().map(compute_minhash_signatures, chunks, [self.num_perm] * len(chunks),
+												  [self.shingle_size] * len(chunks), [self.seed] * len(chunks)))
+
+		return np.concatenate(signatures)
+
+	def get_band_keys(self, signature):
+		bands = signature.reshape(self.num_bands, self.rows_per_band).astype(np.uint64)
+		keys = (bands * self.band_multipliers).sum(axis=1, dtype=np.uint64) ^ self.band_salts
+
+		return keys.view(np.int64).tolist()  # SQLite integers are signed
+
+	def is_near_duplicate(self, band_keys, signature):
+		candidates = self.db.execute('SELECT signature FROM signatures WHERE row_id IN (SELECT row_id FROM lsh_buckets WHERE band_key IN ('
+									 + ','.join('?' * len(band_keys)) + '))', band_keys)
+
+		return any(np.mean(np.frombuffer(candidate, dtype=np.uint32) == signature) >= self.near_dup_threshold for candidate, in candidates)
+
+	def add_to_lsh(self, band_keys, signature):
+		row_id = self.num_signatures
+		self.num_signatures += 1
+		self.db.execute('INSERT INTO signatures VALUES (?, ?)', (row_id, signature.astype(np.uint32).tobytes()))
+		self.db.executemany('INSERT OR IGNORE INTO lsh_buckets VALUES (?, ?)', [(band_key, row_id) for band_key in band_keys])
+
+	def filter(self, data):
+		"""
+		Returns the rows of 'data' (with column 'code') that are neither duplicates of each other nor of rows of previous calls.
+		"""
+		normalized_codes = [normalize_code(code) for code in data['code']]
+		keep = np.zeros(len(data), dtype=bool)
+		for i, code in enumerate(normalized_codes):
+			code_hash = hashlib.blake2b(code.encode('utf-8'), digest_size=16).digest()
+			if self.db.execute('INSERT OR IGNORE INTO code_hashes VALUES (?)', (code_hash,)).rowcount == 0:
+				self.stats['num_exact_duplicates'] += 1
+				continue
+			keep[i] = True
+
+		if self.near_dup_threshold is not None:
+			# signatures are computed in parallel, LSH lookups are sequential to keep the first occurrence
+			signatures = self.compute_signatures([normalized_codes[i] for i in np.flatnonzero(keep)])
+			for i, signature in zip(np.flatnonzero(keep), signatures):
+				band_keys = self.get_band_keys(signature)
+				if self.is_near_duplicate(band_keys, signature):
+					self.stats['num_near_duplicates'] += 1
+					keep[i] = False
+				else:
+					self.add_to_lsh(band_keys, signature)
+
+		self.db.commit()
+		self.stats['num_rows'] += len(data)
+
+		return data[keep].reset_index(drop=True)
+
+	def get_summary(self):
+		num_dropped = self.stats['num_exact_duplicates'] + self.stats['num_near_duplicates']
+
+		return ('Deduplication dropped ' + str(num_dropped) + ' of ' + str(self.stats['num_rows']) + ' rows ('
+				+ str(self.stats['num_exact_duplicates']) + ' exact, ' + str(self.stats['num_near_duplicates']) + ' near duplicates)')
@@ -0,0 +1,412 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import shutil
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from data_handler import get_shard_format_version, LENGTH_DERIVED_COLS
+
+
+FLAT_STORE_DIRNAME = 'flat'
+INDEX_FILENAME = 'index.json'
+CURRENT_FILENAME = 'CURRENT'
+LOCK_SUFFIX = '.lock'
+
+# part of the fingerprint of a store, must be increased whenever a change of the decoding changes the stored buffers
+FLAT_STORE_VERSION = 4
+
+# kind and value type of the fields, all 'attn_' columns are float32 matrices
+FLAT_FIELDS = {
+	'code_tokens': ('list', np.int32),
+	'text_tokens': ('list', np.int32),
+	'lr_paths_len': ('list', np.int32),
+	'dfg_node_mask': ('list', np.int8),
+	'lr_paths_types': ('nested', np.int32),
+	'll_sims': ('nested', np.float32),
+	'ast_leaf_code_token_idxs': ('nested', np.int32),
+	'dfg_node_code_token_idxs': ('nested', np.int32),
+	'dfg_edges': ('edges', np.int32),
+}
+
+
+def get_field_kind(field):
+	if field in LENGTH_DERIVED_COLS:
+		return None, None  # columns of older shards that are built at collate time
+	if field.startswith('attn_'):
+		return 'matrix', np.float32
+
+	return FLAT_FIELDS.get(field, (None, None))
+
+
+def list_components(array):
+	# offsets starting at 0 and flattened values of a list array, also if it is sliced
+	lengths = pc.list_value_length(array).to_numpy(zero_copy_only=False).astype(np.int64)
+
+	return np.concatenate([[0], np.cumsum(lengths)]), pc.list_flatten(array)
+
+
+def to_numpy(values, dtype):
+	# values of shards before format version 3 and ll_sims of shards before format version 5 are strings
+	value_type = pa.float64() if np.issubdtype(dtype, np.floating) else pa.int64()
+
+	return pc.cast(values, value_type).to_numpy(zero_copy_only=False).astype(dtype)
+
+
+def get_buffers(column, kind, dtype):
+	"""
+	Returns the flat buffers of a shard column: offsets into the values for lists, additionally row offsets into the
+	inner lists for nested lists and edges, and the shape of each sample for matrices.
+	"""
+	is_string = pa.types.is_string(column.type) or pa.types.is_large_string(column.type)
+	if kind == 'list':
+		offsets, values = list_components(pc.split_pattern(column, ',') if is_string else column)
+		return {'offsets': offsets, 'values': to_numpy(values, dtype)}
+
+	if kind == 'nested':
+		row_offsets, rows = list_components(pc.split_pattern(column, ';') if is_string else column)
+		offsets, values = list_components(pc.split_pattern(rows, ',') if is_string else rows)
+		return {'row_offsets': row_offsets, 'offsets': offsets, 'values': to_numpy(values, dtype)}
+
+	if kind == 'edges':
+		row_offsets, edges = list_components(column)
+		edge_fields = dict(zip([field.name for field in edges.type], edges.flatten()))
+		offsets, from_nodes = list_components(edge_fields['from_nodes'])
+		return {'row_offsets': row_offsets, 'to_nodes': to_numpy(edge_fields['to_node'], dtype),
+				'offsets': offsets, 'values': to_numpy(from_nodes, dtype)}
+
+	row_offsets, rows = list_components(column)
+	inner_offsets, values = list_components(rows)
+	num_rows = np.diff(row_offsets)
+	num_cols = np.zeros(len(num_rows), dtype=np.int64)
+	num_cols[num_rows > 0] = np.diff(inner_offsets)[row_offsets[:-1][num_rows > 0]]
+
+	return {'shapes': np.stack([num_rows, num_cols], axis=1).ravel(), 'offsets': np.concatenate([[0], np.cumsum(num_rows * num_cols)]),
+			'values': to_numpy(values, dtype)}
+
+
+def get_range_idxs(starts, ends):
+	# offsets of the ranges [starts[i], ends[i]) in their concatenation and the concatenated indices
+	lengths = ends - starts
+	offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+	return offsets, np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+
+
+def pad_nested_lists(sample_offsets, offsets, values, padding_value, padding_side='right'):
+	"""
+	Pads the inner lists of each sample to the longest inner list of the sample, such that each sample becomes a matrix.
+	Returns the shapes of the matrices, their offsets in the padded values and the padded values.
+	"""
+	lengths = np.diff(offsets)
+	num_rows = np.diff(sample_offsets)
+	row_samples = np.repeat(np.arange(len(num_rows)), num_rows)
+	max_lens = np.zeros(len(num_rows), dtype=np.int64)
+	np.maximum.at(max_lens, row_samples, lengths)
+	matrix_offsets = np.concatenate([[0], np.cumsum(num_rows * max_lens)])
+
+	padded = np.full(matrix_offsets[-1], padding_value, dtype=values.dtype)
+	row_starts = matrix_offsets[row_samples] + (np.arange(len(lengths)) - sample_offsets[row_samples]) * max_lens[row_samples]
+	if padding_side == 'left':
+		row_starts += max_lens[row_samples] - lengths
+	padded[np.repeat(row_starts - offsets[:-1], lengths) + np.arange(len(values))] = values
+
+	return np.stack([num_rows, max_lens], axis=1), matrix_offsets, padded
+
+
+def compute_fingerprint(shard_paths, checksums=None, padded_fields=None):
+	"""
+	Fingerprint of the shards (names and contents), the decoding parameters and FLAT_STORE_VERSION.
+	'checksums' maps shard filenames to their SHA-256, e.g. from the manifest, other shards are identified by their
+	size and modification time, such that startup does not read every shard.
+	"""
+	checksums = checksums or {}
+	fingerprint = hashlib.sha256(json.dumps([FLAT_STORE_VERSION, padded_fields or {}], sort_keys=True).encode('utf-8'))
+	for path in shard_paths:
+		filename = os.path.basename(path)
+		if checksums.get(filename):
+			identity = checksums[filename]
+		else:
+			stat = os.stat(path)
+			identity = str(stat.st_size) + ':' + str(stat.st_mtime_ns)
+		fingerprint.update((filename + '\0' + identity + '\0').encode('utf-8'))
+
+	return fingerprint.hexdigest()
+
+
+def get_local_rank():
+	# rank of the process on its node, set by torchrun and Lightning, respectively by SLURM for srun
+	return int(os.environ.get('LOCAL_RANK', os.environ.get('SLURM_LOCALID', 0)))
+
+
+def lock_file(path, shared=False, blocking=True, create=False):
+	"""
+	Opens 'path' and takes a shared or exclusive flock on it, the lock is held until the returned file is closed.
+	Returns None if blocking=False and the lock is held by another process.
+	"""
+	f = open(path, 'a+' if create else 'r')
+	try:
+		fcntl.flock(f, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+	except BlockingIOError:
+		f.close()
+		return None
+
+	return f
+
+
+def build_flat_array_store(shard_paths, build_dir, fingerprint, padded_fields=None):
+	"""
+	Converts the shards of a split into one flat binary buffer per field and component in 'build_dir', see FlatArrayStore.
+	'padded_fields' maps nested list fields to (padding_value, padding_side), such fields are stored as padded matrices.
+	Shards are converted one at a time, such that memory stays bounded by the largest shard.
+	"""
+	padded_fields = padded_fields or {}
+	os.makedirs(build_dir)
+
+	fields = None
+	buffers = {}
+	files = {}
+	shard_num_rows = []
+	for path in shard_paths:
+		table = pq.read_table(path)
+		if get_shard_format_version(table) < 2:
+			raise Exception('Shard ' + path + ' has format version 1, which is not supported by the flat array store')
+
+		if fields is None:
+			fields = {name: get_field_kind(name)[0] for name in table.column_names if get_field_kind(name)[0] is not None}
+		for field, kind in fields.items():
+			field_buffers = get_buffers(table[field].combine_chunks(), kind, get_field_kind(field)[1])
+			if field in padded_fields:
+				shapes, offsets, values = pad_nested_lists(field_buffers['row_offsets'], field_buffers['offsets'], field_buffers['values'],
+														   *padded_fields[field])
+				field_buffers = {'shapes': shapes.ravel(), 'offsets': offsets, 'values': values}
+			for component, values in field_buffers.items():
+				name = field + '.' + component
+				if name not in files:
+					files[name] = open(os.path.join(build_dir, name), 'wb')
+					buffers[name] = {'dtype': values.dtype.str, 'length': 0}
+					if component.endswith('offsets'):
+						# the leading 0 is written once, offsets of later shards continue from the last offset
+						values[:1].tofile(files[name])
+						buffers[name].update({'length': 1, 'last': 0})
+				if component.endswith('offsets'):
+					values = values[1:] + buffers[name]['last']
+					buffers[name]['last'] = int(values[-1]) if len(values) > 0 else buffers[name]['last']
+				values.tofile(files[name])
+				buffers[name]['length'] += len(values)
+		shard_num_rows.append(table.num_rows)
+
+	for f in files.values():
+		f.close()
+
+	index = {
+		'fingerprint': fingerprint,
+		'num_rows': sum(shard_num_rows),
+		'shards': [os.path.basename(path) for path in shard_paths],
+		'shard_num_rows': shard_num_rows,
+		'fields': {field: 'matrix' if field in padded_fields else kind for field, kind in (fields or {}).items()},
+		'buffers': {name: {'dtype': info['dtype'], 'length': info['length']} for name, info in buffers.items()},
+	}
+	# written last, a build directory without an index is an aborted build
+	with open(os.path.join(build_dir, INDEX_FILENAME), 'w') as f:
+		json.dump(index, f)
+
+
+def get_current_build_dir(store_dir):
+	try:
+		with open(os.path.join(store_dir, CURRENT_FILENAME), 'r') as f:
+			return os.path.join(store_dir, f.read().strip())
+	except FileNotFoundError:
+		return None
+
+
+def set_current_build_dir(store_dir, build_dir):
+	# atomic, such that readers see either the former or the new build
+	tmp_path = os.path.join(store_dir, CURRENT_FILENAME + '.tmp')
+	with open(tmp_path, 'w') as f:
+		f.write(os.path.basename(build_dir))
+	os.replace(tmp_path, os.path.join(store_dir, CURRENT_FILENAME))
+
+
+def open_flat_array_store(store_dir, fingerprint):
+	# the current build of the store if it matches 'fingerprint', otherwise None
+	while True:
+		build_dir = get_current_build_dir(store_dir)
+		if build_dir is None:
+			return None
+		try:
+			store = FlatArrayStore(build_dir)
+		except FileNotFoundError:
+			# the build has been replaced and removed between reading CURRENT and locking it
+			continue
+		if store.index.get('fingerprint') == fingerprint:
+			return store
+		store.close()
+
+		return None
+
+
+def remove_unused_builds(store_dir):
+	"""
+	Removes the builds of the store other than the current one that no process has opened, as well as aborted builds
+	and files of the former single-directory layout. Must be called while holding the build lock.
+	"""
+	current_build_dir = get_current_build_dir(store_dir)
+	for name in os.listdir(store_dir):
+		path = os.path.join(store_dir, name)
+		if path == current_build_dir or name == CURRENT_FILENAME:
+			continue
+		if not os.path.isdir(path):
+			os.remove(path)
+			continue
+		index_path = os.path.join(path, INDEX_FILENAME)
+		if not os.path.exists(index_path):
+			shutil.rmtree(path, ignore_errors=True)
+			continue
+		# an open FlatArrayStore holds a shared lock on the index of its build
+		lock = lock_file(index_path, blocking=False)
+		if lock is not None:
+			shutil.rmtree(path, ignore_errors=True)
+			lock.close()
+
+
+def load_flat_array_store(shard_paths, store_dir, checksums=None, padded_fields=None, rebuild=False):
+	"""
+	Maps the current build of the flat array store in 'store_dir' and builds a new one if it is missing, its fingerprint
+	does not match the shards and decoding parameters (see compute_fingerprint) or rebuild=True.
+	Each build has its own directory, CURRENT names the current one. Builds are serialized by a file lock, and builds
+	that are still opened by another process (e.g. another DDP rank) are kept until they are no longer used.
+	rebuild=True only applies to local rank 0, the other ranks of a node use the store that is current when they load it.
+	"""
+	shard_paths = list(shard_paths)
+	fingerprint = compute_fingerprint(shard_paths, checksums=checksums, padded_fields=padded_fields)
+	rebuild = rebuild and get_local_rank() == 0
+	if not rebuild:
+		store = open_flat_array_store(store_dir, fingerprint)
+		if store is not None:
+			return store
+
+	os.makedirs(store_dir, exist_ok=True)
+	build_lock = lock_file(store_dir + LOCK_SUFFIX, create=True)
+	try:
+		if not rebuild:
+			# another process may have built the store while this one was waiting for the lock
+			store = open_flat_array_store(store_dir, fingerprint)
+			if store is not None:
+				return store
+
+		build_dir = os.path.join(store_dir, fingerprint[:16] + '.' + str(time.time_ns()))
+		build_flat_array_store(shard_paths, build_dir, fingerprint, padded_fields=padded_fields)
+		set_current_build_dir(store_dir, build_dir)
+		store = FlatArrayStore(build_dir)
+		remove_unused_builds(store_dir)
+	finally:
+		build_lock.close()
+
+	return store
+
+
+class FlatArrayStore:
+	"""
+	Memory-mapped columns of a split, each stored as flat buffers of values and offsets per sample, like Arrow list arrays.
+	Samples are sliced out of the buffers on access, so opening a store reads only its index and resident memory
+	is proportional to the samples that are touched. The buffers hold the decoded samples, e.g. ll_sims as padded
+	float matrices, such that they serve as a cache across runs, see load_flat_array_store.
+	While the store is open, it holds a shared lock on its index, such that its build is not removed.
+	"""
+
+	def __init__(self, store_dir):
+		self.store_dir = store_dir
+		index_path = os.path.join(store_dir, INDEX_FILENAME)
+		self.lock = lock_file(index_path, shared=True)
+		if not os.path.exists(index_path):
+			# removed before the lock was acquired
+			self.lock.close()
+			raise FileNotFoundError(index_path)
+		self.index = json.load(self.lock)
+		self.buffers = {}
+
+	def __getstate__(self):
+		# DataLoader workers started with spawn rely on the lock of the main process
+		state = self.__dict__.copy()
+		state.update({'lock': None, 'buffers': {}})
+		return state
+
+	def close(self):
+		self.buffers = {}
+		if self.lock is not None:
+			self.lock.close()
+			self.lock = None
+
+	def __len__(self):
+		return self.index['num_rows']
+
+	def get_shard_offsets(self):
+		# rows of the i-th shard are [offsets[i], offsets[i + 1])
+		return np.concatenate([[0], np.cumsum(self.index['shard_num_rows'], dtype=np.int64)])
+
+	def get_list_lengths(self, field):
+		# number of elements of each sample of a list field, without touching its values
+		return np.diff(self.get_buffer(field + '.offsets'))
+
+	def has_field(self, field):
+		return field in self.index['fields']
+
+	def get_buffer(self, name):
+		# mapped on first access, so that forked DataLoader workers do not inherit read pages of the parent
+		if name not in self.buffers:
+			info = self.index['buffers'][name]
+			if info['length'] == 0:
+				self.buffers[name] = np.empty(0, dtype=info['dtype'])
+			else:
+				self.buffers[name] = np.memmap(os.path.join(self.store_dir, name), dtype=info['dtype'], mode='r', shape=(info['length'],))
+
+		return self.buffers[name]
+
+	def get_ranges(self, offsets_name, idxs):
+		offsets = self.get_buffer(offsets_name)
+
+		return offsets[idxs], offsets[idxs + 1]
+
+	def get_lists(self, field, idxs):
+		"""
+		Gathers the lists of the samples 'idxs' (a NumPy integer array) into one array.
+		Returns the offsets of the samples in the gathered array and the gathered array.
+		"""
+		offsets, value_idxs = get_range_idxs(*self.get_ranges(field + '.offsets', idxs))
+
+		return offsets, self.get_buffer(field + '.values')[value_idxs]
+
+	def get_nested_lists(self, field, idxs):
+		# offsets of the samples into the inner lists, offsets of the inner lists into the gathered values and the values
+		sample_offsets, rows = get_range_idxs(*self.get_ranges(field + '.row_offsets', idxs))
+		offsets, value_idxs = get_range_idxs(*self.get_ranges(field + '.offsets', rows))
+
+		return sample_offsets, offsets, self.get_buffer(field + '.values')[value_idxs]
+
+	def get_nested(self, field, idxs):
+		# the inner lists of each sample as views into the gathered values
+		sample_offsets, offsets, values = self.get_nested_lists(field, idxs)
+		inner_lists = np.split(values, offsets[1:-1]) if len(offsets) > 1 else []
+
+		return [inner_lists[sample_offsets[i]:sample_offsets[i + 1]] for i in range(len(idxs))]
+
+	def get_matrices(self, field, idxs):
+		shapes = self.get_buffer(field + '.shapes').reshape(-1, 2)[idxs]
+		offsets, values = self.get_lists(field, idxs)
+
+		return [values[offsets[i]:offsets[i + 1]].reshape(shapes[i]) for i in range(len(idxs))]
+
+	def get_edges(self, idxs):
+		# DFG edges of each sample as (to_node, from_nodes) tuples
+		sample_offsets, edges = get_range_idxs(*self.get_ranges('dfg_edges.row_offsets', idxs))
+		to_nodes = self.get_buffer('dfg_edges.to_nodes')[edges]
+		offsets, from_nodes = self.get_lists('dfg_edges', edges)
+		all_edges = [(to_nodes[i], from_nodes[offsets[i]:offsets[i + 1]]) for i in range(len(edges))]
+
+		return [all_edges[sample_offsets[i]:sample_offsets[i + 1]] for i in range(len(idxs))]
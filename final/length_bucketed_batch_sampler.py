@@ -0,0 +1,113 @@
+from structure_aware_iterable_dataset import get_data_parallel_rank_and_size
+
+import numpy as np
+from torch.utils.data import Sampler
+
+NUM_GLOBAL_BATCHES_PER_BUCKET = 16
+
+
+def compute_padding_stats(sample_lengths, batches):
+	"""
+	Returns the fraction of padding in the structure-aware sequences and in the attention biases of 'batches',
+	where 'sample_lengths' are the block sizes of every sample, see StructureAwareDataset.get_sample_lengths.
+	"""
+	lengths = np.stack([np.asarray(value, dtype=np.int64) for value in sample_lengths.values()], axis=1)
+	num_tokens = num_padded_tokens = num_bias = num_padded_bias = 0
+	for batch in batches:
+		batch_lengths = lengths[batch]
+		seq_len = int(batch_lengths.max(axis=0).sum())  # every block is padded to its max within the batch
+		total_lens = batch_lengths.sum(axis=1)
+		num_tokens += int(total_lens.sum())
+		num_padded_tokens += len(batch) * seq_len
+		num_bias += int((total_lens ** 2).sum())
+		num_padded_bias += len(batch) * seq_len ** 2
+
+	return {
+		'token_padding_ratio': 1 - num_tokens / num_padded_tokens if num_padded_tokens > 0 else 0.0,
+		'attn_bias_padding_ratio': 1 - num_bias / num_padded_bias if num_padded_bias > 0 else 0.0,
+	}
+
+
+class LengthBucketedBatchSampler(Sampler):
+	"""
+	Batches samples of similar structural lengths, such that little of the quadratic attention bias is padding.
+	Samples are sorted by the length of their structure-aware sequence (ties by AST leaves, DFG nodes and code tokens)
+	and cut into buckets of 'bucket_size' samples. Each epoch, samples are shuffled within their bucket, each bucket is split
+	into global batches of batch_size * data_parallel_size samples and the global batches are shuffled.
+	Each data-parallel rank takes its part of every global batch, so all ranks see batches of similar lengths at every step.
+	The epoch advances with every iteration over the sampler, set_epoch sets the epoch of the next iteration.
+	"""
+
+	def __init__(self, sample_lengths, batch_size, bucket_size=None, seed=0, drop_last=False,
+				 data_parallel_rank=None, data_parallel_size=None):
+		super().__init__()
+		if data_parallel_rank is None or data_parallel_size is None:
+			data_parallel_rank, data_parallel_size = get_data_parallel_rank_and_size()
+
+		self.sample_lengths = sample_lengths
+		self.batch_size = batch_size
+		self.seed = seed
+		self.drop_last = drop_last
+		self.data_parallel_rank = data_parallel_rank
+		self.data_parallel_size = data_parallel_size
+		self.global_batch_size = batch_size * data_parallel_size
+		# buckets consist of whole global batches
+		bucket_size = NUM_GLOBAL_BATCHES_PER_BUCKET * self.global_batch_size if bucket_size is None else bucket_size
+		self.bucket_size = -(-bucket_size // self.global_batch_size) * self.global_batch_size
+		self.epoch = 0
+		self.num_iterations = 0
+		self.num_skipped_batches = 0
+
+		total_lens = sum(np.asarray(value, dtype=np.int64) for value in sample_lengths.values())
+		self.sorted_idxs = np.lexsort((sample_lengths['num_code_tokens'], sample_lengths['num_dfg_nodes'],
+									   sample_lengths['num_ast_leaves'], total_lens))
+
+	def set_epoch(self, epoch):
+		self.epoch = epoch
+		self.num_iterations = 0
+
+	def get_epoch(self):
+		return self.epoch + self.num_iterations
+
+	def set_consumed_samples(self, consumed_samples):
+		# resumes training after 'consumed_samples' samples of all ranks, counted from the start of epoch 0
+		epoch, self.num_skipped_batches = divmod(consumed_samples // self.global_batch_size, max(len(self), 1))
+		self.set_epoch(epoch)
+
+	def get_global_batches(self, epoch):
+		rng = np.random.default_rng([self.seed, epoch])
+		global_batches = []
+		for bucket_start in range(0, len(self.sorted_idxs), self.bucket_size):
+			bucket = rng.permutation(self.sorted_idxs[bucket_start:bucket_start + self.bucket_size])
+			for start in range(0, len(bucket), self.global_batch_size):
+				global_batches.append(bucket[start:start + self.global_batch_size])
+
+		# only the last bucket can end with an incomplete global batch
+		if global_batches and len(global_batches[-1]) < self.global_batch_size:
+			last_global_batch = global_batches.pop()
+			if not self.drop_last and len(last_global_batch) >= self.data_parallel_size:
+				# every rank takes the same number of samples
+				global_batches.append(last_global_batch[:len(last_global_batch) - len(last_global_batch) % self.data_parallel_size])
+
+		return [global_batches[i] for i in rng.permutation(len(global_batches))]
+
+	def get_batches(self, epoch=None):
+		# batches of this rank in 'epoch', by default the epoch of the next iteration
+		epoch = self.get_epoch() if epoch is None else epoch
+
+		return [np.array_split(global_batch, self.data_parallel_size)[self.data_parallel_rank] for global_batch in self.get_global_batches(epoch)]
+
+	def get_padding_stats(self, epoch=None):
+		return compute_padding_stats(self.sample_lengths, self.get_batches(epoch))
+
+	def __iter__(self):
+		batches = self.get_batches()[self.num_skipped_batches:]
+		self.num_iterations += 1
+		self.num_skipped_batches = 0
+		for batch in batches:
+			yield batch.tolist()
+
+	def __len__(self):
+		num_global_batches, remainder = divmod(len(self.sorted_idxs), self.global_batch_size)
+
+		return num_global_batches + int(not self.drop_last and remainder >= self.data_parallel_size)
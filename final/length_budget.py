@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+TRUNCATE = 'truncate'
+DROP = 'drop'
+STAT_KEYS = ['num_samples', 'num_dropped', 'num_truncated_code_tokens', 'num_truncated_ast_leaves',
+			 'num_truncated_dfg_nodes', 'num_truncated_lr_paths', 'num_truncated_total_len']
+
+
+class LengthBudget:
+	"""
+	Budgets on the structural lengths of a sample, all including special tokens, i.e. BOS/EOS of the code tokens,
+	<START_AST>/<END_AST> of the AST leaves and the start and padding token of the DFG nodes.
+	'max_total_len' bounds the structure-aware sequence of code tokens, AST leaves, DFG nodes (and text tokens).
+	With policy='truncate', over-budget samples are cut to a prefix of the function, such that code tokens, AST leaves
+	and DFG nodes stay consistent, and LR paths keep their leaf and the nodes closest to the root.
+	With policy='drop', over-budget samples are removed. A budget of None is unbounded.
+	"""
+
+	def __init__(self, max_code_tokens=None, max_ast_leaves=None, max_dfg_nodes=None, max_lr_path_len=None,
+				 max_total_len=None, policy=TRUNCATE):
+		if policy not in [TRUNCATE, DROP]:
+			raise ValueError('Unknown length budget policy ' + str(policy))
+
+		self.max_code_tokens = max_code_tokens
+		self.max_ast_leaves = max_ast_leaves
+		self.max_dfg_nodes = max_dfg_nodes
+		self.max_lr_path_len = max_lr_path_len
+		self.max_total_len = max_total_len
+		self.policy = policy
+
+	def get_key(self):
+		# part of the sample keys, as the budget changes the stored samples
+		return ','.join(str(value) for value in [self.max_code_tokens, self.max_ast_leaves, self.max_dfg_nodes,
+												 self.max_lr_path_len, self.max_total_len, self.policy])
+
+	def truncate_lr_path(self, lr_path):
+		# lr_path goes from the leaf to the root, the leaf and the nodes closest to the root are kept for the LCA of ll_sims
+		if self.max_lr_path_len is None or len(lr_path) <= self.max_lr_path_len:
+			return lr_path
+
+		return lr_path[:1] + lr_path[len(lr_path) - self.max_lr_path_len + 1:]
+
+	def get_max_lr_path_len(self, ast_leaves):
+		max_lr_path_len = 0
+		for leaf in ast_leaves:
+			lr_path_len = 1
+			while leaf.parent is not None:
+				leaf = leaf.parent
+				lr_path_len += 1
+			max_lr_path_len = max(max_lr_path_len, lr_path_len)
+
+		return max_lr_path_len
+
+	def truncate_structure(self, num_code_tokens, ast_leaf_code_token_idxs, dfg_edges, max_code_tokens, max_leaves, max_dfg_nodes):
+		"""
+		Cuts a sample without special tokens to at most 'max_code_tokens' code tokens, 'max_leaves' AST leaves and
+		'max_dfg_nodes' DFG nodes. AST leaves whose code tokens are cut and DFG edges between cut AST leaves are removed.
+		"""
+		num_leaves = min(len(ast_leaf_code_token_idxs), max_leaves)
+		for i in range(num_leaves):
+			if ast_leaf_code_token_idxs[i] and max(ast_leaf_code_token_idxs[i]) >= max_code_tokens:
+				num_leaves = i
+				break
+
+		if num_leaves < len(ast_leaf_code_token_idxs):
+			# the code ends with the last remaining AST leaf
+			num_code_tokens = max([max(idxs) + 1 for idxs in ast_leaf_code_token_idxs[:num_leaves] if idxs], default=0)
+		num_code_tokens = min(num_code_tokens, max_code_tokens)
+
+		dfg_edges = [(left, [r for r in right if r < num_leaves]) for left, right in dfg_edges if left < num_leaves]
+		dfg_nodes = sorted(set([left for left, _ in dfg_edges] + [r for _, right in dfg_edges for r in right]))
+		if len(dfg_nodes) > max_dfg_nodes:
+			max_dfg_node = dfg_nodes[max_dfg_nodes - 1]
+			dfg_edges = [(left, [r for r in right if r <= max_dfg_node]) for left, right in dfg_edges if left <= max_dfg_node]
+			dfg_nodes = dfg_nodes[:max_dfg_nodes]
+
+		return num_code_tokens, num_leaves, dfg_edges, len(dfg_nodes)
+
+	def apply(self, data):
+		"""
+		Enforces the budgets on featurized data with the columns code_tokens (integer lists w/o special tokens), ast_leaves,
+		ast_leaf_code_token_idxs, dfg_edges and optionally text_tokens.
+		Returns the remaining samples and the statistics of what was affected.
+		"""
+		stats = dict.fromkeys(STAT_KEYS, 0)
+		stats['num_samples'] = len(data)
+		code_tokens = pa.array(data['code_tokens'])
+		num_code_tokens = pc.list_value_length(code_tokens).to_numpy()
+		num_text_tokens = pc.list_value_length(pa.array(data['text_tokens'])).to_numpy() + 2 if 'text_tokens' in data.columns else np.zeros(len(data), dtype=np.int64)
+		max_code_tokens = np.inf if self.max_code_tokens is None else self.max_code_tokens - 2
+		max_leaves = np.inf if self.max_ast_leaves is None else self.max_ast_leaves - 2
+		max_dfg_nodes = np.inf if self.max_dfg_nodes is None else self.max_dfg_nodes - 2
+
+		keep = np.ones(len(data), dtype=bool)
+		new_num_code_tokens = num_code_tokens.copy()
+		all_ast_leaves = []
+		all_ast_leaf_code_token_idxs = []
+		all_dfg_edges = []
+		for i, (ast_leaves, ast_leaf_code_token_idxs, dfg_edges) in enumerate(zip(data['ast_leaves'], data['ast_leaf_code_token_idxs'], data['dfg_edges'])):
+			truncated = self.truncate_structure(num_code_tokens[i], ast_leaf_code_token_idxs, dfg_edges, max_code_tokens, max_leaves, max_dfg_nodes)
+			total_len = truncated[0] + truncated[1] + truncated[3] + 6 + num_text_tokens[i]
+			if self.max_total_len is not None and total_len > self.max_total_len:
+				# shortening the code also removes AST leaves and DFG nodes, so cutting the excess from the code is sufficient
+				truncated = self.truncate_structure(num_code_tokens[i], ast_leaf_code_token_idxs, dfg_edges,
+													truncated[0] - (total_len - self.max_total_len), max_leaves, max_dfg_nodes)
+				stats['num_truncated_total_len'] += 1
+			num_dfg_nodes = len(set([left for left, _ in dfg_edges] + [r for _, right in dfg_edges for r in right]))
+			is_truncated = {
+				'num_truncated_code_tokens': truncated[0] < num_code_tokens[i],
+				'num_truncated_ast_leaves': truncated[1] < len(ast_leaves),
+				# DFG nodes are only removed as a whole, i.e. edges change iff the number of DFG nodes does
+				'num_truncated_dfg_nodes': truncated[3] < num_dfg_nodes,
+				'num_truncated_lr_paths': self.max_lr_path_len is not None and self.get_max_lr_path_len(ast_leaves) > self.max_lr_path_len,
+			}
+			for key, value in is_truncated.items():
+				stats[key] += int(value)
+			if (self.policy == DROP and any(is_truncated.values())) or truncated[0] <= 0 or not truncated[2]:
+				keep[i] = False
+				continue
+
+			new_num_code_tokens[i] = truncated[0]
+			all_ast_leaves.append(ast_leaves[:truncated[1]])
+			all_ast_leaf_code_token_idxs.append(ast_leaf_code_token_idxs[:truncated[1]])
+			all_dfg_edges.append(truncated[2])
+
+		stats['num_dropped'] = int((~keep).sum())
+		data = data[keep].copy()
+		# prefixes of the kept code tokens
+		starts = code_tokens.offsets.to_numpy()[:-1][keep]
+		ends = starts + new_num_code_tokens[keep]
+		code_offsets = np.concatenate([[0], np.cumsum(ends - starts)])
+		idxs = np.repeat(starts - code_offsets[:-1], ends - starts) + np.arange(code_offsets[-1])
+		code_tokens = pa.ListArray.from_arrays(pa.array(code_offsets, type=pa.int32()), code_tokens.values.take(pa.array(idxs, type=pa.int64())))
+		data['code_tokens'] = pd.Series(pd.arrays.ArrowExtensionArray(code_tokens), index=data.index)
+		data['ast_leaves'] = pd.Series(all_ast_leaves, index=data.index, dtype=object)
+		data['ast_leaf_code_token_idxs'] = pd.Series(all_ast_leaf_code_token_idxs, index=data.index, dtype=object)
+		data['dfg_edges'] = pd.Series(all_dfg_edges, index=data.index, dtype=object)
+
+		return data, stats
+
+
+def merge_stats(all_stats):
+	merged = dict.fromkeys(STAT_KEYS, 0)
+	for stats in all_stats:
+		for key in STAT_KEYS:
+			merged[key] += stats.get(key, 0)
+
+	return merged
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import resource
+import sys
+import threading
+from contextlib import contextmanager
+
+from tqdm import tqdm
+
+try:
+	import psutil
+except ImportError:
+	psutil = None
+
+RSS_SAMPLE_INTERVAL = 0.01  # seconds
+
+
+def get_peak_rss_bytes(who=resource.RUSAGE_SELF):
+	# peak over the lifetime of the process or, with RUSAGE_CHILDREN, of its largest terminated child
+	# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+	peak_rss = resource.getrusage(who).ru_maxrss
+
+	return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def get_rss_bytes():
+	# current resident set size of the process
+	if psutil is not None:
+		return psutil.Process().memory_info().rss
+	try:
+		with open('/proc/self/statm', 'r') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except OSError:
+		return get_peak_rss_bytes()
+
+
+class RssSampler:
+	"""
+	Samples the RSS of the process on a background thread while a stage runs, such that the peak of the stage is known
+	instead of the peak over the lifetime of the process. Peaks shorter than RSS_SAMPLE_INTERVAL can be missed.
+	"""
+
+	def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+		self.interval = interval
+		self.start_rss = get_rss_bytes()
+		self.peak_rss = self.start_rss
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self.sample, daemon=True)
+		self.thread.start()
+
+	def sample(self):
+		while not self.stopped.wait(self.interval):
+			self.peak_rss = max(self.peak_rss, get_rss_bytes())
+
+	def stop(self):
+		self.stopped.set()
+		self.thread.join()
+		self.peak_rss = max(self.peak_rss, get_rss_bytes())
+
+		return self.peak_rss
+
+
+class StageRecord:
+
+	def __init__(self, stage, chunk_start=None, num_rows=0):
+		self.stage = stage
+		self.chunk_start = chunk_start
+		self.num_rows = num_rows
+		self.seconds = 0.0
+		self.bytes_written = 0
+		self.start_rss_bytes = 0
+		self.peak_rss_bytes = 0
+		self.children_peak_rss_bytes = 0
+		self.pid = os.getpid()
+
+	def to_dict(self):
+		return {
+			'stage': self.stage,
+			'chunk_start': self.chunk_start,
+			'num_rows': self.num_rows,
+			'seconds': self.seconds,
+			'rows_per_sec': self.num_rows / self.seconds if self.seconds > 0 else None,
+			'bytes_written': self.bytes_written,
+			'start_rss_bytes': self.start_rss_bytes,
+			'peak_rss_bytes': self.peak_rss_bytes,
+			'children_peak_rss_bytes': self.children_peak_rss_bytes,
+			'pid': self.pid,
+		}
+
+
+class PipelineProfiler:
+	"""
+	Records wall time, rows/second, bytes written and memory per stage and chunk of the DataHandler pipeline.
+	The RSS at the start and the peak RSS of a stage are sampled while it runs, see RssSampler. Stages of forked workers
+	are sampled in the workers. children_peak_rss_bytes is the peak of the largest terminated child process so far.
+	A disabled profiler does not record anything, such that it can be passed to every run.
+	"""
+
+	def __init__(self, enabled=True, live=False):
+		self.enabled = enabled
+		self.live = live
+		self.records = []
+		self.start_time = time.perf_counter()
+
+	@contextmanager
+	def stage(self, stage, num_rows=0, chunk_start=None):
+		"""
+		Times the body of the with-statement as 'stage' and yields its record, e.g. to set bytes_written.
+		"""
+		if not self.enabled:
+			yield None
+			return
+
+		record = StageRecord(stage, chunk_start=chunk_start, num_rows=num_rows)
+		rss_sampler = RssSampler()
+		start = time.perf_counter()
+		try:
+			yield record
+		finally:
+			seconds = time.perf_counter() - start
+			record.start_rss_bytes = rss_sampler.start_rss
+			record.peak_rss_bytes = rss_sampler.stop()
+			self.finish(record, seconds)
+
+	def add(self, stage, seconds, num_rows=0, chunk_start=None):
+		# for stages that are timed in pieces, e.g. per row, the RSS is only taken when they are added
+		if self.enabled:
+			record = StageRecord(stage, chunk_start=chunk_start, num_rows=num_rows)
+			record.start_rss_bytes = record.peak_rss_bytes = get_rss_bytes()
+			self.finish(record, seconds)
+
+	def finish(self, record, seconds):
+		record.seconds = seconds
+		record.children_peak_rss_bytes = get_peak_rss_bytes(resource.RUSAGE_CHILDREN)
+		self.records.append(record)
+		if self.live:
+			tqdm.write(self.format_record(record))
+
+	def format_record(self, record):
+		chunk = '' if record.chunk_start is None else ' (chunk ' + str(record.chunk_start) + ')'
+		rows_per_sec = record.num_rows / record.seconds if record.seconds > 0 else 0
+
+		return '{}{}: {:.3f}s, {} rows, {:.1f} rows/s, {} bytes written, RSS {:.1f} MiB at start, peak RSS {:.1f} MiB'.format(
+			record.stage, chunk, record.seconds, record.num_rows, rows_per_sec, record.bytes_written, record.start_rss_bytes / 2 ** 20,
+			record.peak_rss_bytes / 2 ** 20)
+
+	def pop_records(self):
+		# records of a worker process are sent to the parent process and merged via extend
+		records = self.records
+		self.records = []
+
+		return records
+
+	def extend(self, records):
+		if self.enabled:
+			self.records.extend(records)
+
+	def summarize(self):
+		stages = {}
+		for record in self.records:
+			summary = stages.setdefault(record.stage, {'calls': 0, 'num_rows': 0, 'seconds': 0.0, 'bytes_written': 0, 'peak_rss_bytes': 0,
+													   'peak_rss_increase_bytes': 0})
+			summary['calls'] += 1
+			summary['num_rows'] += record.num_rows
+			summary['seconds'] += record.seconds
+			summary['bytes_written'] += record.bytes_written
+			summary['peak_rss_bytes'] = max(summary['peak_rss_bytes'], record.peak_rss_bytes)
+			summary['peak_rss_increase_bytes'] = max(summary['peak_rss_increase_bytes'], record.peak_rss_bytes - record.start_rss_bytes)
+
+		for summary in stages.values():
+			summary['rows_per_sec'] = summary['num_rows'] / summary['seconds'] if summary['seconds'] > 0 else None
+
+		return stages
+
+	def get_report(self):
+		return {
+			'wall_seconds': time.perf_counter() - self.start_time,
+			'peak_rss_bytes': max([record.peak_rss_bytes for record in self.records], default=get_rss_bytes()),
+			'children_peak_rss_bytes': get_peak_rss_bytes(resource.RUSAGE_CHILDREN),
+			'stages': self.summarize(),
+			'records': [record.to_dict() for record in self.records],
+		}
+
+	def write_report(self, path):
+		report = self.get_report()
+		with open(path, 'w') as f:
+			json.dump(report, f, indent=2)
+
+		return report
+
+	def print_summary(self):
+		for stage, summary in sorted(self.summarize().items(), key=lambda item: -item[1]['seconds']):
+			print('{:<40} {:>6} calls {:>10.3f}s {:>10} rows {:>12.1f} rows/s {:>12} bytes {:>10.1f} MiB peak RSS'.format(
+				stage, summary['calls'], summary['seconds'], summary['num_rows'], summary['rows_per_sec'] or 0, summary['bytes_written'],
+				summary['peak_rss_bytes'] / 2 ** 20))
@@ -0,0 +1,285 @@
+import os
+import re
+import sys
+import time
+import tempfile
+import tokenize
+import tracemalloc
+from io import StringIO
+from types import SimpleNamespace
+
+import numpy as np
+
+from data_handler import DataHandler
+from code_completion_attn_mask import CodeCompletionAttnMask
+from code_text_attn_mask import CodeTextAttnMask
+from deduplication import Deduplicator
+from pipeline_profiler import get_peak_rss_bytes
+from synthetic_corpus import SIZE_TIERS, SyntheticTokenizer, generate_tier
+
+
+NUM_SAMPLES_PER_TIER = {'small': 400, 'medium': 100, 'large': 25}
+
+
+def benchmark_char_filter(data_handler, codes):
+	"""
+	Compares the characters/second of the list-based character filter with the precompiled one of 'preprocess'.
+	"""
+	num_chars = sum(len(code) for code in codes)
+	results = {}
+
+	start = time.perf_counter()
+	tokenizer_chars = data_handler.get_tokenizer_chars()
+	list_filtered = [''.join(filter(lambda c: c in tokenizer_chars, code)) for code in codes]
+	results['list_chars_per_sec'] = num_chars / (time.perf_counter() - start)
+
+	start = time.perf_counter()
+	char_filter = data_handler.get_char_filter()
+	compiled_filtered = [char_filter.sub('', code) for code in codes]
+	results['compiled_chars_per_sec'] = num_chars / (time.perf_counter() - start)
+
+	assert list_filtered == compiled_filtered, 'Precompiled character filter is not equivalent to list-based filter'
+	results['speedup'] = results['compiled_chars_per_sec'] / results['list_chars_per_sec']
+
+	return results
+
+
+def legacy_remove_comments_and_docstrings(source):
+	"""
+	Quadratic reference implementation of DataHandler.remove_comments_and_docstrings.
+	"""
+	io_obj = StringIO(source)
+	out = ""
+	prev_toktype = tokenize.INDENT
+	last_lineno = -1
+	last_col = 0
+
+	for tok in tokenize.generate_tokens(io_obj.readline):
+		token_type = tok[0]
+		token_string = tok[1]
+		start_line, start_col = tok[2]
+		end_line, end_col = tok[3]
+
+		if start_line > last_lineno:
+			last_col = 0
+		if start_col > last_col:
+			out += (" " * (start_col - last_col))
+
+		if token_type == tokenize.COMMENT:
+			pass
+		elif token_type == tokenize.STRING:
+			if prev_toktype != tokenize.INDENT:
+				if prev_toktype != tokenize.NEWLINE:
+					if start_col > 0:
+						out += token_string
+		else:
+			out += token_string
+
+		prev_toktype = token_type
+		last_col = end_col
+		last_lineno = end_line
+
+	temp = []
+	for row in out.split('\n'):
+		if row.strip() != "":
+			temp.append(row)
+	code = '\n'.join(temp)
+
+	pos = 0
+	docstring_quotes = '"""'
+	while pos < len(code):
+		try:
+			start = code[pos:].index(docstring_quotes) + pos
+			end = code[start + len(docstring_quotes):].index(docstring_quotes) + start + len(docstring_quotes)
+			code = code[:start] + code[end + len(docstring_quotes):]
+			pos = start
+		except ValueError:
+			break
+
+	return re.sub(r"\r\n\s*\r\n", '\n', code)
+
+
+def strip_or_none(strip_fn, code):
+	try:
+		return strip_fn(code)
+	except (tokenize.TokenError, SyntaxError):
+		return None
+
+
+def benchmark_comment_stripper(data_handler, codes):
+	"""
+	Compares the legacy comment and docstring stripper with the one of 'preprocess'.
+	Fails if any output is not byte-identical.
+	"""
+	num_chars = sum(len(code) for code in codes)
+	results = {}
+
+	start = time.perf_counter()
+	legacy_stripped = [strip_or_none(legacy_remove_comments_and_docstrings, code) for code in codes]
+	results['legacy_chars_per_sec'] = num_chars / (time.perf_counter() - start)
+
+	start = time.perf_counter()
+	stripped = [strip_or_none(data_handler.remove_comments_and_docstrings, code) for code in codes]
+	results['linear_chars_per_sec'] = num_chars / (time.perf_counter() - start)
+
+	mismatches = [i for i, (a, b) in enumerate(zip(legacy_stripped, stripped)) if a != b]
+	assert not mismatches, 'Comment stripper output differs for samples ' + str(mismatches[:10])
+	results['speedup'] = results['linear_chars_per_sec'] / results['legacy_chars_per_sec']
+
+	return results
+
+
+def legacy_ll_sims(data_handler, leaf_lr_paths, max_num_ast_leaves=512):
+	"""
+	Double-loop reference implementation of DataHandler.compute_ll_sims based on get_ll_sim.
+	"""
+	lr_paths = [[SimpleNamespace(type='<START_AST>')]] + leaf_lr_paths + [[SimpleNamespace(type='<END_AST>')]]
+	num_ast_leaves = min(len(lr_paths), max_num_ast_leaves)
+	ll_sims = np.ones((num_ast_leaves, num_ast_leaves))
+
+	for i in range(num_ast_leaves - 1):
+		for j in range(i + 1, num_ast_leaves):
+			ll_sims[i, j] = ll_sims[j, i] = data_handler.get_ll_sim(lr_paths[i], lr_paths[j])
+
+	return ll_sims
+
+
+def benchmark_ll_sims(data_handler, ast_leaves_per_sample):
+	"""
+	Compares the leaves/second of the double-loop ll_sims computation with the vectorized one.
+	Fails if any ll_sims matrix differs.
+	"""
+	all_leaf_lr_paths = [[data_handler.get_lr_path(leaf) for leaf in ast_leaves] for ast_leaves in ast_leaves_per_sample]
+	num_leaves = sum(len(leaf_lr_paths) for leaf_lr_paths in all_leaf_lr_paths)
+	results = {}
+
+	start = time.perf_counter()
+	legacy = [legacy_ll_sims(data_handler, leaf_lr_paths) for leaf_lr_paths in all_leaf_lr_paths]
+	results['legacy_leaves_per_sec'] = num_leaves / (time.perf_counter() - start)
+
+	start = time.perf_counter()
+	vectorized = [data_handler.compute_ll_sims(leaf_lr_paths) for leaf_lr_paths in all_leaf_lr_paths]
+	results['vectorized_leaves_per_sec'] = num_leaves / (time.perf_counter() - start)
+
+	mismatches = [i for i, (a, b) in enumerate(zip(legacy, vectorized)) if not np.array_equal(a, b)]
+	assert not mismatches, 'Vectorized ll_sims differ for samples ' + str(mismatches[:10])
+	results['speedup'] = results['vectorized_leaves_per_sec'] / results['legacy_leaves_per_sec']
+
+	return results
+
+
+def measure(fn, setup, num_samples):
+	"""
+	Runs fn(setup()) once timed and once under tracemalloc, as tracing slows down the run.
+	The peak covers Python objects and NumPy arrays, but not buffers of the Arrow memory pool.
+	"""
+	inputs = setup()
+	start = time.perf_counter()
+	fn(inputs)
+	seconds = time.perf_counter() - start
+
+	inputs = setup()
+	tracemalloc.start()
+	try:
+		fn(inputs)
+		peak_traced_bytes = tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+
+	return {
+		'samples_per_sec': num_samples / seconds,
+		'peak_traced_bytes': peak_traced_bytes,
+	}
+
+
+def benchmark_stages(data_handler, data):
+	"""
+	Benchmarks each stage of the pipeline in isolation on the output of the previous stages.
+	'data' is a synthetic corpus, see synthetic_corpus.generate_corpus.
+	"""
+	results = {}
+	num_samples = len(data)
+
+	results['preprocess'] = measure(data_handler.preprocess, lambda: data[['text', 'code']].copy(), num_samples)
+	results['deduplicate'] = measure(lambda data: Deduplicator(near_dup_threshold=0.8).filter(data), lambda: data[['text', 'code']].copy(), num_samples)
+	results['clean_data'] = measure(data_handler.clean_data, lambda: data.copy(), num_samples)
+	cleaned = data_handler.clean_data(data.copy())
+	results['convert_tokens_to_arrays'] = measure(data_handler.convert_tokens_to_arrays, lambda: cleaned.copy(), num_samples)
+
+	stage_data = data_handler.convert_tokens_to_arrays(cleaned.copy())
+	for stage in [data_handler.add_ast_lr_paths_and_ll_sim, data_handler.map_dfg_node_code_token_idices, data_handler.add_special_tokens]:
+		results[stage.__name__] = measure(stage, lambda: stage_data.copy(), num_samples)
+		stage(stage_data)
+
+	return results
+
+
+def benchmark_end_to_end(data_handler, data, num_rows_per_file=100):
+	"""
+	Benchmarks the pipeline from the featurized corpus to reduced shards with node type indices in a temporary directory.
+	"""
+	def run_pipeline(data):
+		with tempfile.TemporaryDirectory() as save_dir:
+			data_handler.save_dir = save_dir
+			data = data_handler.convert_tokens_to_arrays(data_handler.clean_data(data))
+			all_node_types, _ = data_handler.store_preprocessed_data(data, num_rows_per_file)
+			data_handler.convert_node_types_to_indices(all_node_types)
+			data_handler.reduce_ll_sims()
+
+	return measure(run_pipeline, lambda: data.copy(), len(data))
+
+
+def run_synthetic_suite(tiers=tuple(SIZE_TIERS), num_samples_per_tier=None, seed=0):
+	"""
+	Benchmarks all stages and the whole pipeline with both attention mask builders on seeded synthetic corpora of all size tiers.
+	The comment stripper and the ll_sims computation are checked against their legacy implementations on the way.
+	Runs offline on CPU.
+	"""
+	num_samples_per_tier = NUM_SAMPLES_PER_TIER if num_samples_per_tier is None else num_samples_per_tier
+	results = {}
+
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		tokenizer = SyntheticTokenizer()
+		tokenizer_cache_dir = os.path.join(tmp_dir, 'tokenizers')
+		for tier in tiers:
+			data = generate_tier(tier, num_samples_per_tier[tier], seed=seed, tokenizer=tokenizer)
+			data_handler = DataHandler(save_dir=tmp_dir, tokenizer=tokenizer, tokenizer_cache_dir=tokenizer_cache_dir)
+
+			tier_results = benchmark_stages(data_handler, data)
+			codes = [code.strip().replace('▁', '_').replace('\r\n', '\n') for code in data['code']]
+			tier_results['comment_stripper'] = benchmark_comment_stripper(data_handler, codes)
+			tier_results['ll_sims'] = benchmark_ll_sims(data_handler, data['ast_leaves'])
+			for attn_mask_builder in [CodeCompletionAttnMask(), CodeTextAttnMask()]:
+				data_handler = DataHandler(save_dir=tmp_dir, tokenizer=tokenizer, attn_mask_builder=attn_mask_builder,
+										   tokenizer_cache_dir=tokenizer_cache_dir)
+				tier_results['end_to_end.' + type(attn_mask_builder).__name__] = benchmark_end_to_end(data_handler, data)
+			tier_results['peak_rss_bytes'] = get_peak_rss_bytes()
+			results[tier] = tier_results
+
+	return results
+
+
+def print_results(results, indent=''):
+	for name, value in results.items():
+		if isinstance(value, dict):
+			print(indent + name + ':')
+			print_results(value, indent + '  ')
+		else:
+			print(indent + name + ': ' + str(round(value, 2)))
+
+
+if __name__ == '__main__':
+	print_results(run_synthetic_suite())
+	if '--code-search-net' not in sys.argv:
+		sys.exit()
+
+	data_handler = DataHandler(save_dir='../data/benchmark')
+	data = data_handler.read_dataset(split='validation', max_samples=1000)
+	codes = [code.strip().replace('▁', '_').replace('\r\n', '\n') for code in data['code']]
+
+	for name, value in benchmark_char_filter(data_handler, codes).items():
+		print(name + ': ' + str(round(value, 2)))
+
+	codes = [data_handler.get_char_filter().sub('', code) for code in codes]
+	for name, value in benchmark_comment_stripper(data_handler, codes).items():
+		print(name + ': ' + str(round(value, 2)))
@@ -0,0 +1,188 @@
+import numpy as np
+import torch
+
+INT_DTYPES = [np.int8, np.int16, np.int32, np.int64]
+
+
+def to_smallest_int(values):
+	# casts integer 'values' to the smallest signed integer type that holds them
+	if values.size == 0:
+		return values.astype(np.int8)
+	low, high = values.min(), values.max()
+
+	return values.astype(next(dtype for dtype in INT_DTYPES if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max))
+
+
+def encode_rows(rows, col_starts, row_lens, values, fill_value):
+	"""
+	Encodes the entries that differ from 'fill_value' of rows of 'row_lens' entries, whose 'values' are concatenated,
+	once as runs of equal values and once as the spans from the first to the last such entry of each row.
+	'rows' and 'col_starts' are the positions of the rows in the padded tensor. Returns both encodings as
+	the segments (row, start, end) and their values.
+	"""
+	row_offsets = np.cumsum(row_lens) - row_lens
+	row_of_entries = np.repeat(np.arange(len(row_lens)), row_lens)
+	cols = np.arange(len(values)) - row_offsets[row_of_entries] + col_starts[row_of_entries]
+	is_set = values != fill_value
+	is_row_start = np.zeros(len(values), dtype=bool)
+	is_row_start[row_offsets[row_lens > 0]] = True
+	changes = is_row_start.copy()
+	changes[1:] |= values[1:] != values[:-1]
+	run_starts = np.flatnonzero(is_set & changes)
+	run_ends = np.flatnonzero(is_set & np.append(changes[1:], True))
+	runs = np.stack([rows[row_of_entries[run_starts]], cols[run_starts], cols[run_ends] + 1], axis=1)
+
+	set_idxs = np.flatnonzero(is_set)
+	set_rows = row_of_entries[set_idxs]
+	span_starts = set_idxs[np.diff(set_rows, prepend=-1) != 0]
+	span_ends = set_idxs[np.diff(set_rows, append=-1) != 0]
+	in_span = np.zeros(len(values) + 1, dtype=np.int64)
+	in_span[span_starts] += 1
+	in_span[span_ends + 1] -= 1
+	spans = np.stack([rows[row_of_entries[span_starts]], cols[span_starts], cols[span_ends] + 1], axis=1)
+
+	return (runs, values[run_starts]), (spans, values[np.cumsum(in_span[:-1]) > 0])
+
+
+def expand_segments(segments, num_cols, num_entries):
+	# flat positions of all entries within the segments (row, start, end) of a tensor with 'num_cols' columns
+	segments = segments.long()
+	lengths = segments[:, 2] - segments[:, 1]
+	entry_idxs = torch.arange(num_entries, device=segments.device) - torch.repeat_interleave(lengths.cumsum(0) - lengths, lengths,
+																							   output_size=num_entries)
+
+	return torch.repeat_interleave(segments[:, 0] * num_cols + segments[:, 1], lengths, output_size=num_entries) + entry_idxs, lengths
+
+
+class RaggedTensor:
+	"""
+	Records slice assignments to a tensor of 'size' filled with 'fill_value' without allocating it, see StructureAwareDataset.collate.
+	The assigned entries are stored either as runs of equal values or as row spans, whichever takes fewer bytes.
+	The assignments must not overlap, and 'assemble' scatters them into the padded tensor on the device of the recorded tensors.
+	"""
+
+	def __init__(self, size, fill_value, dtype):
+		self.size = tuple(size)
+		self.fill_value = fill_value
+		self.dtype = dtype
+		# 2D tensors are treated as one row per sample
+		self.num_rows = int(np.prod(self.size[1:-1], dtype=np.int64)) if len(self.size) > 2 else 1
+		self.num_cols = self.size[-1]
+		self.writes = []
+		self.fills = []
+		self.tensors = None
+		self.num_entries = 0
+
+	def __setitem__(self, key, value):
+		key = key if isinstance(key, tuple) else (key,)
+		if len(self.size) == 2:
+			key = (key[0], 0) + key[1:]
+		key = key + (slice(None),) * (3 - len(key))
+		batch_idxs, rows, cols = [range(size)[k] if isinstance(k, slice) else range(k, k + 1)
+								  for k, size in zip(key, (self.size[0], self.num_rows, self.num_cols))]
+		if len(rows) == 0 or len(cols) == 0:
+			return
+
+		for batch_idx in batch_idxs:
+			flat_rows = np.arange(rows.start, rows.stop) + batch_idx * self.num_rows
+			if torch.is_tensor(value):
+				self.writes.append((flat_rows, cols.start, value.numpy().reshape(len(rows), len(cols))))
+			else:
+				self.fills.append((np.stack([flat_rows, np.full(len(rows), cols.start), np.full(len(rows), cols.stop)], axis=1), value))
+
+	def unsqueeze(self, dim):
+		self.size = self.size[:dim] + (1,) + self.size[dim:]
+		return self
+
+	def get_tensors(self):
+		"""
+		Encodes the assignments into the segments (row, start, end) of the runs and the spans and their values.
+		Integer values and the segments are stored in the smallest integer type that holds them.
+		"""
+		if self.tensors is not None:
+			return self.tensors
+
+		if self.writes:
+			row_lens = np.concatenate([np.full(len(flat_rows), matrix.shape[1]) for flat_rows, _, matrix in self.writes])
+			(runs, run_values), (spans, span_values) = encode_rows(
+				np.concatenate([flat_rows for flat_rows, _, _ in self.writes]),
+				np.concatenate([np.full(len(flat_rows), col_start) for flat_rows, col_start, _ in self.writes]),
+				row_lens,
+				np.concatenate([matrix.ravel() for _, _, matrix in self.writes]),
+				self.fill_value,
+			)
+			item_size = torch.empty(0, dtype=self.dtype).element_size()
+			if len(runs) * (3 * 4 + item_size) >= len(spans) * 3 * 4 + len(span_values) * item_size:
+				runs, run_values = np.zeros((0, 3), dtype=np.int64), run_values[:0]
+			else:
+				spans, span_values = np.zeros((0, 3), dtype=np.int64), span_values[:0]
+		else:
+			runs, run_values = np.zeros((0, 3), dtype=np.int64), np.zeros(0)
+			spans, span_values = runs, run_values
+		if self.fills:
+			runs = np.concatenate([runs] + [fill_runs for fill_runs, _ in self.fills])
+			run_values = np.concatenate([run_values] + [np.full(len(fill_runs), value, dtype=run_values.dtype) for fill_runs, value in self.fills])
+
+		self.tensors = {'runs': runs, 'runs_values': run_values, 'spans': spans, 'spans_values': span_values}
+		for name, values in self.tensors.items():
+			if name.endswith('values') and self.dtype.is_floating_point:
+				self.tensors[name] = torch.from_numpy(values).to(self.dtype)
+			else:
+				self.tensors[name] = torch.from_numpy(to_smallest_int(values))
+		# computed on the host, such that assemble does not synchronize with the device
+		self.num_entries = int((runs[:, 2] - runs[:, 1]).sum())
+		self.writes = self.fills = None
+
+		return self.tensors
+
+	def assemble(self, tensors):
+		# 'tensors' are the tensors of get_tensors, possibly moved to another device
+		assembled = torch.full(self.size, self.fill_value, dtype=self.dtype, device=tensors['runs'].device)
+		flat = assembled.view(-1)
+		positions, lengths = expand_segments(tensors['runs'], self.num_cols, self.num_entries)
+		flat[positions] = torch.repeat_interleave(tensors['runs_values'].to(self.dtype), lengths, output_size=self.num_entries)
+		flat[expand_segments(tensors['spans'], self.num_cols, tensors['spans_values'].size(0))[0]] = tensors['spans_values'].to(self.dtype)
+
+		return assembled
+
+
+class RaggedBatch:
+	"""
+	Batch of StructureAwareDataset.collate_ragged_fn that holds only the entries of the samples instead of the padded tensors,
+	e.g. runs of the attention masks and row spans of ll_sims. It is moved to the device with 'to' and assembled there into
+	the batch of StructureAwareDataset.collate_fn, such that the quadratic padded tensors are neither built on the host nor copied.
+	"""
+
+	def __init__(self, batch_dict):
+		self.ragged_tensors = {key: value for key, value in batch_dict.items() if isinstance(value, RaggedTensor)}
+		self.tensors = {key: value.get_tensors() if isinstance(value, RaggedTensor) else value for key, value in batch_dict.items()}
+
+	def map_tensors(self, fn):
+		batch = RaggedBatch.__new__(RaggedBatch)
+		batch.ragged_tensors = self.ragged_tensors
+		batch.tensors = {key: {name: fn(tensor) for name, tensor in value.items()} if isinstance(value, dict) else fn(value)
+						 for key, value in self.tensors.items()}
+
+		return batch
+
+	def to(self, device, non_blocking=False):
+		return self.map_tensors(lambda tensor: tensor.to(device, non_blocking=non_blocking))
+
+	def pin_memory(self):
+		# called by the DataLoader with pin_memory=True
+		return self.map_tensors(lambda tensor: tensor.pin_memory())
+
+	def get_num_bytes(self):
+		return sum(tensor.numel() * tensor.element_size() for value in self.tensors.values()
+				   for tensor in (value.values() if isinstance(value, dict) else [value]))
+
+	def get_padded_num_bytes(self):
+		# bytes of the batch of StructureAwareDataset.collate_fn
+		return sum(int(np.prod(self.ragged_tensors[key].size)) * torch.empty(0, dtype=self.ragged_tensors[key].dtype).element_size()
+				   if key in self.ragged_tensors else value.numel() * value.element_size() for key, value in self.tensors.items())
+
+	def assemble(self):
+		"""
+		Scatters the entries into the padded tensors of StructureAwareDataset.collate_fn on the device of the batch.
+		"""
+		return {key: self.ragged_tensors[key].assemble(value) if key in self.ragged_tensors else value for key, value in self.tensors.items()}
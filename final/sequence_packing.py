@@ -0,0 +1,135 @@
+from structure_aware_dataset import StructureAwareDataset, build_length_attn_mask
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset
+
+# keys of the samples that are concatenated along their first dimension when samples are packed
+CONCAT_KEYS = ['code_token_ids', 'text_token_ids', 'lr_paths_len', 'dfg_node_mask', 'labels', 'loss_mask']
+LEN_SUM_KEYS = ['code_token_lens', 'text_token_lens']
+# attention of the text tokens to the AST leaves, DFG nodes and code tokens of their own sample
+TEXT_ATTN_KEYS = {'attn_text_ast': 'lr_paths_len', 'attn_text_dfg': 'dfg_node_mask', 'attn_text_code': 'code_token_ids'}
+
+
+def pack_lengths(lengths, max_len, seed=0):
+	"""
+	Groups the samples with 'lengths' into packs of at most 'max_len' positions via best-fit decreasing.
+	Samples longer than 'max_len' get a pack of their own. Ties are broken randomly by 'seed'.
+	"""
+	lengths = np.asarray(lengths, dtype=np.int64)
+	order = np.lexsort((np.random.default_rng(seed).permutation(len(lengths)), -lengths))
+	packs = []
+	packs_by_space = [[] for _ in range(max_len + 1)]  # indices of the packs by their remaining space
+	for idx in order:
+		length = int(lengths[idx])
+		space = next((space for space in range(length, max_len + 1) if packs_by_space[space]), None) if length <= max_len else None
+		if space is None:
+			packs.append([idx])
+			if length <= max_len:
+				packs_by_space[max_len - length].append(len(packs) - 1)
+			continue
+
+		pack = packs_by_space[space].pop()
+		packs[pack].append(idx)
+		packs_by_space[space - length].append(pack)
+
+	return [np.array(pack, dtype=np.int64) for pack in packs]
+
+
+def block_diag(matrices, fill_value, shape=None):
+	# places the matrices along the diagonal of a matrix filled with 'fill_value'
+	num_rows = sum(matrix.size(0) for matrix in matrices)
+	num_cols = sum(matrix.size(1) for matrix in matrices)
+	diag = torch.full(shape or (num_rows, num_cols), fill_value, dtype=matrices[0].dtype)
+	row = col = 0
+	for matrix in matrices:
+		diag[row:row + matrix.size(0), col:col + matrix.size(1)] = matrix
+		row += matrix.size(0)
+		col += matrix.size(1)
+
+	return diag
+
+
+def pack_samples(samples, padding_value, pad_tok_id_ast, length_attn_masks):
+	"""
+	Packs samples of a StructureAwareDataset into one sample with the blocks AST leaves | DFG nodes | code tokens (| text tokens)
+	of all samples. The attention masks become block diagonal, such that the samples cannot attend to each other.
+	The masks that only depend on the block sizes are built for each sample, see StructureAwareDataset.get_length_attn_masks.
+	"""
+	packed = {}
+	for key in samples[0]:
+		values = [sample[key] for sample in samples]
+		if key in CONCAT_KEYS:
+			packed[key] = torch.cat(values)
+		elif key in LEN_SUM_KEYS:
+			packed[key] = torch.stack(values).sum()
+		elif key == 'lr_paths_types':
+			max_path_len = max(value.size(1) for value in values)
+			packed[key] = torch.cat([F.pad(value, (0, max_path_len - value.size(1)), value=pad_tok_id_ast) for value in values])
+		elif key == 'll_sims':
+			# the similarities of each sample start at the position of its first AST leaf
+			leaf_offsets = np.cumsum([0] + [sample['lr_paths_len'].size(0) for sample in samples])
+			size = max(leaf_offset + value.size(0) for leaf_offset, value in zip(leaf_offsets, values))
+			ll_sims = torch.full((size, size), padding_value, dtype=values[0].dtype)
+			for leaf_offset, value in zip(leaf_offsets, values):
+				ll_sims[leaf_offset:leaf_offset + value.size(0), leaf_offset:leaf_offset + value.size(1)] = value
+			packed[key] = ll_sims
+		else:
+			packed[key] = block_diag(values, fill_value=-1e9)
+
+	for key, (block_key, causal) in length_attn_masks.items():
+		packed[key] = block_diag([build_length_attn_mask(sample[block_key].size(0), causal) for sample in samples], fill_value=-1e9)
+
+	if 'text_token_ids' in packed:
+		for key, col_key in TEXT_ATTN_KEYS.items():
+			packed[key] = block_diag([torch.zeros(sample['text_token_ids'].size(0), sample[col_key].size(0)) for sample in samples],
+									 fill_value=-1e9)
+
+	return packed
+
+
+class PackedStructureAwareDataset(Dataset):
+	"""
+	Packs several samples of a StructureAwareDataset into each row, such that a row has at most 'max_seq_length'
+	positions of AST leaves, DFG nodes, code and text tokens. Relative distances of code and text tokens only depend on
+	their difference, so they are unaffected by packing, and labels and loss masks keep their per-sample first token masked.
+	"""
+
+	def __init__(self, dataset: StructureAwareDataset, max_seq_length, seed=0):
+		super().__init__()
+		self.dataset = dataset
+		self.max_seq_length = max_seq_length
+		self.packs = pack_lengths(sum(dataset.get_sample_lengths().values()), max_seq_length, seed=seed)
+
+	def __len__(self):
+		return len(self.packs)
+
+	def get_sample_lengths(self):
+		# block sizes of each pack
+		return {key: np.array([value[pack].sum() for pack in self.packs], dtype=np.int64) for key, value in self.dataset.get_sample_lengths().items()}
+
+	def get_packing_ratio(self):
+		# fraction of the positions of all rows that hold samples
+		return float(sum(self.dataset.get_sample_lengths().values()).sum()) / (len(self.packs) * self.max_seq_length)
+
+	def __getitem__(self, idx):
+		return self.__getitems__([idx])[0]
+
+	def __getitems__(self, idxs):
+		packs = [self.packs[idx] for idx in idxs]
+		samples = self.dataset.__getitems__(np.concatenate(packs))
+		offsets = np.cumsum([0] + [len(pack) for pack in packs])
+
+		return [pack_samples(samples[offsets[i]:offsets[i + 1]], self.dataset.padding_value, self.dataset.pad_tok_id_ast,
+							 self.dataset.get_length_attn_masks())
+				for i in range(len(packs))]
+
+	def collate_fn(self, batch):
+		return self.dataset.collate_fn(batch)
+
+	def collate_ragged_fn(self, batch):
+		return self.dataset.collate_ragged_fn(batch)
+
+	def collate(self, batch, full):
+		return self.dataset.collate(batch, full)
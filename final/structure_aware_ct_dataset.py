@@ -1,80 +1,54 @@
-import ast
-
-from structure_aware_dataset import StructureAwareDataset
+from structure_aware_dataset import StructureAwareDataset, build_labels_loss_masks, write_blocks
+from code_text_attn_mask import CodeTextAttnMask
 
+import numpy as np
 import torch
 
 
 class StructureAwareCTDataset(StructureAwareDataset):
 
-	def __init__(self, save_dir='../../data/pretraining', split='train') -> None:
-		super().__init__(save_dir=save_dir, task='code_text', split=split)
-
-		self.data['text_tokens'] = (self.data['text_tokens'].apply(lambda x: list(map(int, x.split(',')))).
-									apply(lambda x: torch.tensor(x)))
-
-		self.data['text_tokens_rel_pos_ids'] = (self.data['text_tokens_rel_pos_ids'].apply(ast.literal_eval).
-												apply(lambda x: torch.tensor(x)))
-
-		self.data['attn_text_tokens'] = self.data['attn_text_tokens'].apply(ast.literal_eval).apply(lambda x: torch.tensor(x))
+	def __init__(self, save_dir='../../data/pretraining', split='train', rebuild_cache=False) -> None:
+		super().__init__(attn_mask_builder=CodeTextAttnMask(), save_dir=save_dir, task='code_text', split=split,
+						 rebuild_cache=rebuild_cache)
 
-		self.data['attn_code_text'] = self.data['attn_code_text'].apply(ast.literal_eval).apply(lambda x: torch.tensor(x))
+	def __getitems__(self, idxs):
+		samples = super().__getitems__(idxs)
 
-		self.data['attn_ast_text'] = self.data['attn_ast_text'].apply(ast.literal_eval).apply(lambda x: torch.tensor(x))
+		idxs = np.asarray(idxs, dtype=np.int64)
+		text_tokens = self.get_int_tensors('text_tokens', idxs)
+		labels, loss_masks = build_labels_loss_masks(text_tokens, self.padding_value)
 
-		self.data['attn_dfg_text'] = self.data['attn_dfg_text'].apply(ast.literal_eval).apply(lambda x: torch.tensor(x))
+		for i, sample in enumerate(samples):
+			sample['text_token_ids'] = text_tokens[i]
+			sample['text_token_lens'] = torch.tensor(text_tokens[i].size(0))
+			sample['labels'] = labels[i]
+			sample['loss_mask'] = loss_masks[i]
 
-	def __getitem__(self, idx):
-		batch = super().__getitem__(idx)
+		return samples
 
-		text_tokens = self.data.iloc[idx]['text_tokens']
-		labels = torch.cat([torch.tensor([self.padding_value]), text_tokens[1:]])
-		loss_mask = torch.cat([torch.tensor([0]), torch.ones(len(text_tokens[:-1]))])
-
-		batch['text_token_ids'] = text_tokens
-		batch['text_token_rel_pos_ids'] = self.data.iloc[idx]['text_tokens_rel_pos_ids']
-		batch['attn_text_tokens'] = self.data.iloc[idx]['attn_text_tokens']
-		batch['attn_code_text'] = self.data.iloc[idx]['attn_code_text']
-		batch['attn_ast_text'] = self.data.iloc[idx]['attn_ast_text']
-		batch['attn_dfg_text'] = self.data.iloc[idx]['attn_dfg_text']
-		batch['labels'] = labels
-		batch['loss_mask'] = loss_mask
-
-		return batch
-
-	def get_key_not_in(self):
-		return ['code_token_ids', 'text_token_ids', 'dfg_node_mask', 'lr_paths_len', 'labels', 'loss_mask']
+	def get_block_keys(self):
+		return ['lr_paths_len', 'dfg_node_mask', 'code_token_ids', 'text_token_ids']
 
 	def get_attn_keys(self):
-		return ['attn_code_tokens', 'attn_text_tokens', 'attn_ast_leaves', 'attn_dfg_edges', 'attn_code_ast',
-				'attn_code_dfg', 'attn_code_text', 'attn_ast_text', 'attn_dfg_text']
-
-	def get_labels_loss_pad_len(self, batch_dict):
-		return batch_dict['dfg_node_mask'][0].size(0) + batch_dict['lr_paths_len'][0].size(0) + batch_dict['code_token_ids'][0].size(0)
-
-	def build_attn_bias(self, batch_dict, first_col_matrix, second_col_matrix, third_col_matrix):
-		# individual padded attention masks
-		attn_text_tokens = batch_dict['attn_text_tokens']
-		attn_code_text = batch_dict['attn_code_text']
-		attn_ast_text = batch_dict['attn_ast_text']
-		attn_dfg_text = batch_dict['attn_dfg_text']
-
-		# Compute transpose
-		attn_code_text_T_shape = attn_code_text.transpose(1, 2).shape
-		attn_code_text_T = torch.full(attn_code_text_T_shape, fill_value=0)
-
-		attn_ast_text_T_shape = attn_ast_text.transpose(1, 2).shape
-		attn_ast_text_T = torch.full(attn_ast_text_T_shape, fill_value=0)
-
-		attn_dfg_text_T_shape = attn_dfg_text.transpose(1, 2).shape
-		attn_dfg_text_T = torch.full(attn_dfg_text_T_shape, fill_value=0)
-
-		# Build block matrices column-wise
-		first_col_matrix = torch.cat((first_col_matrix, attn_ast_text_T), dim=1)
-		second_col_matrix = torch.cat((second_col_matrix, attn_dfg_text_T), dim=1)
-		third_col_matrix = torch.cat((third_col_matrix, attn_code_text_T), dim=1)
-		fourth_col_matrix = torch.cat((attn_ast_text, attn_dfg_text, attn_code_text, attn_text_tokens), dim=1)
-
-		attn_bias = torch.cat((first_col_matrix, second_col_matrix, third_col_matrix, fourth_col_matrix), dim=2)
-
-		return attn_bias
+		return ['attn_code_tokens', 'attn_text_tokens', 'attn_ast_leaves', 'attn_dfg_edges', 'attn_code_ast', 'attn_code_dfg',
+				'attn_text_ast', 'attn_text_dfg', 'attn_text_code']  # only for packed samples, see sequence_packing
+
+	def get_length_attn_masks(self):
+		return {'attn_ast_leaves': ('lr_paths_len', False), 'attn_code_tokens': ('code_token_ids', False),
+				'attn_text_tokens': ('text_token_ids', True)}
+
+	def get_labels_loss_pad_len(self, block_sizes):
+		return block_sizes['dfg_node_mask'] + block_sizes['lr_paths_len'] + block_sizes['code_token_ids']
+
+	def build_attn_bias(self, attn_bias, batch, block_offsets):
+		# AST leaves, DFG nodes and code tokens do not attend to the text tokens, i.e. their blocks keep the mask value
+		super().build_attn_bias(attn_bias, batch, block_offsets)
+		ast, dfg, code, text = (block_offsets[key] for key in self.get_block_keys())
+
+		if 'attn_text_code' in batch[0]:
+			# text tokens of packed samples only attend to their own sample
+			write_blocks(attn_bias, [sample['attn_text_ast'] for sample in batch], text, ast)
+			write_blocks(attn_bias, [sample['attn_text_dfg'] for sample in batch], text, dfg)
+			write_blocks(attn_bias, [sample['attn_text_code'] for sample in batch], text, code)
+		else:
+			attn_bias[:, text:, :text] = 0
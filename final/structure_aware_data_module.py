@@ -1,11 +1,17 @@
 from typing import Optional, List, TYPE_CHECKING
 
 from structure_aware_dataset import StructureAwareDataset
+from structure_aware_data_sampler import StructureAwareDataSampler
+from length_bucketed_batch_sampler import LengthBucketedBatchSampler
+from sequence_packing import PackedStructureAwareDataset
+from batch_prefetcher import BatchPrefetcher, get_samples
 
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, IterableDataset
 from lightning.pytorch.utilities.types import EVAL_DATALOADERS, TRAIN_DATALOADERS
 
 from nemo.collections.llm.gpt.data.mock import MockDataModule
+from nemo.lightning.data import WrappedDataLoader
+from nemo.utils import logging
 
 if TYPE_CHECKING:
 	from nemo.collections.common.tokenizers.tokenizer_spec import TokenizerSpec
@@ -32,6 +38,12 @@ class StructureAwareDataModule(MockDataModule):
 			create_attention_mask: bool = False,
 			vocab_file: Optional[str] = None,
 			merges_file: Optional[str] = None,
+			length_bucketing: bool = False,
+			bucket_size: Optional[int] = None,
+			seed: int = 0,
+			pack_sequences: bool = False,
+			ragged_batches: bool = False,
+			num_prefetch_batches: int = 0,
 	):
 		super().__init__(
 			seq_length=seq_length,
@@ -49,36 +61,82 @@ class StructureAwareDataModule(MockDataModule):
 			vocab_file=vocab_file,
 			merges_file=merges_file,
 		)
+		# keeps the DataLoaders that split the samples among the data-parallel ranks themselves
+		self.data_sampler = StructureAwareDataSampler(
+			seq_len=self.seq_length,
+			micro_batch_size=micro_batch_size,
+			global_batch_size=global_batch_size,
+			rampup_batch_size=rampup_batch_size,
+		)
 		self.train_dataset = train_dataset
 		self.validation_dataset = validation_dataset
 		self.test_dataset = test_dataset
+		# batches of samples with similar structural lengths, see LengthBucketedBatchSampler
+		self.length_bucketing = length_bucketing
+		self.bucket_size = bucket_size
+		self.seed = seed
+		# several samples per row of at most seq_length positions, see PackedStructureAwareDataset
+		self.pack_sequences = pack_sequences
+		# batches are assembled on the device from the entries of the samples, see RaggedBatch
+		self.ragged_batches = ragged_batches
+		# batches are collated on a background thread into reusable pinned buffers and copied to the device ahead of time,
+		# see BatchPrefetcher, the DataLoader workers then only fetch the samples
+		self.num_prefetch_batches = num_prefetch_batches
 
 	def setup(self, stage: str = "") -> None:
 		self._train_ds = self.train_dataset
 		self._validation_ds = self.validation_dataset
 		self._test_ds = self.test_dataset
+		if self.pack_sequences:
+			self._train_ds = PackedStructureAwareDataset(self._train_ds, self.seq_length, seed=self.seed)
+			self._validation_ds = PackedStructureAwareDataset(self._validation_ds, self.seq_length, seed=self.seed)
+			self._test_ds = PackedStructureAwareDataset(self._test_ds, self.seq_length, seed=self.seed)
 
 	def train_dataloader(self) -> TRAIN_DATALOADERS:
 		if not hasattr(self, "_train_ds"):
 			self.setup()
-		return self._create_dataloader(self._train_ds)
+		return self._create_dataloader(self._train_ds, mode='train')
 
 	def val_dataloader(self) -> EVAL_DATALOADERS:
 		if not hasattr(self, "_validation_ds"):
 			self.setup()
-		return self._create_dataloader(self._validation_ds)
+		return self._create_dataloader(self._validation_ds, mode='validation')
 
 	def test_dataloader(self) -> EVAL_DATALOADERS:
 		if not hasattr(self, "_test_ds"):
 			self.setup()
-		return self._create_dataloader(self._test_ds)
+		return self._create_dataloader(self._test_ds, mode='test')
 
-	def _create_dataloader(self, dataset, **kwargs) -> DataLoader:
-		return DataLoader(
-			dataset,
+	def _create_dataloader(self, dataset, mode='train', **kwargs) -> DataLoader:
+		persistent_workers = self.persistent_workers
+		if isinstance(dataset, IterableDataset):
+			# batches of a streaming dataset are formed within each worker, a batch sampler cannot be applied
+			kwargs.setdefault('batch_size', self.micro_batch_size)
+			# the workers keep their copy of the dataset, which advances its epoch on every iteration
+			persistent_workers = persistent_workers or self.num_workers > 0
+		elif self.length_bucketing:
+			kwargs.setdefault('batch_sampler', LengthBucketedBatchSampler(dataset.get_sample_lengths(), batch_size=self.micro_batch_size,
+																		  bucket_size=self.bucket_size, seed=self.seed))
+			padding_stats = kwargs['batch_sampler'].get_padding_stats()
+			logging.info(
+				f"Length bucketing of the {mode} samples: {padding_stats['token_padding_ratio']:.1%} of the tokens and"
+				f" {padding_stats['attn_bias_padding_ratio']:.1%} of the attention bias are padding."
+			)
+		collate_fn = dataset.collate_ragged_fn if self.ragged_batches else dataset.collate_fn
+		if self.num_prefetch_batches > 0 and not self.ragged_batches:
+			collate_fn = get_samples
+		# the mode tells the data sampler whether the consumed samples of a resumed training apply
+		dataloader = WrappedDataLoader(
+			mode=mode,
+			dataset=dataset,
 			num_workers=self.num_workers,
-			pin_memory=self.pin_memory,
-			persistent_workers=self.persistent_workers,
-			collate_fn=dataset.collate_fn,
+			pin_memory=self.pin_memory and self.num_prefetch_batches == 0,
+			persistent_workers=persistent_workers,
+			collate_fn=collate_fn,
 			**kwargs,
 		)
+		if self.num_prefetch_batches > 0:
+			# ragged batches are small, they are collated by the workers and only copied into the buffers
+			return BatchPrefetcher(dataloader, collate_fn=None if self.ragged_batches else dataset.collate,
+								   num_prefetch_batches=self.num_prefetch_batches)
+		return dataloader
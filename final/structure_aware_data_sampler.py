@@ -0,0 +1,30 @@
+from length_bucketed_batch_sampler import LengthBucketedBatchSampler
+from batch_prefetcher import BatchPrefetcher
+
+from torch.utils.data import DataLoader, IterableDataset
+
+from nemo.lightning.pytorch.plugins.data_sampler import MegatronDataSampler
+
+
+class StructureAwareDataSampler(MegatronDataSampler):
+	"""
+	MegatronDataSampler that keeps the DataLoaders which already split the samples among the data-parallel ranks.
+	MegatronStrategy rebuilds every DataLoader with a Megatron batch sampler over len(dataset) indices, see
+	MegatronDataSampler.transform_dataloader, which does not apply to a StructureAwareIterableDataset and would replace
+	a LengthBucketedBatchSampler. The DataLoader of a BatchPrefetcher is transformed and wrapped again.
+	"""
+
+	def transform_dataloader(self, dataloader: DataLoader, consumed_samples: int = 0) -> DataLoader:
+		if isinstance(dataloader, BatchPrefetcher):
+			# its DataLoader yields uncollated samples, the prefetcher collates them
+			return dataloader.replace_loader(self.transform_dataloader(dataloader.loader, consumed_samples=consumed_samples))
+		if isinstance(dataloader.dataset, IterableDataset):
+			# each data-parallel rank streams its own shards, see StructureAwareIterableDataset
+			return dataloader
+		if isinstance(dataloader.batch_sampler, LengthBucketedBatchSampler):
+			# each data-parallel rank takes its part of every global batch, the consumed samples are skipped on resumption
+			if getattr(dataloader, 'mode', 'train') == 'train':
+				dataloader.batch_sampler.set_consumed_samples(self.init_consumed_samples)
+			return dataloader
+
+		return super().transform_dataloader(dataloader, consumed_samples=consumed_samples)
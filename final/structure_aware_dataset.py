@@ -1,78 +1,117 @@
 import os
-import ast
 import json
 from abc import ABC, abstractmethod
 
 from data_handler import DataHandler, PAD_TOK_ID_DFG
+from attn_mask import AttnMask
+from flat_array_store import load_flat_array_store, FLAT_STORE_DIRNAME
+from ragged_batch import RaggedBatch, RaggedTensor
 
+import numpy as np
 import torch
 from torch.utils.data import Dataset
-import torch.nn.functional as F
-from torch.nn.utils.rnn import pad_sequence
+
+# per-sample sequence lengths from which the relative distances are derived on device
+LEN_KEYS = ['code_token_lens', 'text_token_lens']
 
 
 class StructureAwareDataset(ABC, Dataset):
 
-	def __init__(self, save_dir='../../data/pretraining', task='code_completion', split='train') -> None:
+	def __init__(self, attn_mask_builder: AttnMask, save_dir='../../data/pretraining', task='code_completion', split='train',
+				 rebuild_cache=False) -> None:
 		super().__init__()
-		self.data_handler = DataHandler(save_dir=os.path.join(save_dir, task))
+		self.attn_mask_builder = attn_mask_builder
+		self.data_handler = DataHandler(save_dir=os.path.join(save_dir, task), attn_mask_builder=attn_mask_builder)
 		self.padding_value = self.data_handler.tokenizer.eos_token_id
-		self.data = self.data_handler.get_concat_stored_data(split=split)
-		with open(os.path.join(save_dir, task, 'metadata.json'), 'r') as f_metadata:
-			metadata = json.load(f_metadata)
+		split_dir = os.path.join(save_dir, task, split)
+		manifest = self.data_handler.load_manifest(split_dir)
+		if manifest is not None:
+			metadata = manifest['metadata']
+		else:
+			with open(os.path.join(save_dir, task, 'metadata.json'), 'r') as f_metadata:
+				metadata = json.load(f_metadata)
 		self.pad_tok_id_ast = metadata['num_ast_node_types']
 
-		self.data['code_tokens'] = (self.data['code_tokens'].apply(lambda x: list(map(int, x.split(',')))).
-									apply(lambda x: torch.tensor(x)))
-
-		self.data['code_tokens_rel_pos_ids'] = (self.data['code_tokens_rel_pos_ids'].apply(ast.literal_eval).
-												apply(lambda x: torch.tensor(x)))
-
-		self.data['ll_sims'] = (self.data['ll_sims'].
-								apply(lambda x: [list(map(float, sublist.split(','))) for sublist in x.split(';')]).
-								apply(pad_inner_lists, padding_value=self.padding_value, padding_side='left'))
-
-		self.data['lr_paths_types'] = (self.data['lr_paths_types'].apply(lambda x: ast.literal_eval(x)).
-									   apply(pad_inner_lists, padding_value=self.pad_tok_id_ast))
-
-		self.data['lr_paths_len'] = (self.data['lr_paths_len'].apply(lambda x: list(map(int, x.split(',')))).
-									 apply(lambda x: torch.tensor(x)))
-
-		self.data['dfg_node_mask'] = (self.data['dfg_node_mask'].apply(lambda x: list(map(int, x.split(',')))).
-									  apply(lambda x: torch.tensor(x)))
-
-		self.data['attn_code_tokens'] = self.data['attn_code_tokens'].apply(ast.literal_eval).apply(lambda x: torch.tensor(x))
+		# decoded samples are cached in memory-mapped flat buffers next to the shards, written on the first load
+		# and reused as long as the shards and the decoding do not change, rebuild_cache=True forces a rebuild
+		self.store = load_flat_array_store(
+			self.data_handler.iter_shard_paths(split_dir, use_manifest=True),
+			os.path.join(split_dir, FLAT_STORE_DIRNAME),
+			checksums={shard['filename']: shard['sha256'] for shard in manifest['shards']} if manifest is not None else None,
+			padded_fields={'ll_sims': (self.padding_value, 'left'), 'lr_paths_types': (self.pad_tok_id_ast, 'right')},
+			rebuild=rebuild_cache,
+		)
 
-		self.data['attn_ast_leaves'] = self.data['attn_ast_leaves'].apply(ast.literal_eval).apply(lambda x: torch.tensor(x))
+	def get_int_tensors(self, field, idxs):
+		offsets, values = self.store.get_lists(field, idxs)
 
-		self.data['attn_dfg_edges'] = self.data['attn_dfg_edges'].apply(ast.literal_eval).apply(lambda x: torch.tensor(x))
+		return torch.from_numpy(values.astype(np.int64)).split(np.diff(offsets).tolist())
 
-		self.data['attn_code_ast'] = self.data['attn_code_ast'].apply(ast.literal_eval).apply(lambda x: torch.tensor(x))
-
-		self.data['attn_code_dfg'] = self.data['attn_code_dfg'].apply(ast.literal_eval).apply(lambda x: torch.tensor(x))
+	def get_matrix_tensors(self, field, idxs, dtype=None):
+		return [torch.from_numpy(matrix if dtype is None else matrix.astype(dtype)) for matrix in self.store.get_matrices(field, idxs)]
 
 	def __len__(self) -> int:
-		return len(self.data)
-
-	def __getitem__(self, idx):
-		batch = {
-			'code_token_ids': self.data.iloc[idx]['code_tokens'],
-			'code_token_rel_pos_ids': self.data.iloc[idx]['code_tokens_rel_pos_ids'],
-			'll_sims': self.data.iloc[idx]['ll_sims'],
-			'lr_paths_types': self.data.iloc[idx]['lr_paths_types'],
-			'lr_paths_len': self.data.iloc[idx]['lr_paths_len'],
-			'dfg_node_mask': self.data.iloc[idx]['dfg_node_mask'],
-			'attn_code_tokens': self.data.iloc[idx]['attn_code_tokens'],
-			'attn_ast_leaves': self.data.iloc[idx]['attn_ast_leaves'],
-			'attn_dfg_edges': self.data.iloc[idx]['attn_dfg_edges'],
-			'attn_code_ast': self.data.iloc[idx]['attn_code_ast'],
-			'attn_code_dfg': self.data.iloc[idx]['attn_code_dfg'],
+		return len(self.store)
+
+	def get_sample_lengths(self):
+		"""
+		Returns the number of AST leaves, DFG nodes, code tokens and, if present, text tokens of every sample,
+		i.e. the sizes of the blocks of the structure-aware sequence.
+		"""
+		sample_lengths = {
+			'num_ast_leaves': self.store.get_list_lengths('lr_paths_len'),
+			'num_dfg_nodes': self.store.get_list_lengths('dfg_node_mask'),
+			'num_code_tokens': self.store.get_list_lengths('code_tokens'),
 		}
+		if self.store.has_field('text_tokens'):
+			sample_lengths['num_text_tokens'] = self.store.get_list_lengths('text_tokens')
+
+		return sample_lengths
 
-		return batch
+	def __getitem__(self, idx):
+		return self.__getitems__([idx])[0]
+
+	def __getitems__(self, idxs):
+		"""
+		Fetches the samples 'idxs' with one gather per field. The DataLoader calls it with the indices of a whole batch.
+		"""
+		idxs = np.asarray(idxs, dtype=np.int64)
+		code_tokens = self.get_int_tensors('code_tokens', idxs)
+		lr_paths_len = self.get_int_tensors('lr_paths_len', idxs)
+		dfg_node_mask = self.get_int_tensors('dfg_node_mask', idxs)
+		ll_sims = self.get_matrix_tensors('ll_sims', idxs)
+		lr_paths_types = self.get_matrix_tensors('lr_paths_types', idxs, dtype=np.int64)
+		ast_leaf_code_token_idxs = self.store.get_nested('ast_leaf_code_token_idxs', idxs)
+		dfg_node_code_token_idxs = self.store.get_nested('dfg_node_code_token_idxs', idxs)
+		dfg_edges = self.store.get_edges(idxs)
+
+		samples = []
+		for i in range(len(idxs)):
+			sparse_attn_masks = self.attn_mask_builder.build_sparse_attention_masks(
+				ast_leaf_code_token_idxs=ast_leaf_code_token_idxs[i],
+				dfg_node_code_token_idxs=dfg_node_code_token_idxs[i],
+				dfg_edges=dfg_edges[i],
+				num_code_tokens=code_tokens[i].size(0),
+				num_ast_leaves=lr_paths_len[i].size(0),
+				num_dfg_nodes=dfg_node_mask[i].size(0),
+			)
+
+			samples.append({
+				'code_token_ids': code_tokens[i],
+				'code_token_lens': torch.tensor(code_tokens[i].size(0)),
+				'll_sims': ll_sims[i],
+				'lr_paths_types': lr_paths_types[i],
+				'lr_paths_len': lr_paths_len[i],
+				'dfg_node_mask': dfg_node_mask[i],
+				'attn_dfg_edges': torch.from_numpy(sparse_attn_masks['attn_dfg_edges']),
+				'attn_code_ast': torch.from_numpy(sparse_attn_masks['attn_code_ast']),
+				'attn_code_dfg': torch.from_numpy(sparse_attn_masks['attn_code_dfg']),
+			})
+
+		return samples
 
 	@abstractmethod
-	def get_key_not_in(self):
+	def get_block_keys(self):
 		pass
 
 	@abstractmethod
@@ -80,110 +119,138 @@ class StructureAwareDataset(ABC, Dataset):
 		pass
 
 	@abstractmethod
-	def get_labels_loss_pad_len(self, batch_dict):
+	def get_length_attn_masks(self):
+		"""
+		Returns the attention masks of the blocks that only depend on the block sizes, which are built at collate time
+		instead of being stored. Maps the key of each mask to its block key and whether the block attends causally or fully.
+		"""
 		pass
 
 	@abstractmethod
-	def build_attn_bias(self, batch_dict, first_col_matrix, second_col_matrix, third_col_matrix):
+	def get_labels_loss_pad_len(self, block_sizes):
 		pass
 
+	def build_attn_bias(self, attn_bias, batch, block_offsets):
+		"""
+		Writes the attention masks of the samples into their blocks of 'attn_bias', which is filled with the mask value.
+		"""
+		for key, (block_key, causal) in self.get_length_attn_masks().items():
+			block = block_offsets[block_key]
+			if key in batch[0]:
+				# packed samples hold block diagonal masks, see sequence_packing
+				write_blocks(attn_bias, [sample[key] for sample in batch], block, block)
+			else:
+				write_length_blocks(attn_bias, [sample[block_key].size(0) for sample in batch], block, causal)
+
+		ast, dfg, code = block_offsets['lr_paths_len'], block_offsets['dfg_node_mask'], block_offsets['code_token_ids']
+		write_blocks(attn_bias, [sample['attn_dfg_edges'] for sample in batch], dfg, dfg)
+		attn_code_ast = [sample['attn_code_ast'] for sample in batch]
+		write_blocks(attn_bias, attn_code_ast, code, ast)
+		write_blocks(attn_bias, attn_code_ast, ast, code, transpose=True)
+		attn_code_dfg = [sample['attn_code_dfg'] for sample in batch]
+		write_blocks(attn_bias, attn_code_dfg, code, dfg)
+		write_blocks(attn_bias, attn_code_dfg, dfg, code, transpose=True)
+
 	def collate_fn(self, batch):
-		# Initialize a dictionary to store the batch data
+		"""
+		Collates the samples into tensors that are allocated once with their final batch dimensions and written by slice assignment.
+		The attention bias is allocated in bfloat16 and filled with the mask value, such that only the blocks of the samples are written.
+		"""
+		return self.collate(batch, full=torch.full)
+
+	def collate_ragged_fn(self, batch):
+		"""
+		Collates the samples into a RaggedBatch, which is assembled into the batch of collate_fn on the device.
+		"""
+		return RaggedBatch(self.collate(batch, full=RaggedTensor))
+
+	def collate(self, batch, full):
+		# 'full' allocates the tensors of the batch, see torch.full and RaggedTensor
+		# every block of the structure-aware sequence is padded to its largest size within the batch
+		block_sizes = {key: max(sample[key].size(0) for sample in batch) for key in self.get_block_keys()}
+		block_offsets = dict(zip(block_sizes, np.cumsum([0] + list(block_sizes.values())).tolist()))
+
 		batch_dict = {}
 		for key in batch[0].keys():
-			batch_dict[key] = [sample[key] for sample in batch]
-			if key not in self.get_key_not_in():
-				if key == 'lr_paths_types':
-					batch_dict[key] = pad_2d_tensors(batch_dict[key], padding_value=self.pad_tok_id_ast)
-				elif key in self.get_attn_keys():
-					batch_dict[key] = pad_2d_tensors(batch_dict[key], padding_value=-1e9)
-				else:
-					batch_dict[key] = pad_2d_tensors(batch_dict[key], padding_value=self.padding_value)
-
-			padding_value = self.padding_value
-			if key == 'dfg_node_mask':
-				padding_value = PAD_TOK_ID_DFG
 			if key in self.get_attn_keys():
-				padding_value = -1e9
-
-			if key in ['labels', 'loss_mask']:
-				batch_dict[key] = pad_sequence(batch_dict[key], batch_first=True, padding_value=padding_value, padding_side='left')
+				continue
+
+			values = [sample[key] for sample in batch]
+			if key in LEN_KEYS:
+				batch_dict[key] = torch.stack(values)
+			elif key in ['labels', 'loss_mask']:
+				# left-padded to the longest labels and preceded by the blocks before them
+				pad_len = self.get_labels_loss_pad_len(block_sizes)
+				batch_dict[key] = pad_tensors(values, self.padding_value, padding_side='left',
+											  shape=[pad_len + max(value.size(0) for value in values)], full=full)
+				batch_dict[key][:, :pad_len] = 0
+			elif key == 'lr_paths_types':
+				batch_dict[key] = pad_tensors(values, self.pad_tok_id_ast, full=full)
+			elif key == 'dfg_node_mask':
+				batch_dict[key] = pad_tensors(values, PAD_TOK_ID_DFG, full=full)
 			else:
-				batch_dict[key] = pad_sequence(batch_dict[key], batch_first=True, padding_value=padding_value)
-
-		pad_len = self.get_labels_loss_pad_len(batch_dict)
-		batch_dict = pad_labels_loss_mask(batch_dict, pad_len)
-
-		# individual padded attention masks
-		attn_code_tokens = batch_dict['attn_code_tokens']
-		attn_ast_leaves = batch_dict['attn_ast_leaves']
-		attn_dfg_edges = batch_dict['attn_dfg_edges']
-		attn_code_ast = batch_dict['attn_code_ast']
-		attn_code_dfg = batch_dict['attn_code_dfg']
-
-		# Compute transpose
-		attn_code_ast_T = attn_code_ast.transpose(1, 2)
-		attn_code_dfg_T = attn_code_dfg.transpose(1, 2)
-
-		# Compute null matrix for attention between AST leaves and DFG edges
-		attn_ast_dfg = torch.full((attn_ast_leaves.size(0), attn_ast_leaves.size(1), attn_dfg_edges.size(2)), fill_value=-1e9)
-		attn_ast_dfg_T = attn_ast_dfg.transpose(1, 2)
-
-		# Build block matrices column-wise
-		first_col_matrix = torch.cat((attn_ast_leaves, attn_ast_dfg_T, attn_code_ast), dim=1)
-		second_col_matrix = torch.cat((attn_ast_dfg, attn_dfg_edges, attn_code_dfg), dim=1)
-		third_col_matrix = torch.cat((attn_code_ast_T, attn_code_dfg_T, attn_code_tokens), dim=1)
-
-		attn_bias = self.build_attn_bias(batch_dict, first_col_matrix, second_col_matrix, third_col_matrix)
+				batch_dict[key] = pad_tensors(values, self.padding_value, full=full)
 
-		batch_dict['attention_bias'] = attn_bias.unsqueeze(1).bfloat16() # broadcast across all attention heads
-
-		keys_to_remove = self.get_attn_keys()
-		for key in keys_to_remove:
-			del batch_dict[key]
+		seq_len = sum(block_sizes.values())
+		attn_bias = full((len(batch), seq_len, seq_len), -1e9, dtype=torch.bfloat16)
+		self.build_attn_bias(attn_bias, batch, block_offsets)
+		batch_dict['attention_bias'] = attn_bias.unsqueeze(1)  # broadcast across all attention heads
 
 		return batch_dict
 
 
-def pad_labels_loss_mask(batch_dict, pad_len):
-	labels = batch_dict['labels']
-	loss_mask = batch_dict['loss_mask']
+def build_labels_loss_masks(token_ids, padding_value):
+	"""
+	Labels are the token ids of each sample with the first one replaced by 'padding_value', the loss masks exclude the first token.
+	Both are built for all samples at once.
+	"""
+	lengths = [tokens.size(0) for tokens in token_ids]
+	starts = torch.tensor(np.cumsum([0] + lengths[:-1]), dtype=torch.int64)
+	labels = torch.cat(token_ids)
+	labels[starts] = padding_value
+	loss_mask = torch.ones(labels.size(0))
+	loss_mask[starts] = 0
+
+	return labels.split(lengths), loss_mask.split(lengths)
+
+
+def pad_tensors(tensors, padding_value, padding_side='right', shape=None, full=torch.full):
+	"""
+	Stacks 1D or 2D tensors into one tensor of their largest size in every dimension, or of 'shape', filled with 'padding_value'.
+	With padding_side='left', 1D tensors are aligned to the end.
+	"""
+	shape = shape or [max(tensor.size(dim) for tensor in tensors) for dim in range(tensors[0].dim())]
+	padded = full((len(tensors), *shape), padding_value, dtype=tensors[0].dtype)
+	for i, tensor in enumerate(tensors):
+		if padding_side == 'left':
+			padded[i, shape[0] - tensor.size(0):] = tensor
+		else:
+			padded[(i, *(slice(0, size) for size in tensor.shape))] = tensor
 
-	padded_labels = []
-	padded_loss_mask = []
+	return padded
 
-	for label, mask in zip(labels, loss_mask):
-		padded_label = F.pad(label, (pad_len, 0), value=0)
-		padded_mask = F.pad(mask, (pad_len, 0), value=0)
-		padded_labels.append(padded_label)
-		padded_loss_mask.append(padded_mask)
 
-	batch_dict['labels'] = torch.stack(padded_labels)
-	batch_dict['loss_mask'] = torch.stack(padded_loss_mask)
+def write_blocks(attn_bias, matrices, row, col, transpose=False):
+	# writes the matrix of each sample into its block of 'attn_bias' that starts at position (row, col)
+	for i, matrix in enumerate(matrices):
+		if transpose:
+			matrix = matrix.T
+		attn_bias[i, row:row + matrix.size(0), col:col + matrix.size(1)] = matrix
 
-	return batch_dict
 
+def build_length_attn_mask(size, causal):
+	# mask of a block of 'size' positions that attend to all previous positions (causal=True) or to all positions
+	if causal:
+		return torch.triu(torch.full((size, size), -1e9), diagonal=1)
 
-def pad_2d_tensors(tensor_list, padding_value, padding_side='right'):
-	max_rows = max(tensor.size(0) for tensor in tensor_list)
-	max_cols = max(tensor.size(1) for tensor in tensor_list)
+	return torch.zeros((size, size))
 
-	padded_tensors = []
-	for tensor in tensor_list:
-		rows_to_pad = max_rows - tensor.size(0)
-		cols_to_pad = max_cols - tensor.size(1)
 
-		if padding_side == 'right':
-			padded_tensor = torch.nn.functional.pad(tensor, (0, cols_to_pad, 0, rows_to_pad), mode='constant', value=padding_value)
+def write_length_blocks(attn_bias, sizes, offset, causal):
+	# writes the mask of a block of each sample's size into 'attn_bias' at position (offset, offset)
+	causal_mask = build_length_attn_mask(max(sizes, default=0), causal=True) if causal else None
+	for i, size in enumerate(sizes):
+		if causal:
+			attn_bias[i, offset:offset + size, offset:offset + size] = causal_mask[:size, :size]
 		else:
-			padded_tensor = torch.nn.functional.pad(tensor, (cols_to_pad, 0, 0, rows_to_pad), mode='constant', value=padding_value)
-
-		padded_tensors.append(padded_tensor)
-
-	return padded_tensors
-
-
-def pad_inner_lists(list_of_lists, padding_value, padding_side='right'):
-	tensors = [torch.tensor(x) for x in list_of_lists]
-
-	return pad_sequence(tensors, batch_first=True, padding_value=padding_value, padding_side=padding_side) if tensors else [torch.tensor(-1)]
+			attn_bias[i, offset:offset + size, offset:offset + size] = 0
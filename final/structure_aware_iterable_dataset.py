@@ -0,0 +1,126 @@
+from structure_aware_dataset import StructureAwareDataset
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+ROW_GROUP_SIZE = 100  # row group size of the shards, see DataHandler.write_shard
+
+
+def get_data_parallel_rank_and_size():
+	# tensor-parallel ranks of Megatron see the same data, so its data-parallel rank is used if it is initialized
+	try:
+		from megatron.core import parallel_state
+		if parallel_state.model_parallel_is_initialized():
+			return parallel_state.get_data_parallel_rank(), parallel_state.get_data_parallel_world_size()
+	except ImportError:
+		pass
+
+	if torch.distributed.is_available() and torch.distributed.is_initialized():
+		return torch.distributed.get_rank(), torch.distributed.get_world_size()
+
+	return 0, 1
+
+
+class StructureAwareIterableDataset(IterableDataset):
+	"""
+	Streams the samples of a StructureAwareDataset, such that each pair of data-parallel rank and DataLoader worker
+	reads its own shards row group by row group and shuffles the samples within a buffer of 'shuffle_buffer_size'.
+	If there are fewer shards than pairs, the row groups are partitioned instead.
+	The order of the shards and the shuffling depend on 'seed' and the epoch, which advances with every iteration over the dataset,
+	such that it is also counted by the copies in persistent DataLoader workers, set_epoch sets the epoch of the next iteration.
+	With equalize=True, every pair yields the same number of samples, such that all ranks take the same number of steps.
+	"""
+
+	def __init__(self, dataset: StructureAwareDataset, shuffle_buffer_size=1000, seed=0, row_group_size=ROW_GROUP_SIZE,
+				 data_parallel_rank=None, data_parallel_size=None, equalize=True):
+		super().__init__()
+		self.dataset = dataset
+		self.shuffle_buffer_size = shuffle_buffer_size
+		self.seed = seed
+		self.row_group_size = row_group_size
+		self.data_parallel_rank = data_parallel_rank
+		self.data_parallel_size = data_parallel_size
+		self.equalize = equalize
+		self.epoch = 0
+		self.num_iterations = 0
+
+	def set_epoch(self, epoch):
+		self.epoch = epoch
+		self.num_iterations = 0
+
+	def get_epoch(self):
+		return self.epoch + self.num_iterations
+
+	def collate_fn(self, batch):
+		return self.dataset.collate_fn(batch)
+
+	def collate_ragged_fn(self, batch):
+		return self.dataset.collate_ragged_fn(batch)
+
+	def collate(self, batch, full):
+		return self.dataset.collate(batch, full)
+
+	def get_row_groups(self, shard_offsets, shard):
+		return [(start, min(start + self.row_group_size, shard_offsets[shard + 1]))
+				for start in range(shard_offsets[shard], shard_offsets[shard + 1], self.row_group_size)]
+
+	def partition_row_groups(self, num_consumers, epoch):
+		"""
+		Returns the row ranges [start, end) that each of the 'num_consumers' pairs reads in 'epoch'.
+		"""
+		shard_offsets = self.dataset.store.get_shard_offsets()
+		shards = np.random.default_rng([self.seed, epoch]).permutation(len(shard_offsets) - 1)
+		if len(shards) >= num_consumers:
+			all_row_groups = [[row_group for shard in shards[consumer::num_consumers] for row_group in self.get_row_groups(shard_offsets, shard)]
+							  for consumer in range(num_consumers)]
+		else:
+			row_groups = [row_group for shard in shards for row_group in self.get_row_groups(shard_offsets, shard)]
+			all_row_groups = [row_groups[consumer::num_consumers] for consumer in range(num_consumers)]
+
+		if self.equalize:
+			num_samples = min(sum(end - start for start, end in row_groups) for row_groups in all_row_groups)
+			all_row_groups = [truncate_row_groups(row_groups, num_samples) for row_groups in all_row_groups]
+
+		return all_row_groups
+
+	def __iter__(self):
+		if self.data_parallel_rank is None or self.data_parallel_size is None:
+			data_parallel_rank, data_parallel_size = get_data_parallel_rank_and_size()
+		else:
+			data_parallel_rank, data_parallel_size = self.data_parallel_rank, self.data_parallel_size
+		worker_info = get_worker_info()
+		worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+		consumer = data_parallel_rank * num_workers + worker_id
+		epoch = self.get_epoch()
+		self.num_iterations += 1
+
+		row_groups = self.partition_row_groups(data_parallel_size * num_workers, epoch)[consumer]
+		rng = np.random.default_rng([self.seed, epoch, consumer])
+		buffer = []
+		for start, end in row_groups:
+			for sample in self.dataset.__getitems__(np.arange(start, end)):
+				buffer.append(sample)
+				if len(buffer) >= self.shuffle_buffer_size:
+					yield pop_random(buffer, rng)
+
+		while buffer:
+			yield pop_random(buffer, rng)
+
+
+def truncate_row_groups(row_groups, num_samples):
+	truncated = []
+	for start, end in row_groups:
+		if num_samples <= 0:
+			break
+		truncated.append((start, min(end, start + num_samples)))
+		num_samples -= end - start
+
+	return truncated
+
+
+def pop_random(buffer, rng):
+	i = rng.integers(len(buffer))
+	buffer[i], buffer[-1] = buffer[-1], buffer[i]
+
+	return buffer.pop()
@@ -13,6 +13,7 @@ from megatron.core.packed_seq_params import PackedSeqParams
 from megatron.core.transformer.spec_utils import ModuleSpec
 
 from structure_aware_transformer_block import StructureAwareTransformerBlock
+from structure_aware_self_attention import get_rel_pos_ids
 
 
 class StructureAwareMCoreGPTModel(MCoreGPTModel):
@@ -92,7 +93,7 @@ class StructureAwareMCoreGPTModel(MCoreGPTModel):
 	def forward(
 			self,
 			code_token_ids: Tensor,
-			code_token_rel_pos_ids: Tensor,
+			code_token_lens: Tensor,
 			ll_sims: Tensor,
 			lr_paths_types: Tensor,
 			lr_paths_len: Tensor,
@@ -100,7 +101,7 @@ class StructureAwareMCoreGPTModel(MCoreGPTModel):
 			attention_bias: Tensor,
 			attention_mask: Tensor,
 			text_token_ids: Tensor = None,
-			text_token_rel_pos_ids: Tensor = None,
+			text_token_lens: Tensor = None,
 			decoder_input: Tensor = None,
 			labels: Tensor = None,
 			inference_params: InferenceParams = None,
@@ -141,6 +142,15 @@ class StructureAwareMCoreGPTModel(MCoreGPTModel):
 			# decoder will get hidden_states from encoder.input_tensor
 			decoder_input = None
 
+		# Relative distances between code/text tokens are derived on device from the sequence lengths
+		code_token_rel_pos_ids = None
+		if code_token_ids is not None and code_token_lens is not None:
+			code_token_rel_pos_ids = get_rel_pos_ids(code_token_lens, code_token_ids.shape[1], self.config.max_code_token_rel_pos)
+
+		text_token_rel_pos_ids = None
+		if text_token_ids is not None and text_token_lens is not None:
+			text_token_rel_pos_ids = get_rel_pos_ids(text_token_lens, text_token_ids.shape[1], self.config.max_code_token_rel_pos)
+
 		# Rotary positional embeddings (embedding is None for PP intermediate devices)
 		rotary_pos_emb = None
 		rotary_pos_cos = None
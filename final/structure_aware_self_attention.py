@@ -8,6 +8,18 @@ from megatron.core.transformer.transformer_config import TransformerConfig
 from megatron.core.models.common.embeddings.language_model_embedding import LanguageModelEmbedding
 
 
+def get_rel_pos_ids(token_lens, seq_len, max_rel_pos):
+	"""
+	Builds the clipped relative distances min(|i - j| + 1, max_rel_pos) between the tokens of each sample on the device of 'token_lens'.
+	Distances to padded positions get the padding distance id of 0.
+	"""
+	positions = torch.arange(seq_len, device=token_lens.device)
+	rel_pos_ids = ((positions.unsqueeze(0) - positions.unsqueeze(1)).abs() + 1).clamp(max=max_rel_pos)
+	is_token = positions.unsqueeze(0) < token_lens.unsqueeze(1)
+
+	return rel_pos_ids.unsqueeze(0) * (is_token.unsqueeze(2) & is_token.unsqueeze(1))
+
+
 class StructureAwareSelfAttention(SelfAttention):
 
 	def __init__(
@@ -30,12 +42,14 @@ class StructureAwareSelfAttention(SelfAttention):
 		config_copy.hidden_size = 1 # scalar embedding
 
 		vocab_size_code_text_rel_pos = config.max_code_token_rel_pos + 1 # padding
+		self.num_code_text_rel_pos = vocab_size_code_text_rel_pos
 		self.code_text_token_rel_pos_embedding = LanguageModelEmbedding(
 			config=config_copy,
 			vocab_size=vocab_size_code_text_rel_pos if vocab_size_code_text_rel_pos % 2 == 0 else vocab_size_code_text_rel_pos + 1,  # even
 			max_sequence_length=-1,
 			position_embedding_type='none',
-			scatter_to_sequence_parallel=True,
+			# the table of all distances is needed on every rank, see get_rel_pos_embedding
+			scatter_to_sequence_parallel=False,
 		)
 
 		self.ll_sims_weight_bias = LanguageModelEmbedding(
@@ -46,6 +60,16 @@ class StructureAwareSelfAttention(SelfAttention):
 			scatter_to_sequence_parallel=True,
 		)
 
+	def get_rel_pos_table(self, device):
+		# scalar embedding of each relative distance, the vocab-parallel lookup is all-reduced, i.e. complete on every rank
+		input_ids = torch.arange(self.num_code_text_rel_pos, device=device)
+
+		return self.code_text_token_rel_pos_embedding.word_embeddings(input_ids).view(-1)
+
+	def get_rel_pos_embedding(self, rel_pos_table, rel_pos_ids):
+		# gathers the embeddings of the L x L distances, dropout applies to each pair (i, j) as for an embedding of rel_pos_ids
+		return self.code_text_token_rel_pos_embedding.embedding_dropout(rel_pos_table[rel_pos_ids]).unsqueeze(1)
+
 	def forward(
 			self,
 			hidden_states,
@@ -62,8 +86,8 @@ class StructureAwareSelfAttention(SelfAttention):
 			packed_seq_params=None,
 			sequence_len_offset=None,
 	):
-		code_token_rel_pos_embedding= self.code_text_token_rel_pos_embedding(input_ids=code_token_rel_pos_ids, position_ids=None)
-		code_token_rel_pos_embedding = code_token_rel_pos_embedding.permute(1, 3, 0, 2)
+		rel_pos_table = self.get_rel_pos_table(code_token_rel_pos_ids.device)
+		code_token_rel_pos_embedding = self.get_rel_pos_embedding(rel_pos_table, code_token_rel_pos_ids)
 
 		ll_sims_weight_param = self.ll_sims_weight_bias(input_ids=torch.tensor([0], device=ll_sims.device), position_ids=None)
 		ll_sims_bias_param = self.ll_sims_weight_bias(input_ids=torch.tensor([1], device=ll_sims.device), position_ids=None)
@@ -72,8 +96,7 @@ class StructureAwareSelfAttention(SelfAttention):
 		batch, head, height_code_token, width_code_token = code_token_rel_pos_embedding.shape
 
 		if text_token_rel_pos_ids is not None:
-			text_token_rel_pos_embedding = self.code_text_token_rel_pos_embedding(input_ids=text_token_rel_pos_ids, position_ids=None)
-			text_token_rel_pos_embedding = text_token_rel_pos_embedding.permute(1, 3, 0, 2)
+			text_token_rel_pos_embedding = self.get_rel_pos_embedding(rel_pos_table, text_token_rel_pos_ids)
 			batch, head, height_text_token, width_text_token = text_token_rel_pos_embedding.shape
 			target_text_tokens = attention_bias[:, :, -height_text_token:, -width_text_token:]
 			mask_text_tokens = target_text_tokens > -1
@@ -1,9 +1,10 @@
 import json
-from typing import Callable, Dict, Union
+from typing import Callable, Dict, Optional, Union
 from dataclasses import dataclass, field
 
 from structure_aware_mcore_gpt_model import StructureAwareMCoreGPTModel
 from structure_aware_layer_spec import structure_aware_layer_spec
+from ragged_batch import RaggedBatch
 
 import torch
 from megatron.core.transformer.spec_utils import ModuleSpec
@@ -26,7 +27,8 @@ def get_batch_on_this_context_parallel_rank(batch) -> Dict[str, torch.Tensor]:
 
 		cp_rank = parallel_state.get_context_parallel_rank()
 		for key, val in batch.items():
-			if val is not None:
+			# sequence lengths have no sequence dimension
+			if val is not None and key not in ('code_token_lens', 'text_token_lens'):
 				seq_dim = 1 if key != 'attention_mask' else 2
 				_val = val.view(
 					*val.shape[0:seq_dim],
@@ -55,6 +57,10 @@ def structure_aware_gpt_data_step(dataloader_iter) -> Dict[str, torch.Tensor]:
 	else:
 		_batch = batch
 
+	if isinstance(_batch, RaggedBatch):
+		# only the entries of the samples are copied, the padded tensors are assembled on the device
+		_batch = _batch.to(torch.cuda.current_device(), non_blocking=True).assemble()
+
 	required_device_keys = set()
 	required_host_keys = set()
 
@@ -65,10 +71,10 @@ def structure_aware_gpt_data_step(dataloader_iter) -> Dict[str, torch.Tensor]:
 		required_host_keys.add('max_seqlen')
 
 	if parallel_state.is_pipeline_first_stage():
-		required_device_keys.update(("code_token_ids", "code_token_rel_pos_ids", "ll_sims", "lr_paths_types",
+		required_device_keys.update(("code_token_ids", "code_token_lens", "ll_sims", "lr_paths_types",
 									 "lr_paths_len", "dfg_node_mask", "attention_bias"))
 		if 'text_token_ids' in _batch:
-			required_device_keys.update(("text_token_ids", "text_token_rel_pos_ids"))
+			required_device_keys.update(("text_token_ids", "text_token_lens"))
 
 	if parallel_state.is_pipeline_last_stage():
 		required_device_keys.update(("labels", "loss_mask"))
@@ -115,7 +121,7 @@ def get_packed_seq_params(batch):
 def structure_aware_gpt_forward_step(model, batch) -> torch.Tensor:
 	forward_args = {
 		"code_token_ids": batch["code_token_ids"],
-		"code_token_rel_pos_ids": batch["code_token_rel_pos_ids"],
+		"code_token_lens": batch["code_token_lens"],
 		"ll_sims": batch["ll_sims"],
 		"lr_paths_types": batch["lr_paths_types"],
 		"lr_paths_len": batch["lr_paths_len"],
@@ -126,7 +132,7 @@ def structure_aware_gpt_forward_step(model, batch) -> torch.Tensor:
 
 	if 'text_token_ids' in batch:
 		forward_args["text_token_ids"] = batch["text_token_ids"]
-		forward_args["text_token_rel_pos_ids"] = batch["text_token_rel_pos_ids"]
+		forward_args["text_token_lens"] = batch["text_token_lens"]
 
 	if 'attention_mask' not in batch:
 		assert (
@@ -149,6 +155,9 @@ class StructureAwareStarcoder2Config(Starcoder2Config3B):
 	forward_step_fn: Callable = structure_aware_gpt_forward_step
 	data_step_fn: Callable = structure_aware_gpt_data_step
 	position_embedding_type: str = "none"
+	# manifest.json of the preprocessed training split, see DataHandler.write_manifest; metadata.json is the fallback
+	manifest_path: Optional[str] = None
+	metadata_path: str = '/shared/home/i741961/structure_aware_final/data/pretraining/code_completion/metadata.json'
 	num_ast_node_types: int = field(init=False)
 	max_ast_depth: int = field(init=False)
 	max_code_token_rel_pos: int = field(init=False)
@@ -156,8 +165,12 @@ class StructureAwareStarcoder2Config(Starcoder2Config3B):
 	def __post_init__(self):
 		super().__post_init__()
 
-		with open('/shared/home/i741961/structure_aware_final/data/pretraining/code_completion/metadata.json', 'r') as f_metadata:
-			metadata = json.load(f_metadata)
+		if self.manifest_path is not None:
+			with open(self.manifest_path, 'r') as f_manifest:
+				metadata = json.load(f_manifest)['metadata']
+		else:
+			with open(self.metadata_path, 'r') as f_metadata:
+				metadata = json.load(f_metadata)
 
 		self.num_ast_node_types = metadata['num_ast_node_types']
 		self.max_ast_depth = metadata['max_ast_depth']
@@ -32,14 +32,14 @@ class StructureAwareStarcoder2Model(Starcoder2Model):
 	def forward(
 			self,
 			code_token_ids: torch.Tensor,
-			code_token_rel_pos_ids: torch.Tensor,
+			code_token_lens: torch.Tensor,
 			ll_sims: torch.Tensor,
 			lr_paths_types: torch.Tensor,
 			lr_paths_len: torch.Tensor,
 			dfg_node_mask: torch.Tensor,
 			attention_bias: torch.Tensor,
 			text_token_ids: Optional[torch.Tensor] = None,
-			text_token_rel_pos_ids: Optional[torch.Tensor] = None,
+			text_token_lens: Optional[torch.Tensor] = None,
 			attention_mask: Optional[torch.Tensor] = None,
 			labels: Optional[torch.Tensor] = None,
 			decoder_input: Optional[torch.Tensor] = None,
@@ -49,14 +49,14 @@ class StructureAwareStarcoder2Model(Starcoder2Model):
 		extra_kwargs = {'packed_seq_params': packed_seq_params} if packed_seq_params is not None else {}
 		output_tensor = self.module(
 			code_token_ids=code_token_ids,
-			code_token_rel_pos_ids=code_token_rel_pos_ids,
+			code_token_lens=code_token_lens,
 			ll_sims=ll_sims,
 			lr_paths_types=lr_paths_types,
 			lr_paths_len=lr_paths_len,
 			dfg_node_mask=dfg_node_mask,
 			attention_bias=attention_bias,
 			text_token_ids=text_token_ids,
-			text_token_rel_pos_ids=text_token_rel_pos_ids,
+			text_token_lens=text_token_lens,
 			attention_mask=attention_mask,
 			decoder_input=decoder_input,
 			labels=labels,
@@ -0,0 +1,240 @@
+import string
+import zlib
+import numpy as np
+import pandas as pd
+
+
+SIZE_TIERS = {
+	'small': {'num_statements': 6, 'max_depth': 2, 'docstring_density': 0.5, 'fan_out': 2},
+	'medium': {'num_statements': 24, 'max_depth': 3, 'docstring_density': 0.5, 'fan_out': 3},
+	'large': {'num_statements': 64, 'max_depth': 4, 'docstring_density': 0.5, 'fan_out': 4},
+}
+
+MAX_CODE_TOKEN_CHARS = 3  # leaves longer than this are split into several code tokens, like subword tokenization
+WORDS = ['compute', 'value', 'index', 'result', 'buffer', 'count', 'total', 'item', 'node', 'offset']
+OPERATORS = ['+', '-', '*', '//']
+
+
+class SyntheticTokenizer:
+	"""
+	Offline stand-in for the Hugging Face tokenizer with a single-character vocabulary, see DataHandler.get_tokenizer_chars.
+	"""
+
+	def __init__(self):
+		self.vocab = ['<s>', '</s>'] + list(string.printable)
+		self.vocab_size = len(self.vocab)
+		self.bos_token_id = 0
+		self.eos_token_id = 1
+		self.name_or_path = 'synthetic'
+
+	def decode(self, token_id):
+		return self.vocab[token_id]
+
+	def encode(self, text):
+		return [zlib.crc32(text.encode('utf-8')) % (self.vocab_size - 2) + 2]
+
+
+class SyntheticNode:
+	# hashable by identity like the nodes of the parser
+	def __init__(self, type, parent):
+		self.type = type
+		self.parent = parent
+
+
+class SyntheticFunction:
+	"""
+	Emits the source of a function leaf by leaf together with its AST, the code tokens of each leaf and the DFG edges.
+	DFG edges connect each use of a variable to its last definition and each definition to the uses it comes from.
+	"""
+
+	def __init__(self, rng, tokenizer, num_statements, max_depth, docstring_density, fan_out):
+		self.rng = rng
+		self.tokenizer = tokenizer
+		self.max_depth = max_depth
+		self.docstring_density = docstring_density
+		self.fan_out = fan_out
+
+		self.lines = []
+		self.line = []
+		self.indent = 0
+		self.num_chars = 0
+		self.leaves = []
+		self.leaf_tokens = []
+		self.leaf_ranges = []
+		self.leaf_code_token_idxs = []
+		self.code_tokens = []
+		self.code_tokens_ranges = []
+		self.dfg_edges = []
+		self.last_definition = {}
+		self.num_variables = 0
+
+		self.root = SyntheticNode('module', None)
+		self.build_function(num_statements)
+
+	def leaf(self, token, parent, type=None):
+		if self.line:
+			self.line.append(' ')
+			self.num_chars += 1
+		start = self.num_chars
+		self.line.append(token)
+		self.num_chars += len(token)
+
+		code_token_idxs = []
+		for i in range(0, len(token), MAX_CODE_TOKEN_CHARS):
+			code_token_idxs.append(len(self.code_tokens))
+			self.code_tokens.append(self.tokenizer.encode(token[i:i + MAX_CODE_TOKEN_CHARS])[0])
+			self.code_tokens_ranges.append((start + i, start + min(i + MAX_CODE_TOKEN_CHARS, len(token))))
+
+		self.leaves.append(SyntheticNode(token if type is None else type, parent))
+		self.leaf_tokens.append(token)
+		self.leaf_ranges.append((start, self.num_chars))
+		self.leaf_code_token_idxs.append(code_token_idxs)
+
+		return len(self.leaves) - 1
+
+	def newline(self, comment=None):
+		line = '    ' * self.indent + ''.join(self.line)
+		if comment is not None:
+			line += '  # ' + comment
+		self.lines.append(line)
+		self.line = []
+		self.num_chars = 0
+
+	def use(self, name, parent):
+		leaf_idx = self.leaf(name, parent, type='identifier')
+		if name in self.last_definition:
+			self.dfg_edges.append((leaf_idx, [self.last_definition[name]]))
+
+		return leaf_idx
+
+	def define(self, name, parent, use_idxs):
+		leaf_idx = self.leaf(name, parent, type='identifier')
+		self.dfg_edges.append((leaf_idx, list(use_idxs)))
+		self.last_definition[name] = leaf_idx
+
+	def new_variable(self):
+		self.num_variables += 1
+
+		return str(self.rng.choice(WORDS)) + '_' + str(self.num_variables)
+
+	def comment(self):
+		return ' '.join(self.rng.choice(WORDS, size=3)) if self.rng.random() < self.docstring_density else None
+
+	def build_function(self, num_statements):
+		function = SyntheticNode('function_definition', self.root)
+		self.leaf('def', function)
+		self.leaf(self.new_variable(), function, type='identifier')
+		parameters = SyntheticNode('parameters', function)
+		self.leaf('(', parameters)
+		for i in range(max(self.fan_out, 1)):
+			if i > 0:
+				self.leaf(',', parameters)
+			self.define(self.new_variable(), parameters, [])
+		self.leaf(')', parameters)
+		self.leaf(':', function)
+		self.newline()
+
+		self.indent += 1
+		block = SyntheticNode('block', function)
+		if self.rng.random() < self.docstring_density:
+			# docstrings are removed by preprocessing, so they are not part of the AST
+			self.lines.append('    ' * self.indent + '"""' + ' '.join(self.rng.choice(WORDS, size=8)) + '"""')
+		self.build_block(block, num_statements, depth=1)
+
+		statement = SyntheticNode('return_statement', block)
+		self.leaf('return', statement)
+		self.use(str(self.rng.choice(list(self.last_definition))), statement)
+		self.newline()
+		self.indent -= 1
+
+	def build_block(self, block, num_statements, depth):
+		while num_statements > 0:
+			kind = self.rng.random()
+			if depth < self.max_depth and num_statements > 2 and kind < 0.3:
+				num_nested = int(self.rng.integers(1, num_statements))
+				self.build_compound_statement(block, num_nested, depth)
+				num_statements -= num_nested + 1
+			else:
+				self.build_assignment(block)
+				num_statements -= 1
+
+	def build_assignment(self, block):
+		statement = SyntheticNode('expression_statement', block)
+		assignment = SyntheticNode('assignment', statement)
+		sources = self.rng.choice(list(self.last_definition), size=min(self.fan_out, len(self.last_definition)), replace=False).tolist()
+
+		target = self.new_variable()
+		target_leaf = self.leaf(target, assignment, type='identifier')
+		self.leaf('=', assignment)
+		expression = SyntheticNode('binary_operator', assignment)
+		use_idxs = []
+		for i, source in enumerate(sources):
+			if i > 0:
+				self.leaf(str(self.rng.choice(OPERATORS)), expression)
+			use_idxs.append(self.use(source, expression))
+		self.dfg_edges.append((target_leaf, use_idxs))
+		self.last_definition[target] = target_leaf
+		self.newline(comment=self.comment())
+
+	def build_compound_statement(self, block, num_statements, depth):
+		if self.rng.random() < 0.5:
+			statement = SyntheticNode('if_statement', block)
+			self.leaf('if', statement)
+			condition = SyntheticNode('comparison_operator', statement)
+			self.use(str(self.rng.choice(list(self.last_definition))), condition)
+			self.leaf('>', condition)
+			self.leaf(str(int(self.rng.integers(0, 100))), condition, type='integer')
+		else:
+			statement = SyntheticNode('for_statement', block)
+			self.leaf('for', statement)
+			self.define(self.new_variable(), statement, [])
+			self.leaf('in', statement)
+			call = SyntheticNode('call', statement)
+			self.leaf('range', call, type='identifier')
+			arguments = SyntheticNode('argument_list', call)
+			self.leaf('(', arguments)
+			self.use(str(self.rng.choice(list(self.last_definition))), arguments)
+			self.leaf(')', arguments)
+		self.leaf(':', statement)
+		self.newline(comment=self.comment())
+
+		self.indent += 1
+		self.build_block(SyntheticNode('block', statement), num_statements, depth + 1)
+		self.indent -= 1
+
+	def to_row(self):
+		text = ' '.join(self.rng.choice(WORDS, size=int(self.rng.integers(4, 16))))
+
+		return {
+			'text': text,
+			'code': '\n'.join(self.lines),
+			'code_tokens': self.code_tokens,
+			'text_tokens': [self.tokenizer.encode(word)[0] for word in text.split(' ')],
+			'ast_leaves': self.leaves,
+			'ast_leaf_tokens': self.leaf_tokens,
+			'ast_leaf_ranges': self.leaf_ranges,
+			'ast_leaf_code_token_idxs': self.leaf_code_token_idxs,
+			'code_tokens_ranges': self.code_tokens_ranges,
+			'dfg_edges': self.dfg_edges,
+		}
+
+
+def generate_corpus(num_samples, num_statements=24, max_depth=3, docstring_density=0.5, fan_out=3, seed=0, tokenizer=None):
+	"""
+	Generates a seeded corpus of Python functions with the columns that featurization passes to DataHandler.clean_data.
+	'num_statements' controls the length, 'max_depth' the nesting of blocks, 'docstring_density' the fraction of
+	docstrings and comments and 'fan_out' the number of variables each assignment reads.
+	"""
+	rng = np.random.default_rng(seed)
+	tokenizer = SyntheticTokenizer() if tokenizer is None else tokenizer
+	rows = []
+	for _ in range(num_samples):
+		function = SyntheticFunction(rng, tokenizer, num_statements=num_statements, max_depth=max_depth,
+									 docstring_density=docstring_density, fan_out=fan_out)
+		rows.append(function.to_row())
+
+	return pd.DataFrame(rows)
+
+
+def generate_tier(tier, num_samples, seed=0, tokenizer=None):
+	return generate_corpus(num_samples, seed=seed, tokenizer=tokenizer, **SIZE_TIERS[tier])
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+
+# the modules of 'final' import each other by their plain names
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data_handler as data_handler_module
+from data_handler import DataHandler
+from synthetic_corpus import SyntheticTokenizer, generate_tier
+from code_completion_attn_mask import CodeCompletionAttnMask
+from code_text_attn_mask import CodeTextAttnMask
+from structure_aware_cc_dataset import StructureAwareCCDataset
+from structure_aware_ct_dataset import StructureAwareCTDataset
+
+
+@pytest.fixture
+def data_handler(tmp_path):
+	return DataHandler(save_dir=str(tmp_path / 'data'), tokenizer=SyntheticTokenizer(), tokenizer_cache_dir=str(tmp_path / 'tokenizers'))
+
+
+@pytest.fixture(scope='session')
+def structure_aware_datasets(tmp_path_factory):
+	"""
+	Small train splits of the code completion and code text tasks, built like the preprocessing does.
+	"""
+	save_dir = str(tmp_path_factory.mktemp('pretraining'))
+	data = generate_tier('small', 30, seed=1)
+	datasets = {}
+	with pytest.MonkeyPatch.context() as monkeypatch:
+		# the datasets load the default tokenizer, which is replaced by the synthetic one
+		monkeypatch.setattr(data_handler_module.AutoTokenizer, 'from_pretrained', lambda *args, **kwargs: SyntheticTokenizer())
+		for task, attn_mask_builder, dataset_cls in [('code_completion', CodeCompletionAttnMask(), StructureAwareCCDataset),
+													 ('code_text', CodeTextAttnMask(), StructureAwareCTDataset)]:
+			handler = DataHandler(save_dir=os.path.join(save_dir, task, 'train'), tokenizer=SyntheticTokenizer(),
+								  attn_mask_builder=attn_mask_builder, tokenizer_cache_dir=os.path.join(save_dir, 'tokenizers'))
+			node_types, max_rel_pos = handler.store_preprocessed_data(handler.convert_tokens_to_arrays(handler.clean_data(data.copy())), 10)
+			max_depth = handler.convert_node_types_to_indices(node_types)
+			handler.reduce_ll_sims()
+			handler.write_manifest(handler.store_metadata(len(node_types), max_depth, max_rel_pos))
+			datasets[task] = dataset_cls(save_dir=save_dir, split='train')
+
+	return datasets
@@ -0,0 +1,22 @@
+import torch
+from torch.utils.data import DataLoader
+
+from batch_prefetcher import BatchPrefetcher, get_samples
+
+
+def collate(samples, full=torch.full):
+	batch = full((len(samples),), 0, torch.int64)
+	batch.copy_(torch.tensor(samples))
+
+	return {'samples': batch}
+
+
+def test_replaced_loader_is_iterated():
+	prefetcher = BatchPrefetcher(DataLoader(list(range(8)), batch_size=2, collate_fn=get_samples), collate_fn=collate,
+								 num_prefetch_batches=2, device=None)
+	replaced = prefetcher.replace_loader(DataLoader(list(range(100, 106)), batch_size=3, collate_fn=get_samples))
+
+	batches = [batch['samples'].tolist() for batch in replaced]
+	assert batches == [[100, 101, 102], [103, 104, 105]]
+	assert replaced.num_batches == 2 and len(replaced) == 2
+	assert replaced.collate_fn is collate and replaced.num_prefetch_batches == 2
@@ -0,0 +1,101 @@
+import tokenize
+
+import numpy as np
+import pytest
+
+from data_handler import MAX_NUM_AST_LEAVES_LL_SIMS, matrix_list_array
+from preprocessing_benchmark import legacy_remove_comments_and_docstrings, legacy_ll_sims, strip_or_none
+from synthetic_corpus import SyntheticNode, generate_tier
+
+
+SOURCES = {
+	'nested_quotes': 'def f(a):\n    x = "it\'s"  # comment\n    y = \'say "hi"\'\n    z = "a" + \'"\' + "\'"\n    return x, y, z\n',
+	'triple_quotes_in_string': 'def f():\n    x = \'"""\'\n    y = 1\n    z = \'"""\'\n    return x\n',
+	'unclosed_triple_quotes_in_string': 'def f():\n    x = \'"""\'\n    return x\n',
+	'double_quote_docstring': 'def f():\n    """Docstring\n\n    over several lines.\n    """\n    return 1\n',
+	'single_quote_docstring': "def f():\n    '''Docstring'''\n    x = '''kept\n\n    string'''\n    return x\n",
+	'assigned_docstring_quotes': 'def f():\n    x = """cut\n    out"""\n    return x\n',
+	'quote_runs': 'def f():\n    x = """"a""""\n    y = \'""\' + \'"\'\n    return x\n',
+	'crlf': 'def f(a):\r\n    """Docstring"""\r\n    # comment\r\n\r\n    b = a  # comment\r\n    \r\n    return b\r\n',
+	'crlf_mixed': 'def f(a):\r\n    x = """\r\n\r\n    """\r\n\r\n    return x\n',
+	'blank_rows': '\n\n   \ndef f():\n\n    \t\n    return 1\n\n',
+	'empty': '',
+	'unterminated_string': 'def f():\n    """never closed\n    return 1\n',
+	'unterminated_bracket': 'def f(:\n    return (1,\n',
+	'inconsistent_dedent': 'def f():\n        x = 1\n    return x\n',
+}
+
+
+@pytest.mark.parametrize('name', sorted(SOURCES))
+def test_remove_comments_and_docstrings_matches_legacy(data_handler, name):
+	source = SOURCES[name]
+	try:
+		expected = legacy_remove_comments_and_docstrings(source)
+	except (tokenize.TokenError, SyntaxError) as e:
+		with pytest.raises(type(e)):
+			data_handler.remove_comments_and_docstrings(source)
+		return
+
+	assert data_handler.remove_comments_and_docstrings(source) == expected
+
+
+def test_remove_comments_and_docstrings_matches_legacy_on_synthetic_corpus(data_handler):
+	codes = list(generate_tier('medium', 50)['code'])
+	codes += [code.replace('\n', '\r\n') for code in codes]
+
+	for code in codes:
+		assert strip_or_none(data_handler.remove_comments_and_docstrings, code) == strip_or_none(legacy_remove_comments_and_docstrings, code)
+
+
+def build_random_ast(num_leaves, seed=0):
+	# leaves of a seeded random tree, in the order in which they were created
+	rng = np.random.default_rng(seed)
+	inner_nodes = [SyntheticNode('module', None)]
+	leaves = []
+	while len(leaves) < num_leaves:
+		parent = inner_nodes[rng.integers(len(inner_nodes))]
+		if rng.random() < 0.3:
+			inner_nodes.append(SyntheticNode('block', parent))
+		else:
+			leaves.append(SyntheticNode('identifier', parent))
+
+	return leaves
+
+
+@pytest.mark.parametrize('num_leaves', [0, 1, 2, 37, 509, 510, 511, 600])
+def test_compute_ll_sims_matches_double_loop(data_handler, num_leaves):
+	leaf_lr_paths = [data_handler.get_lr_path(leaf) for leaf in build_random_ast(num_leaves, seed=num_leaves)]
+
+	ll_sims = data_handler.compute_ll_sims(leaf_lr_paths)
+	num_rows = min(num_leaves + 2, MAX_NUM_AST_LEAVES_LL_SIMS)
+	assert ll_sims.shape == (num_rows, num_rows)
+	np.testing.assert_array_equal(ll_sims, legacy_ll_sims(data_handler, leaf_lr_paths))
+	# <START_AST> and, if it is not cut off, <END_AST> are only similar to themselves
+	np.testing.assert_array_equal(ll_sims[0], np.eye(num_rows)[0])
+	if num_leaves + 2 <= MAX_NUM_AST_LEAVES_LL_SIMS:
+		np.testing.assert_array_equal(ll_sims[-1], np.eye(num_rows)[-1])
+
+
+def test_compute_ll_sims_matches_double_loop_on_synthetic_corpus(data_handler):
+	for ast_leaves in generate_tier('medium', 10)['ast_leaves']:
+		leaf_lr_paths = [data_handler.get_lr_path(leaf) for leaf in ast_leaves]
+		np.testing.assert_array_equal(data_handler.compute_ll_sims(leaf_lr_paths), legacy_ll_sims(data_handler, leaf_lr_paths))
+
+
+def legacy_upper_triangle(ll_sims):
+	# upper triangle of the ';'/','-joined ll_sims strings of shards before format version 5
+	rows = ';'.join([','.join(map(str, row)) for row in ll_sims]).split(';')[:-1]
+
+	return [[float(value) for value in row.split(',')[i + 1:]] for i, row in enumerate(rows)]
+
+
+def test_upper_triangle_matches_legacy_strings(data_handler):
+	rng = np.random.default_rng(0)
+	all_ll_sims = [data_handler.compute_ll_sims([data_handler.get_lr_path(leaf) for leaf in build_random_ast(num_leaves, seed=num_leaves)])
+				   for num_leaves in rng.integers(0, 40, size=250)]
+	all_ll_sims[3] = rng.random((7, 7))  # values without a short decimal representation
+
+	column = matrix_list_array(all_ll_sims)
+	reduced = [data_handler.upper_triangle(chunk) for chunk in column.chunks]
+	assert len(reduced) == 3
+	assert [row for chunk in reduced for row in chunk.to_pylist()] == [legacy_upper_triangle(ll_sims) for ll_sims in all_ll_sims]
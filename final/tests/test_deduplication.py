@@ -0,0 +1,40 @@
+import pandas as pd
+
+from deduplication import Deduplicator
+from synthetic_corpus import generate_tier
+
+
+def test_duplicates_are_dropped_across_batches_until_reset():
+	codes = list(generate_tier('medium', 20, seed=1)['code'])
+	near_duplicate = codes[0] + '\n    extra_1 = 1'
+	deduplicator = Deduplicator(near_dup_threshold=0.8)
+
+	first = deduplicator.filter(pd.DataFrame({'code': codes[:10]}))
+	second = deduplicator.filter(pd.DataFrame({'code': codes[10:] + [codes[3].replace('\n', '\n\n'), near_duplicate]}))
+	assert list(first['code']) == codes[:10]
+	assert list(second['code']) == codes[10:]
+	assert deduplicator.stats == {'num_rows': 22, 'num_exact_duplicates': 1, 'num_near_duplicates': 1}
+
+	deduplicator.reset()
+	assert list(deduplicator.filter(pd.DataFrame({'code': [near_duplicate, codes[0]]}))['code']) == [near_duplicate]
+	deduplicator.close()
+
+
+def test_worker_pool_is_reused_and_matches_serial():
+	codes = list(generate_tier('medium', 40, seed=2)['code'])
+	batches = [codes[:20], codes[20:] + [code + '\n    extra_1 = 1' for code in codes[:5]]]
+	serial = Deduplicator(near_dup_threshold=0.8)
+	parallel = Deduplicator(near_dup_threshold=0.8, num_workers=2)
+
+	executor = None
+	for batch in batches:
+		assert parallel.filter(pd.DataFrame({'code': batch})).equals(serial.filter(pd.DataFrame({'code': batch})))
+		executor = executor or parallel.executor
+		assert executor is not None and parallel.executor is executor
+	assert parallel.stats == serial.stats
+
+	parallel.reset()
+	assert parallel.executor is executor
+	parallel.close()
+	serial.close()
+	assert parallel.executor is None
@@ -0,0 +1,82 @@
+import os
+import multiprocessing
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from data_handler import SHARD_FORMAT_VERSION, SHARD_FORMAT_VERSION_KEY
+from flat_array_store import compute_fingerprint, load_flat_array_store, get_current_build_dir
+
+
+def write_shards(shard_dir, num_shards=3, num_rows=50):
+	os.makedirs(shard_dir, exist_ok=True)
+	rng = np.random.default_rng(0)
+	paths = []
+	for i in range(num_shards):
+		code_tokens = [rng.integers(0, 100, size=rng.integers(0, 20)).astype(np.int32) for _ in range(num_rows)]
+		table = pa.table({'code_tokens': pa.array(code_tokens, type=pa.list_(pa.int32()))})
+		table = table.replace_schema_metadata({SHARD_FORMAT_VERSION_KEY: str(SHARD_FORMAT_VERSION)})
+		paths.append(os.path.join(shard_dir, 'from_' + str(i * num_rows) + '.parquet'))
+		pq.write_table(table, paths[-1])
+
+	return paths
+
+
+def load_in_process(paths, store_dir, local_rank, rebuild, queue):
+	os.environ['LOCAL_RANK'] = str(local_rank)
+	store = load_flat_array_store(paths, store_dir, rebuild=rebuild)
+	queue.put((store.store_dir, store.get_list_lengths('code_tokens').tolist()))
+
+
+def test_fingerprint_uses_file_stats_without_checksums(tmp_path):
+	paths = write_shards(str(tmp_path / 'shards'))
+	fingerprint = compute_fingerprint(paths)
+	assert compute_fingerprint(paths) == fingerprint
+
+	stat = os.stat(paths[0])
+	os.utime(paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+	assert compute_fingerprint(paths) != fingerprint
+
+	# shards listed in the manifest are identified by their checksum
+	checksums = {os.path.basename(path): 'sha' + str(i) for i, path in enumerate(paths)}
+	fingerprint = compute_fingerprint(paths, checksums=checksums)
+	os.utime(paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 2))
+	assert compute_fingerprint(paths, checksums=checksums) == fingerprint
+
+
+def test_concurrent_loads_build_once(tmp_path):
+	paths = write_shards(str(tmp_path / 'shards'))
+	store_dir = str(tmp_path / 'flat')
+	context = multiprocessing.get_context('fork')
+	queue = context.Queue()
+	# every local rank is asked to rebuild, only local rank 0 does
+	processes = [context.Process(target=load_in_process, args=(paths, store_dir, rank, True, queue)) for rank in range(4)]
+	for process in processes:
+		process.start()
+	results = [queue.get(timeout=60) for _ in processes]
+	for process in processes:
+		process.join()
+		assert process.exitcode == 0
+
+	expected = [len(pq.read_table(path)['code_tokens'][i]) for path in paths for i in range(50)]
+	assert all(lengths == expected for _, lengths in results)
+	assert len([name for name in os.listdir(store_dir) if os.path.isdir(os.path.join(store_dir, name))]) <= 2
+
+
+def test_rebuild_keeps_open_builds(tmp_path):
+	paths = write_shards(str(tmp_path / 'shards'))
+	store_dir = str(tmp_path / 'flat')
+	store = load_flat_array_store(paths, store_dir)
+	assert load_flat_array_store(paths, store_dir).store_dir == store.store_dir
+
+	rebuilt = load_flat_array_store(paths, store_dir, rebuild=True)
+	assert rebuilt.store_dir != store.store_dir
+	assert get_current_build_dir(store_dir) == rebuilt.store_dir
+	# the former build is still opened by 'store'
+	assert np.array_equal(store.get_list_lengths('code_tokens'), rebuilt.get_list_lengths('code_tokens'))
+
+	store.close()
+	rebuilt.close()
+	rebuilt = load_flat_array_store(paths, store_dir, rebuild=True)
+	assert sorted(os.listdir(store_dir)) == sorted(['CURRENT', os.path.basename(rebuilt.store_dir)])
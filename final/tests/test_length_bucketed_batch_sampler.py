@@ -0,0 +1,31 @@
+import numpy as np
+
+from length_bucketed_batch_sampler import LengthBucketedBatchSampler
+
+
+def get_sample_lengths(num_samples=200):
+	rng = np.random.default_rng(0)
+
+	return {key: rng.integers(1, 100, size=num_samples) for key in ['num_ast_leaves', 'num_dfg_nodes', 'num_code_tokens']}
+
+
+def test_epoch_advances_with_every_iteration():
+	sampler = LengthBucketedBatchSampler(get_sample_lengths(), batch_size=4, bucket_size=32, data_parallel_rank=0, data_parallel_size=2)
+	epochs = [list(sampler) for _ in range(3)]
+	assert epochs[0] != epochs[1] != epochs[2]
+	assert all(len(epoch) == len(sampler) for epoch in epochs)
+
+	sampler.set_epoch(1)
+	assert list(sampler) == epochs[1]
+
+
+def test_consumed_samples_are_skipped():
+	sample_lengths = get_sample_lengths()
+	sampler = LengthBucketedBatchSampler(sample_lengths, batch_size=4, bucket_size=32, data_parallel_rank=1, data_parallel_size=2)
+	epochs = [list(sampler) for _ in range(2)]
+
+	resumed = LengthBucketedBatchSampler(sample_lengths, batch_size=4, bucket_size=32, data_parallel_rank=1, data_parallel_size=2)
+	resumed.set_consumed_samples((len(sampler) + 3) * 8)
+	assert list(resumed) == epochs[1][3:]
+	# the next iteration continues with the following epoch
+	assert list(resumed) == [batch.tolist() for batch in sampler.get_batches(2)]
@@ -0,0 +1,94 @@
+import pandas as pd
+import pytest
+
+from length_budget import LengthBudget, TRUNCATE, DROP
+from synthetic_corpus import SyntheticNode
+
+
+def build_sample(num_leaves, dfg_edges, num_text_tokens=3):
+	# leaf i covers the code tokens 2i and 2i + 1, every LR path has 3 nodes
+	root = SyntheticNode('module', None)
+	ast_leaves = [SyntheticNode('identifier', SyntheticNode('statement', root)) for _ in range(num_leaves)]
+
+	return {
+		'code_tokens': list(range(100, 100 + 2 * num_leaves)),
+		'text_tokens': list(range(num_text_tokens)),
+		'ast_leaves': ast_leaves,
+		'ast_leaf_code_token_idxs': [[2 * i, 2 * i + 1] for i in range(num_leaves)],
+		'dfg_edges': dfg_edges,
+	}
+
+
+def build_data():
+	return pd.DataFrame([
+		build_sample(5, [(2, [0]), (4, [2, 1]), (3, [1])]),
+		build_sample(2, [(1, [0])]),
+	])
+
+
+def get_dfg_nodes(dfg_edges):
+	return set([left for left, _ in dfg_edges] + [r for _, right in dfg_edges for r in right])
+
+
+def check_budgets(budget, original, data):
+	# budgets include special tokens, see LengthBudget
+	for idx, sample in data.iterrows():
+		before = original.loc[idx]
+		code_tokens, num_leaves, dfg_nodes = list(sample['code_tokens']), len(sample['ast_leaves']), get_dfg_nodes(sample['dfg_edges'])
+		total_len = len(code_tokens) + num_leaves + len(dfg_nodes) + len(sample['text_tokens']) + 8
+		for value, max_value in [(len(code_tokens) + 2, budget.max_code_tokens), (num_leaves + 2, budget.max_ast_leaves),
+								 (len(dfg_nodes) + 2, budget.max_dfg_nodes), (total_len, budget.max_total_len)]:
+			assert max_value is None or value <= max_value
+
+		# code, AST leaves and DFG edges are consistent prefixes of the original sample
+		assert code_tokens == list(before['code_tokens'][:len(code_tokens)])
+		assert sample['ast_leaves'] == before['ast_leaves'][:num_leaves]
+		assert sample['ast_leaf_code_token_idxs'] == before['ast_leaf_code_token_idxs'][:num_leaves]
+		assert all(idx < len(code_tokens) for idxs in sample['ast_leaf_code_token_idxs'] for idx in idxs)
+		assert all(node < num_leaves for node in dfg_nodes)
+		original_edges = dict(before['dfg_edges'])
+		assert all(left in original_edges and set(right) <= set(original_edges[left]) for left, right in sample['dfg_edges'])
+
+
+# the first sample is truncated as 'expected_sample' or, with policy='drop', dropped like all samples counted in 'expected_stats'
+@pytest.mark.parametrize('kwargs, expected_sample, expected_stats, num_dropped', [
+	# leaf 3 ends at code token 7, so leaves 3 and 4 and the code after leaf 2 are cut, only the edge (2, [0]) remains
+	({'max_code_tokens': 9}, (6, 3, [(2, [0])]),
+	 {'num_truncated_code_tokens': 1, 'num_truncated_ast_leaves': 1, 'num_truncated_dfg_nodes': 1}, 1),
+	({'max_ast_leaves': 5}, (6, 3, [(2, [0])]),
+	 {'num_truncated_code_tokens': 1, 'num_truncated_ast_leaves': 1, 'num_truncated_dfg_nodes': 1}, 1),
+	# the DFG nodes 0, 1 and 2 are kept, of their edges only (2, [0]) stays within them
+	({'max_dfg_nodes': 5}, (10, 5, [(2, [0])]), {'num_truncated_dfg_nodes': 1}, 1),
+	# 10 + 5 + 5 + 5 + 6 = 31 is 4 over budget, the code is cut to 6 tokens, i.e. 6 + 3 + 2 + 5 + 6 = 22
+	({'max_total_len': 27}, (6, 3, [(2, [0])]),
+	 {'num_truncated_code_tokens': 1, 'num_truncated_ast_leaves': 1, 'num_truncated_dfg_nodes': 1, 'num_truncated_total_len': 1}, 1),
+	# LR paths are truncated when they are built, the samples stay as they are
+	({'max_lr_path_len': 2}, (10, 5, [(2, [0]), (4, [2, 1]), (3, [1])]), {'num_truncated_lr_paths': 2}, 2),
+])
+@pytest.mark.parametrize('policy', [TRUNCATE, DROP])
+def test_apply(policy, kwargs, expected_sample, expected_stats, num_dropped):
+	budget = LengthBudget(policy=policy, **kwargs)
+	original = build_data()
+	data, stats = budget.apply(original.copy())
+
+	if policy == TRUNCATE:
+		num_dropped = 0
+		first = data.loc[0]
+		assert (len(first['code_tokens']), len(first['ast_leaves']), first['dfg_edges']) == expected_sample
+	assert len(data) == 2 - num_dropped
+	check_budgets(budget, original, data)
+	assert stats == {'num_samples': 2, 'num_dropped': num_dropped, 'num_truncated_code_tokens': 0, 'num_truncated_ast_leaves': 0,
+					 'num_truncated_dfg_nodes': 0, 'num_truncated_lr_paths': 0, 'num_truncated_total_len': 0, **expected_stats}
+
+
+def test_truncate_lr_path_keeps_leaf_and_root():
+	budget = LengthBudget(max_lr_path_len=3)
+	assert budget.truncate_lr_path(['leaf', 'a', 'b', 'c', 'root']) == ['leaf', 'c', 'root']
+	assert budget.truncate_lr_path(['leaf', 'root']) == ['leaf', 'root']
+
+
+def test_samples_without_code_or_dfg_edges_are_dropped():
+	# cutting the code to 4 tokens keeps the leaves 0 and 1, which have no DFG edges among them
+	data, stats = LengthBudget(max_code_tokens=6).apply(build_data())
+	assert len(data) == 1 and len(data.iloc[0]['code_tokens']) == 4
+	assert stats['num_dropped'] == 1
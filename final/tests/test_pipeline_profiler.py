@@ -0,0 +1,28 @@
+import time
+
+import numpy as np
+import pytest
+
+import pipeline_profiler
+from pipeline_profiler import PipelineProfiler
+
+
+@pytest.mark.parametrize('use_psutil', [True, False])
+def test_stage_peak_rss_is_sampled_per_stage(monkeypatch, use_psutil):
+	if not use_psutil:
+		monkeypatch.setattr(pipeline_profiler, 'psutil', None)
+	profiler = PipelineProfiler()
+
+	with profiler.stage('large'):
+		values = np.ones(25_000_000)  # 200 MB
+		time.sleep(0.05)
+		del values
+	with profiler.stage('small'):
+		time.sleep(0.05)
+
+	large, small = profiler.records
+	assert large.peak_rss_bytes - large.start_rss_bytes > 100 * 2 ** 20
+	# the peak of the previous stage is not carried over, unlike ru_maxrss
+	assert small.peak_rss_bytes - small.start_rss_bytes < 50 * 2 ** 20
+	assert small.peak_rss_bytes < large.peak_rss_bytes
+	assert profiler.summarize()['large']['peak_rss_increase_bytes'] > 100 * 2 ** 20
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+import torch
+
+from ragged_batch import RaggedTensor
+from sequence_packing import PackedStructureAwareDataset
+
+
+@pytest.mark.parametrize('values', [
+	torch.tensor([[0, 0, 3, 3, 3, 0], [5, 0, 0, 0, 0, 7]]),  # few runs
+	torch.arange(1, 13).view(2, 6),  # a distinct value per entry, i.e. row spans
+])
+def test_ragged_tensor_assembles_its_assignments(values):
+	expected = torch.full((3, 4, 8), -1, dtype=torch.int64)
+	ragged = RaggedTensor((3, 4, 8), -1, dtype=torch.int64)
+	for tensor in [expected, ragged]:
+		tensor[0, 1:3, 2:8] = values
+		tensor[2, 0:2, :6] = values
+		tensor[1, 3:4, 1:5] = 0
+		tensor[:, 2:2, :6] = values[:0]  # empty blocks are skipped
+
+	assert torch.equal(ragged.assemble(ragged.get_tensors()), expected)
+
+
+@pytest.mark.parametrize('packed', [False, True])
+@pytest.mark.parametrize('task', ['code_completion', 'code_text'])
+def test_assembled_batch_matches_collate_fn(structure_aware_datasets, task, packed):
+	dataset = structure_aware_datasets[task]
+	if packed:
+		dataset = PackedStructureAwareDataset(dataset, 512, seed=2)
+	rng = np.random.default_rng(3)
+	for batch_size in [1, 2, min(len(dataset), 5)]:
+		samples = dataset.__getitems__(rng.choice(len(dataset), size=batch_size, replace=False))
+		batch, ragged_batch = dataset.collate_fn(samples), dataset.collate_ragged_fn(samples)
+		assembled = ragged_batch.to('cpu').assemble()
+
+		assert assembled.keys() == batch.keys()
+		for key in batch:
+			assert assembled[key].dtype == batch[key].dtype, key
+			assert torch.equal(assembled[key], batch[key]), key
+		assert ragged_batch.get_padded_num_bytes() == sum(value.numel() * value.element_size() for value in batch.values())
+		assert ragged_batch.get_num_bytes() < ragged_batch.get_padded_num_bytes()
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+import torch
+
+from sequence_packing import PackedStructureAwareDataset, pack_lengths
+
+MAX_SEQ_LENGTH = 512
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_pack_lengths_stays_within_max_len(seed):
+	lengths = np.random.default_rng(seed).integers(1, 120, size=200)
+	lengths[:3] = [150, 100, 101]  # longer than 'max_len' or filling it exactly together
+	packs = pack_lengths(lengths, 100, seed=seed)
+
+	assert sorted(np.concatenate(packs).tolist()) == list(range(len(lengths)))
+	for pack in packs:
+		assert lengths[pack].sum() <= 100 or (len(pack) == 1 and lengths[pack[0]] > 100)
+
+
+def get_sample_positions(samples, block_keys):
+	# positions of each sample in the packed sequence, whose blocks hold the blocks of all samples in order
+	block_sizes = [[sample[key].size(0) for key in block_keys] for sample in samples]
+	block_offsets = np.cumsum([0] + np.sum(block_sizes, axis=0).tolist())
+	sample_offsets = np.cumsum([[0] * len(block_keys)] + block_sizes, axis=0)
+
+	return [torch.cat([torch.arange(size) + int(block_offsets[j] + sample_offsets[i][j]) for j, size in enumerate(sizes)])
+			for i, sizes in enumerate(block_sizes)]
+
+
+@pytest.mark.parametrize('task', ['code_completion', 'code_text'])
+def test_packed_samples_are_isolated(structure_aware_datasets, task):
+	dataset = structure_aware_datasets[task]
+	packed_dataset = PackedStructureAwareDataset(dataset, MAX_SEQ_LENGTH, seed=1)
+	assert len(packed_dataset) < len(dataset)
+	assert (sum(packed_dataset.get_sample_lengths().values()) <= MAX_SEQ_LENGTH).all()
+
+	block_keys = dataset.get_block_keys()
+	for idx, pack in enumerate(packed_dataset.packs):
+		samples = dataset.__getitems__(pack)
+		packed = packed_dataset.collate_fn(packed_dataset.__getitems__([idx]))
+		attn_bias = packed['attention_bias'][0, 0]
+		positions = get_sample_positions(samples, block_keys)
+		assert attn_bias.size(0) == sum(position.size(0) for position in positions)
+
+		owner = torch.empty(attn_bias.size(0), dtype=torch.int64)
+		for i, position in enumerate(positions):
+			owner[position] = i
+		# positions of different samples cannot attend to each other
+		assert (attn_bias[owner[:, None] != owner[None, :]] == -1e9).all()
+
+		labels_offset = dataset.get_labels_loss_pad_len({key: packed[key].size(1) for key in block_keys})
+		labels_start = labels_offset
+		for sample, position in zip(samples, positions):
+			unpacked = dataset.collate_fn([sample])
+			# the block of each sample equals its bias without packing
+			assert torch.equal(attn_bias[position][:, position], unpacked['attention_bias'][0, 0])
+
+			# labels and loss masks of each sample follow those of the previous samples and keep its first token masked
+			num_labels = sample['labels'].size(0)
+			for key in ['labels', 'loss_mask']:
+				assert torch.equal(packed[key][0, labels_start:labels_start + num_labels], unpacked[key][0, -num_labels:])
+			assert packed['labels'][0, labels_start] == dataset.padding_value and packed['loss_mask'][0, labels_start] == 0
+			labels_start += num_labels
+		assert labels_start == packed['labels'].size(1)
+		assert (packed['loss_mask'][0, :labels_offset] == 0).all()
@@ -0,0 +1,84 @@
+import os
+import pickle
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from data_handler import DataHandler
+from synthetic_corpus import SyntheticTokenizer, generate_tier
+
+
+def make_data_handler(tmp_path, name):
+	return DataHandler(save_dir=str(tmp_path / name), tokenizer=SyntheticTokenizer(), tokenizer_cache_dir=str(tmp_path / 'tokenizers'))
+
+
+def featurize(data_handler, data):
+	return data_handler.convert_tokens_to_arrays(data_handler.clean_data(data.copy()))
+
+
+def read_shards(data_handler):
+	return {os.path.basename(path): pq.read_table(path) for path in data_handler.iter_shard_paths(data_handler.save_dir)}
+
+
+def test_process_pool_matches_serial(tmp_path):
+	serial = make_data_handler(tmp_path, 'serial')
+	pool = make_data_handler(tmp_path, 'pool')
+	# featurized once, since convert_tokens_to_arrays shuffles the rows
+	data = featurize(serial, generate_tier('small', 35, seed=2))
+
+	assert serial.store_preprocessed_data(data.copy(), 10) == pool.store_preprocessed_data(data.copy(), 10, num_workers=2)
+	serial_shards, pool_shards = read_shards(serial), read_shards(pool)
+	assert list(serial_shards) == list(pool_shards) == ['from_0.parquet', 'from_10.parquet', 'from_20.parquet', 'from_30.parquet']
+	assert all(serial_shards[filename].equals(pool_shards[filename]) for filename in serial_shards)
+	for start in [0, 10, 20, 30]:
+		filename = 'meta_from_' + str(start) + '.pkl'
+		with open(os.path.join(serial.save_dir, filename), 'rb') as f_serial, open(os.path.join(pool.save_dir, filename), 'rb') as f_pool:
+			assert pickle.load(f_serial) == pickle.load(f_pool)
+
+
+def test_rebuild_does_not_merge_metadata_of_earlier_runs(tmp_path):
+	rebuilt = make_data_handler(tmp_path, 'rebuilt')
+	rebuilt.store_preprocessed_data(featurize(rebuilt, generate_tier('medium', 40, seed=3)), 10)
+	data = featurize(rebuilt, generate_tier('small', 15, seed=4))
+	rebuilt.store_preprocessed_data(data.copy(), 10)
+	fresh = make_data_handler(tmp_path, 'fresh')
+	fresh.store_preprocessed_data(data.copy(), 10)
+
+	assert sorted(os.listdir(rebuilt.save_dir)) == sorted(os.listdir(fresh.save_dir))
+	assert rebuilt.merge_shard_metadata() == fresh.merge_shard_metadata()
+	assert rebuilt.get_length_budget_stats() == fresh.get_length_budget_stats()
+
+
+def read_samples(data_handler):
+	# stored samples by key, with the node types of the LR paths mapped back to their names
+	node_types = data_handler.load_node_types()
+	samples = {}
+	for path in data_handler.iter_shard_paths(data_handler.save_dir):
+		for sample in pq.read_table(path).to_pylist():
+			sample['lr_paths_types'] = [[node_types[i] for i in path] for path in sample['lr_paths_types']]
+			samples[sample['sample_key']] = sample
+
+	return samples
+
+
+def test_incremental_build_with_drop_stale_matches_fresh_build(tmp_path):
+	incremental = make_data_handler(tmp_path, 'incremental')
+	data = generate_tier('small', 20, seed=5)
+	incremental.store_incremental_data(featurize(incremental, data), 10)
+
+	# 5 samples are removed, 3 are changed and 6 are new
+	changed = data.iloc[15:18].copy()
+	changed['text'] = changed['text'] + ' changed'
+	new_data = generate_tier('medium', 6, seed=6)
+	updated = featurize(incremental, pd.concat([data.iloc[:15], changed, new_data], ignore_index=True))
+	incremental.store_incremental_data(updated.copy(), 10, drop_stale=True)
+
+	fresh = make_data_handler(tmp_path, 'fresh')
+	node_types, _ = fresh.store_preprocessed_data(updated.copy(), 10)
+	fresh.convert_node_types_to_indices(node_types)
+	fresh.reduce_ll_sims()
+
+	incremental_samples, fresh_samples = read_samples(incremental), read_samples(fresh)
+	assert len(fresh_samples) == 24
+	assert incremental_samples.keys() == fresh_samples.keys()
+	assert incremental_samples == fresh_samples
@@ -0,0 +1,131 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
+
+from data_handler import PAD_TOK_ID_DFG
+from structure_aware_dataset import LEN_KEYS
+
+
+# reference collate of the samples as they were stored with their dense attention masks, before collate_fn wrote
+# all blocks into preallocated tensors
+
+def masked_attention(length):
+	return torch.triu(torch.ones((length, length)) * -1e9, diagonal=1)
+
+
+def full_attention(num_rows, num_cols, value):
+	return torch.full((num_rows, num_cols), float(value))
+
+
+def to_reference_sample(sample, padding_value):
+	# adds the dense masks that only depend on the block sizes and the labels and loss masks of the token ids
+	sample = dict(sample)
+	num_ast_leaves, num_dfg_nodes, num_code_tokens = (sample[key].size(0) for key in ['lr_paths_len', 'dfg_node_mask', 'code_token_ids'])
+	if 'text_token_ids' in sample:
+		num_text_tokens = sample['text_token_ids'].size(0)
+		sample['attn_text_tokens'] = masked_attention(num_text_tokens)
+		sample['attn_code_tokens'] = full_attention(num_code_tokens, num_code_tokens, 0)
+		sample['attn_ast_leaves'] = full_attention(num_ast_leaves, num_ast_leaves, 0)
+		sample['attn_code_text'] = full_attention(num_code_tokens, num_text_tokens, -1e9)
+		sample['attn_ast_text'] = full_attention(num_ast_leaves, num_text_tokens, -1e9)
+		sample['attn_dfg_text'] = full_attention(num_dfg_nodes, num_text_tokens, -1e9)
+		token_ids = sample['text_token_ids']
+	else:
+		sample['attn_code_tokens'] = masked_attention(num_code_tokens)
+		sample['attn_ast_leaves'] = masked_attention(num_ast_leaves)
+		token_ids = sample['code_token_ids']
+	sample['labels'] = torch.cat([torch.tensor([padding_value]), token_ids[1:]])
+	sample['loss_mask'] = torch.cat([torch.tensor([0]), torch.ones(len(token_ids[:-1]))])
+
+	return sample
+
+
+def pad_2d_tensors(tensor_list, padding_value):
+	max_rows = max(tensor.size(0) for tensor in tensor_list)
+	max_cols = max(tensor.size(1) for tensor in tensor_list)
+
+	return [F.pad(tensor, (0, max_cols - tensor.size(1), 0, max_rows - tensor.size(0)), mode='constant', value=padding_value)
+			for tensor in tensor_list]
+
+
+def reference_collate(dataset, batch):
+	is_code_text = 'text_token_ids' in batch[0]
+	batch = [to_reference_sample(sample, dataset.padding_value) for sample in batch]
+	attn_keys = ['attn_code_tokens', 'attn_ast_leaves', 'attn_dfg_edges', 'attn_code_ast', 'attn_code_dfg']
+	if is_code_text:
+		attn_keys += ['attn_text_tokens', 'attn_code_text', 'attn_ast_text', 'attn_dfg_text']
+	keys_not_in = ['code_token_ids', 'text_token_ids', 'dfg_node_mask', 'lr_paths_len', 'labels', 'loss_mask']
+
+	batch_dict = {}
+	for key in batch[0].keys():
+		batch_dict[key] = [sample[key] for sample in batch]
+		if key in LEN_KEYS:
+			batch_dict[key] = torch.stack(batch_dict[key])
+			continue
+		if key not in keys_not_in:
+			if key == 'lr_paths_types':
+				batch_dict[key] = pad_2d_tensors(batch_dict[key], padding_value=dataset.pad_tok_id_ast)
+			elif key in attn_keys:
+				batch_dict[key] = pad_2d_tensors(batch_dict[key], padding_value=-1e9)
+			else:
+				batch_dict[key] = pad_2d_tensors(batch_dict[key], padding_value=dataset.padding_value)
+
+		padding_value = dataset.padding_value
+		if key == 'dfg_node_mask':
+			padding_value = PAD_TOK_ID_DFG
+		if key in attn_keys:
+			padding_value = -1e9
+
+		if key in ['labels', 'loss_mask']:
+			batch_dict[key] = pad_sequence(batch_dict[key], batch_first=True, padding_value=padding_value, padding_side='left')
+		else:
+			batch_dict[key] = pad_sequence(batch_dict[key], batch_first=True, padding_value=padding_value)
+
+	pad_len = batch_dict['dfg_node_mask'][0].size(0) + batch_dict['lr_paths_len'][0].size(0)
+	if is_code_text:
+		pad_len += batch_dict['code_token_ids'][0].size(0)
+	for key in ['labels', 'loss_mask']:
+		batch_dict[key] = torch.stack([F.pad(value, (pad_len, 0), value=0) for value in batch_dict[key]])
+
+	attn_code_ast_T = batch_dict['attn_code_ast'].transpose(1, 2)
+	attn_code_dfg_T = batch_dict['attn_code_dfg'].transpose(1, 2)
+	attn_ast_leaves, attn_dfg_edges = batch_dict['attn_ast_leaves'], batch_dict['attn_dfg_edges']
+	attn_ast_dfg = torch.full((attn_ast_leaves.size(0), attn_ast_leaves.size(1), attn_dfg_edges.size(2)), fill_value=-1e9)
+	attn_ast_dfg_T = attn_ast_dfg.transpose(1, 2)
+
+	first_col_matrix = torch.cat((attn_ast_leaves, attn_ast_dfg_T, batch_dict['attn_code_ast']), dim=1)
+	second_col_matrix = torch.cat((attn_ast_dfg, attn_dfg_edges, batch_dict['attn_code_dfg']), dim=1)
+	third_col_matrix = torch.cat((attn_code_ast_T, attn_code_dfg_T, batch_dict['attn_code_tokens']), dim=1)
+	if is_code_text:
+		attn_code_text, attn_ast_text, attn_dfg_text = (batch_dict[key] for key in ['attn_code_text', 'attn_ast_text', 'attn_dfg_text'])
+		first_col_matrix = torch.cat((first_col_matrix, torch.full(attn_ast_text.transpose(1, 2).shape, fill_value=0)), dim=1)
+		second_col_matrix = torch.cat((second_col_matrix, torch.full(attn_dfg_text.transpose(1, 2).shape, fill_value=0)), dim=1)
+		third_col_matrix = torch.cat((third_col_matrix, torch.full(attn_code_text.transpose(1, 2).shape, fill_value=0)), dim=1)
+		fourth_col_matrix = torch.cat((attn_ast_text, attn_dfg_text, attn_code_text, batch_dict['attn_text_tokens']), dim=1)
+		attn_bias = torch.cat((first_col_matrix, second_col_matrix, third_col_matrix, fourth_col_matrix), dim=2)
+	else:
+		attn_bias = torch.cat((first_col_matrix, second_col_matrix, third_col_matrix), dim=2)
+	batch_dict['attention_bias'] = attn_bias.unsqueeze(1).bfloat16()
+
+	for key in attn_keys:
+		del batch_dict[key]
+
+	return batch_dict
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('task', ['code_completion', 'code_text'])
+def test_collate_fn_matches_reference(structure_aware_datasets, task, seed):
+	dataset = structure_aware_datasets[task]
+	rng = np.random.default_rng(seed)
+	for batch_size in rng.integers(1, 9, size=4):
+		samples = dataset.__getitems__(rng.choice(len(dataset), size=batch_size, replace=False))
+		batch, expected = dataset.collate_fn(samples), reference_collate(dataset, samples)
+
+		assert batch.keys() == expected.keys()
+		for key in expected:
+			assert batch[key].dtype == expected[key].dtype, key
+			assert torch.equal(batch[key], expected[key]), key
+		assert batch['attention_bias'].dtype == torch.bfloat16
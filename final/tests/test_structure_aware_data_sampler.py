@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+import torch
+
+from length_bucketed_batch_sampler import LengthBucketedBatchSampler
+from batch_prefetcher import BatchPrefetcher, get_samples
+
+pytest.importorskip('nemo')
+from nemo.lightning.data import WrappedDataLoader
+from structure_aware_data_sampler import StructureAwareDataSampler
+
+
+def get_sampler():
+	rng = np.random.default_rng(0)
+	sample_lengths = {key: rng.integers(1, 100, size=64) for key in ['num_ast_leaves', 'num_dfg_nodes', 'num_code_tokens']}
+
+	return LengthBucketedBatchSampler(sample_lengths, batch_size=4, bucket_size=16, data_parallel_rank=0, data_parallel_size=1)
+
+
+def test_bucketed_batch_sampler_is_kept():
+	data_sampler = StructureAwareDataSampler(seq_len=2048, micro_batch_size=4, global_batch_size=4)
+	batch_sampler = get_sampler()
+	dataloader = WrappedDataLoader(mode='train', dataset=list(range(64)), batch_sampler=batch_sampler, collate_fn=list)
+	expected = [batch.tolist() for batch in batch_sampler.get_batches(0)]
+
+	transformed = data_sampler.transform_dataloader(dataloader)
+	assert transformed is dataloader
+	assert list(transformed) == expected
+
+
+def test_consumed_samples_apply_to_training():
+	data_sampler = StructureAwareDataSampler(seq_len=2048, micro_batch_size=4, global_batch_size=4, init_consumed_samples=8)
+	for mode, num_skipped_batches in [('train', 2), ('validation', 0)]:
+		batch_sampler = get_sampler()
+		dataloader = WrappedDataLoader(mode=mode, dataset=list(range(64)), batch_sampler=batch_sampler, collate_fn=list)
+		expected = [batch.tolist() for batch in batch_sampler.get_batches(0)][num_skipped_batches:]
+		assert list(data_sampler.transform_dataloader(dataloader)) == expected
+
+
+def collate(samples, full=None):
+	return {'samples': torch.tensor(samples)}
+
+
+def test_prefetcher_survives_the_transformation():
+	data_sampler = StructureAwareDataSampler(seq_len=2048, micro_batch_size=4, global_batch_size=4)
+	batch_sampler = get_sampler()
+	dataloader = WrappedDataLoader(mode='train', dataset=list(range(64)), batch_sampler=batch_sampler, collate_fn=get_samples)
+	expected = [batch.tolist() for batch in batch_sampler.get_batches(0)]
+
+	transformed = data_sampler.transform_dataloader(BatchPrefetcher(dataloader, collate_fn=collate, device=None))
+	assert isinstance(transformed, BatchPrefetcher) and transformed.loader is dataloader
+	# the batches are collated by the prefetcher
+	assert [batch['samples'].tolist() for batch in transformed] == expected
+	assert transformed.num_batches == len(expected)
+
+
+def test_prefetcher_wraps_the_megatron_dataloader(monkeypatch):
+	parallel_state = pytest.importorskip('megatron.core.parallel_state')
+	# a single data-parallel rank without initializing the model-parallel groups
+	monkeypatch.setattr(parallel_state, 'get_data_parallel_rank', lambda *args, **kwargs: 0)
+	monkeypatch.setattr(parallel_state, 'get_data_parallel_world_size', lambda *args, **kwargs: 1)
+	data_sampler = StructureAwareDataSampler(seq_len=2048, micro_batch_size=4, global_batch_size=4)
+	dataloader = WrappedDataLoader(mode='train', dataset=list(range(64)), batch_size=4, collate_fn=get_samples)
+
+	transformed = data_sampler.transform_dataloader(BatchPrefetcher(dataloader, collate_fn=collate, device=None))
+	assert isinstance(transformed, BatchPrefetcher) and transformed.loader is not dataloader
+	assert [batch['samples'].tolist() for batch in transformed] == [list(range(i, i + 4)) for i in range(0, 64, 4)]
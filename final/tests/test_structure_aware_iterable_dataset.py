@@ -0,0 +1,49 @@
+import numpy as np
+from torch.utils.data import DataLoader
+
+from structure_aware_iterable_dataset import StructureAwareIterableDataset
+
+
+class ShardOffsets:
+
+	def __init__(self, shard_num_rows):
+		self.shard_num_rows = shard_num_rows
+
+	def get_shard_offsets(self):
+		return np.concatenate([[0], np.cumsum(self.shard_num_rows)])
+
+
+class IndexDataset:
+	# yields the indices of the samples instead of the samples
+
+	def __init__(self, shard_num_rows):
+		self.store = ShardOffsets(shard_num_rows)
+
+	def __getitems__(self, idxs):
+		return [int(i) for i in idxs]
+
+
+def get_epochs(dataset, num_epochs, **kwargs):
+	loader = DataLoader(dataset, batch_size=None, **kwargs)
+
+	return [list(loader) for _ in range(num_epochs)]
+
+
+def test_epoch_advances_with_every_iteration():
+	dataset = StructureAwareIterableDataset(IndexDataset([40] * 4), shuffle_buffer_size=16, row_group_size=10,
+											data_parallel_rank=0, data_parallel_size=1)
+	epochs = get_epochs(dataset, 3)
+	assert all(sorted(epoch) == list(range(160)) for epoch in epochs)
+	assert epochs[0] != epochs[1] != epochs[2]
+
+	# set_epoch restarts the sequence of epochs
+	dataset.set_epoch(1)
+	assert get_epochs(dataset, 1)[0] == epochs[1]
+
+
+def test_persistent_workers_advance_their_epoch():
+	dataset = StructureAwareIterableDataset(IndexDataset([40] * 4), shuffle_buffer_size=16, row_group_size=10,
+											data_parallel_rank=0, data_parallel_size=1)
+	epochs = get_epochs(dataset, 3, num_workers=2, persistent_workers=True)
+	assert all(sorted(epoch) == list(range(160)) for epoch in epochs)
+	assert epochs[0] != epochs[1] != epochs[2]